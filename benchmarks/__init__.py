@@ -0,0 +1,15 @@
+import statistics
+
+
+def percentiles(timings: list[float]) -> dict[str, float]:
+    cut_points = statistics.quantiles(timings, n=100)
+    return {"p50": cut_points[49], "p99": cut_points[98]}
+
+
+def report(results: dict[str, list[float]]):
+    for name, timings in results.items():
+        values = percentiles(timings)
+        print(
+            f"{name:>24}: p50 {values['p50'] * 1000:8.3f} ms"
+            f"  p99 {values['p99'] * 1000:8.3f} ms  ({len(timings)} runs)"
+        )
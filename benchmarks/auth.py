@@ -0,0 +1,50 @@
+# measures the get_current_user dependency with and without the verified token
+# cache, the user row is served from the user cache in both cases so only the
+# token verification differs
+#
+#     python -m benchmarks.auth --requests 20000
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from benchmarks import report
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=20000)
+args = parser.parse_args()
+
+os.environ["ENV_STATE"] = "test"
+
+from storeapi import security  # noqa: E402
+
+
+async def measure(clear_token_cache: bool) -> list[float]:
+    token = security.create_access_token("bench@example.net")
+    timings = []
+    for _ in range(args.requests):
+        if clear_token_cache:
+            security.token_cache.clear()
+        start = time.perf_counter()
+        await security.get_current_user(token)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def main():
+    security.user_cache.set("bench@example.net", {"id": 1}, ttl=3600)
+
+    await measure(clear_token_cache=True)
+    results = {
+        "jwt.decode every request": await measure(clear_token_cache=True),
+        "verified token cache": await measure(clear_token_cache=False),
+    }
+
+    report(results)
+    baseline, optimized = (statistics.median(t) for t in results.values())
+    print(f"p50 speedup: {baseline / optimized:.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+# compares fetching GET /post/{post_id} with two sequential queries (post then
+# comments) against the single query with the comments aggregated as JSON
+#
+#     python -m benchmarks.post_detail --posts 2000 --comments 10 --requests 5000
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from benchmarks import report
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--posts", type=int, default=2000)
+parser.add_argument("--comments", type=int, default=10)
+parser.add_argument("--requests", type=int, default=5000)
+args = parser.parse_args()
+
+tmp_dir = tempfile.TemporaryDirectory()
+os.environ["ENV_STATE"] = "test"
+os.environ["TEST_DATABASE_URL"] = f"sqlite:///{tmp_dir.name}/bench.db"
+os.environ["TEST_DB_FORCE_ROLLBACK"] = "false"
+
+from storeapi.database import (  # noqa: E402
+    comment_table,
+    database,
+    engine,
+    post_table,
+    user_table,
+)
+from storeapi.migrations import run_migrations  # noqa: E402
+from storeapi.routers.post import (  # noqa: E402
+    fetch_post_with_comments,
+    select_post_and_like,
+)
+
+
+def seed():
+    run_migrations(engine)
+    with engine.begin() as connection:
+        connection.execute(user_table.insert().values(id=1, email="bench@example.net"))
+        connection.execute(
+            post_table.insert(),
+            [{"body": f"Post {i}", "user_id": 1} for i in range(args.posts)],
+        )
+        connection.execute(
+            comment_table.insert(),
+            [
+                {"body": f"Comment {i}", "post_id": post_id, "user_id": 1}
+                for post_id in range(1, args.posts + 1)
+                for i in range(args.comments)
+            ],
+        )
+
+
+async def two_queries(post_id: int):
+    post = await database.fetch_one(
+        select_post_and_like.where(post_table.c.id == post_id)
+    )
+    comments = await database.fetch_all(
+        comment_table.select().where(comment_table.c.post_id == post_id)
+    )
+    return {"post": post, "comments": comments}
+
+
+async def measure(func) -> list[float]:
+    timings = []
+    for _ in range(args.requests):
+        post_id = random.randint(1, args.posts)
+        start = time.perf_counter()
+        await func(post_id)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def main():
+    seed()
+    await database.connect()
+    try:
+        # warm up the connection and the SQLite page cache
+        await measure(two_queries)
+        results = {
+            "two queries": await measure(two_queries),
+            "single query": await measure(fetch_post_with_comments),
+        }
+    finally:
+        await database.disconnect()
+
+    report(results)
+    baseline, optimized = (statistics.median(t) for t in results.values())
+    print(f"p50 speedup: {baseline / optimized:.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
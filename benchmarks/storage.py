@@ -0,0 +1,81 @@
+# upload throughput of the storage backends, every run stores new random
+# content so the content-hashed local backend never skips a copy. B2 is only
+# measured when TEST_B2_KEY_ID, TEST_B2_APPLICATION_KEY and TEST_B2_BUCKET_NAME
+# are set
+#
+#     python -m benchmarks.storage --size-mb 64 --runs 10
+import argparse
+import io
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks import report
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--size-mb", type=int, default=64)
+parser.add_argument("--runs", type=int, default=10)
+args = parser.parse_args()
+
+tmp_dir = tempfile.TemporaryDirectory()
+os.environ["ENV_STATE"] = "test"
+
+from storeapi.config import config  # noqa: E402
+from storeapi.storage.b2 import B2Storage  # noqa: E402
+from storeapi.storage.local import LocalStorage  # noqa: E402
+
+size = args.size_mb * 1024 * 1024
+
+
+def random_file() -> str:
+    path = os.path.join(tmp_dir.name, "upload.tmp")
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def measure_file(storage) -> list[float]:
+    timings = []
+    for run in range(args.runs):
+        path = random_file()
+        start = time.perf_counter()
+        storage.upload_file(path, f"bench-{run}.bin")
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def measure_stream(storage) -> list[float]:
+    timings = []
+    for run in range(args.runs):
+        source = io.BytesIO(os.urandom(size))
+        start = time.perf_counter()
+        storage.upload_stream(source, f"bench-{run}.bin")
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    backends = {
+        "local": LocalStorage(os.path.join(tmp_dir.name, "files"), "/files"),
+    }
+    if config.B2_KEY_ID and config.B2_APPLICATION_KEY and config.B2_BUCKET_NAME:
+        backends["b2"] = B2Storage(
+            config.UPLOAD_PART_SIZE, config.UPLOAD_STREAM_BUFFERS
+        )
+    else:
+        print("B2 credentials not set, only measuring the local backend")
+
+    results = {}
+    for name, storage in backends.items():
+        results[f"{name} file"] = measure_file(storage)
+        results[f"{name} stream"] = measure_stream(storage)
+
+    report(results)
+    for name, timings in results.items():
+        throughput = args.size_mb / statistics.median(timings)
+        print(f"{name:>24}: {throughput:10.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
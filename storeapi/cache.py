@@ -0,0 +1,139 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from storeapi import metrics
+from storeapi.config import config
+from storeapi.etag import resource_versions
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    # least recently used entries are evicted once maxsize is reached and every
+    # entry expires after ttl seconds
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        if self.maxsize <= 0 or (ttl is not None and ttl <= 0):
+            return
+
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable) -> bool:
+        if self._data.pop(key, None) is None:
+            return False
+
+        self.invalidations += 1
+        return True
+
+    def delete_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        keys = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+        for key in keys:
+            del self._data[key]
+
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+# keys are ("feed", sorting, limit, after) -> (posts, next_cursor),
+# ("post", post_id) -> post with comments and ("comments", post_id) -> comments
+post_cache = TTLCache(
+    maxsize=config.POST_CACHE_MAXSIZE, ttl=config.POST_CACHE_TTL_SECONDS
+)
+metrics.register("post_cache", post_cache.stats)
+
+
+def _feed_contains(value: Any, post_id: int) -> bool:
+    posts, _ = value
+    return any(post["id"] == post_id for post in posts)
+
+
+# the invalidate_* functions are called after every write and also bump the
+# resource versions used for the ETags
+
+
+def invalidate_new_post() -> None:
+    resource_versions.bump_feed()
+    # a new post has the highest id and no likes, so it only shows up on the
+    # first page of "new", the last page of "old" and anywhere in "most_likes"
+    evicted = post_cache.delete_where(
+        lambda key, value: key[0] == "feed"
+        and (
+            (key[1] == "new" and key[3] is None)
+            or value[1] is None
+            or key[1] == "most_likes"
+        )
+    )
+    logger.debug(f"Evicted {evicted} cached feed pages for a new post")
+
+
+def invalidate_post(post_id: int, likes_changed: bool = False) -> None:
+    resource_versions.bump_feed()
+    resource_versions.bump_post(post_id)
+    post_cache.delete(("post", post_id))
+    evicted = post_cache.delete_where(
+        lambda key, value: key[0] == "feed"
+        and (
+            (likes_changed and key[1] == "most_likes") or _feed_contains(value, post_id)
+        )
+    )
+    logger.debug(f"Evicted post {post_id} and {evicted} cached feed pages")
+
+
+def invalidate_comments(post_id: int) -> None:
+    resource_versions.bump_post(post_id)
+    post_cache.delete(("post", post_id))
+    post_cache.delete(("comments", post_id))
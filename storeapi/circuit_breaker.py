@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # closed: calls go through and consecutive failures are counted, at
+    # failure_threshold the breaker opens. open: calls fail right away until
+    # reset_timeout passed, then the breaker is half open. half_open: a single
+    # probe call goes through, its success closes the breaker and its failure
+    # opens it again
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+        deadline: float,
+        max_pending: int,
+        is_failure: Callable[[BaseException], bool] = lambda err: True,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.deadline = deadline
+        self.max_pending = max_pending
+        self.is_failure = is_failure
+        self.pending = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probing = False
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if (
+            self._state == "open"
+            and time.monotonic() - self._opened_at >= self.reset_timeout
+        ):
+            self._state = "half_open"
+            logger.info(f"Circuit {self.name} is half open")
+        return self._state
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        raise CircuitOpenError(f"{self.name} {reason}")
+
+    def _acquire(self) -> bool:
+        state = self.state
+        if state == "open":
+            self._reject("circuit is open")
+        if state == "half_open":
+            if self._probing:
+                self._reject("circuit is half open, probe in progress")
+            self._probing = True
+            return True
+        if self.pending >= self.max_pending:
+            self._reject(f"has {self.pending} pending calls")
+        return False
+
+    def _open(self) -> None:
+        logger.warning(
+            f"Circuit {self.name} opened after {self.consecutive_failures} failures"
+        )
+        self._state = "open"
+        self._opened_at = time.monotonic()
+        self.opened += 1
+
+    def _record(self, failed: bool, probe: bool) -> None:
+        if probe:
+            self._probing = False
+
+        if not failed:
+            self.successes += 1
+            self.consecutive_failures = 0
+            if probe:
+                logger.info(f"Circuit {self.name} closed")
+                self._state = "closed"
+            return
+
+        self.failures += 1
+        self.consecutive_failures += 1
+        if probe or (
+            self._state == "closed"
+            and self.consecutive_failures >= self.failure_threshold
+        ):
+            self._open()
+
+    @asynccontextmanager
+    async def call(self):
+        # raises CircuitOpenError without calling the dependency, TimeoutError
+        # once the call takes longer than the deadline
+        probe = self._acquire()
+        self.pending += 1
+        try:
+            async with asyncio.timeout(self.deadline):
+                yield
+        except TimeoutError:
+            self.timeouts += 1
+            self._record(failed=True, probe=probe)
+            raise
+        except asyncio.CancelledError:
+            # a cancelled call says nothing about the dependency
+            if probe:
+                self._probing = False
+            raise
+        except Exception as err:
+            # errors such as a 4xx mean the dependency is up
+            self._record(failed=self.is_failure(err), probe=probe)
+            raise
+        else:
+            self._record(failed=False, probe=probe)
+        finally:
+            self.pending -= 1
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "opened": self.opened,
+        }
@@ -15,11 +15,84 @@ class GlobalConfig(BaseConfig):
     DB_FORCE_ROLLBACK: bool = False
     MAILGUN_DOMAIN: Optional[str] = None
     MAILGUN_API_KEY: Optional[str] = None
+    MAILGUN_API_URL: str = "https://api.mailgun.net/v3"
     LOGTAIL_API_KEY: Optional[str] = None
     B2_KEY_ID: Optional[str] = None
     B2_APPLICATION_KEY: Optional[str] = None
     B2_BUCKET_NAME: Optional[str] = None
+    # the token is valid for 24 hours and renewed well before that
+    B2_AUTH_REFRESH_SECONDS: float = 12 * 3600
+    B2_AUTH_RETRY_SECONDS: float = 60
     DEEPAI_API_KEY: Optional[str] = None
+    POST_CACHE_MAXSIZE: int = 1024
+    POST_CACHE_TTL_SECONDS: float = 30
+    LIKES_WRITE_BEHIND: bool = False
+    LIKES_FLUSH_INTERVAL_MS: int = 200
+    LIKES_FLUSH_MAX_ROWS: int = 500
+    BULK_MAX_ITEMS: int = 1000
+    USER_CACHE_MAXSIZE: int = 4096
+    USER_CACHE_TTL_SECONDS: float = 60
+    TOKEN_CACHE_MAXSIZE: int = 8192
+    # "thread" or "process", bcrypt releases the GIL so threads are enough
+    PASSWORD_HASH_EXECUTOR: str = "thread"
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_PENDING: int = 32
+    # look the user up in the database even when the token carries its claims
+    ACCESS_TOKEN_FRESH_USER: bool = False
+    HTTP_CLIENT_MAX_CONNECTIONS: int = 100
+    HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_CLIENT_KEEPALIVE_EXPIRY_SECONDS: float = 30
+    HTTP_CLIENT_TIMEOUT_SECONDS: float = 10
+    # needs the optional h2 package (httpx[http2])
+    HTTP_CLIENT_HTTP2: bool = False
+    # run emails and image generation from the jobs table instead of
+    # BackgroundTasks, the workers run in the app unless JOB_WORKERS_IN_PROCESS
+    # is off and `python -m storeapi.worker` runs them
+    JOB_QUEUE_ENABLED: bool = False
+    JOB_WORKERS_IN_PROCESS: bool = True
+    JOB_WORKERS: int = 4
+    JOB_POLL_INTERVAL_SECONDS: float = 1
+    JOB_VISIBILITY_TIMEOUT_SECONDS: float = 300
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BACKOFF_SECONDS: float = 2
+    JOB_RETRY_BACKOFF_MAX_SECONDS: float = 600
+    # send registration emails sent within the window in one Mailgun call, a
+    # job worker claims up to a batch of due email jobs and runs them together
+    EMAIL_BATCHING: bool = False
+    EMAIL_BATCH_WINDOW_MS: int = 500
+    EMAIL_BATCH_MAX_RECIPIENTS: int = 1000
+    IMAGE_CACHE_MAXSIZE: int = 1024
+    IMAGE_CACHE_TTL_SECONDS: float = 86400
+    DEEPAI_MAX_CONCURRENCY: int = 4
+    # Mailgun and DeepAI calls fail fast once BREAKER_FAILURE_THRESHOLD calls
+    # in a row failed, a probe call is let through after the reset timeout
+    BREAKER_FAILURE_THRESHOLD: int = 5
+    BREAKER_RESET_TIMEOUT_SECONDS: float = 30
+    MAILGUN_DEADLINE_SECONDS: float = 10
+    MAILGUN_MAX_PENDING: int = 100
+    DEEPAI_DEADLINE_SECONDS: float = 60
+    DEEPAI_MAX_PENDING: int = 20
+    # storage uploads run in their own thread pool
+    UPLOAD_WORKERS: int = 4
+    UPLOAD_MAX_PENDING: int = 16
+    # uploads of at least one part are streamed to B2 as a large file, with at
+    # most UPLOAD_STREAM_BUFFERS parts in memory, smaller ones use a temp file.
+    # B2 parts must be at least 5 MB
+    UPLOAD_PART_SIZE: int = 16 * 1024 * 1024
+    UPLOAD_STREAM_BUFFERS: int = 4
+    # "b2" or "local", local stores the files under LOCAL_STORAGE_PATH and
+    # serves them from LOCAL_STORAGE_URL
+    STORAGE_BACKEND: str = "b2"
+    LOCAL_STORAGE_PATH: str = "uploads"
+    LOCAL_STORAGE_URL: str = "/files"
+    # resumable uploads keep their chunks here until they are completed,
+    # sessions not touched for UPLOAD_SESSION_TTL_SECONDS are removed
+    UPLOAD_SESSION_PATH: str = "upload_sessions"
+    UPLOAD_SESSION_MAX_CHUNK_SIZE: int = 64 * 1024 * 1024
+    # also bounds the chunks a session of unknown size can take
+    UPLOAD_SESSION_MAX_SIZE: int = 5 * 1024 * 1024 * 1024
+    UPLOAD_SESSION_TTL_SECONDS: float = 24 * 3600
+    UPLOAD_SESSION_GC_INTERVAL_SECONDS: float = 600
 
 
 class ProdConfig(GlobalConfig):
@@ -12,6 +12,14 @@ post_table = sqlalchemy.Table(
     sqlalchemy.Column("body", sqlalchemy.String),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
     sqlalchemy.Column("image_url", sqlalchemy.String),
+    # denormalized count of rows in likes, kept in sync by like_post
+    sqlalchemy.Column("likes", sqlalchemy.Integer, nullable=False, server_default="0"),
+    # bumped by updates that may come from another process, e.g. the image
+    # added by a job worker, the ETags include it so they change in every process
+    sqlalchemy.Column(
+        "version", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Index("ix_posts_likes_id", "likes", "id"),
 )
 
 comment_table = sqlalchemy.Table(
@@ -21,6 +29,7 @@ comment_table = sqlalchemy.Table(
     sqlalchemy.Column("body", sqlalchemy.String),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    sqlalchemy.Index("ix_comments_post_id", "post_id"),
 )
 
 user_table = sqlalchemy.Table(
@@ -38,6 +47,106 @@ like_table = sqlalchemy.Table(
     sqlalchemy.Column("id", sqlalchemy.Integer(), primary_key=True),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    # also serves lookups by post_id as it is the leading column
+    sqlalchemy.Index("uq_likes_post_id_user_id", "post_id", "user_id", unique=True),
+    sqlalchemy.Index("ix_likes_user_id", "user_id"),
+)
+
+# the FTS5 table mirroring posts.body, created by migration 0003
+posts_fts_table = sqlalchemy.table("posts_fts", sqlalchemy.column("rowid"))
+
+schema_migrations_table = sqlalchemy.Table(
+    "schema_migrations",
+    metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer(), primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column(
+        "applied_at", sqlalchemy.DateTime, server_default=sqlalchemy.func.now()
+    ),
+)
+
+# durable background jobs, times are unix timestamps so they compare the same
+# from every process sharing the database
+job_table = sqlalchemy.Table(
+    "jobs",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer(), primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("payload", sqlalchemy.JSON, nullable=False),
+    # queued -> running -> done, or back to queued for a retry, failed once
+    # max_attempts is reached
+    sqlalchemy.Column("status", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("attempts", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("max_attempts", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("run_at", sqlalchemy.Float, nullable=False),
+    # a running job whose lock expired is picked up again by another worker
+    sqlalchemy.Column("locked_until", sqlalchemy.Float),
+    sqlalchemy.Column("finished_at", sqlalchemy.Float),
+    sqlalchemy.Column("last_error", sqlalchemy.String),
+    sqlalchemy.Index("ix_jobs_status_run_at", "status", "run_at"),
+)
+
+# content hash -> stored file, lets uploads of content already in storage
+# skip the transfer
+upload_table = sqlalchemy.Table(
+    "uploads",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer(), primary_key=True),
+    # sha256 hex digest of the content
+    sqlalchemy.Column("content_hash", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("file_url", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("file_name", sqlalchemy.String),
+    sqlalchemy.Column("size", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column(
+        "created_at", sqlalchemy.DateTime, server_default=sqlalchemy.func.now()
+    ),
+    sqlalchemy.Index("uq_uploads_content_hash", "content_hash", unique=True),
+)
+
+# resumable uploads, the chunks are kept as files until the session is
+# completed and are tracked here so any process can see what was received
+upload_session_table = sqlalchemy.Table(
+    "upload_sessions",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("file_name", sqlalchemy.String, nullable=False),
+    # expected total size, None when the client did not know it
+    sqlalchemy.Column("size", sqlalchemy.Integer),
+    sqlalchemy.Column("chunk_size", sqlalchemy.Integer, nullable=False),
+    # open -> completing -> complete, back to open when completing fails
+    sqlalchemy.Column("status", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("file_url", sqlalchemy.String),
+    sqlalchemy.Column("created_at", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("updated_at", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Index("ix_upload_sessions_updated_at", "updated_at"),
+)
+
+upload_chunk_table = sqlalchemy.Table(
+    "upload_chunks",
+    metadata,
+    sqlalchemy.Column(
+        "session_id",
+        sqlalchemy.ForeignKey("upload_sessions.id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("chunk", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("size", sqlalchemy.Integer, nullable=False),
+    # name of the chunk file in the session dir, every put writes a new one
+    sqlalchemy.Column("file", sqlalchemy.String),
+)
+
+# recomputes the denormalized posts.likes counter from the likes table, the
+# version of a corrected post is bumped so its ETags change in every process
+post_likes_count = (
+    sqlalchemy.select(sqlalchemy.func.count(like_table.c.id))
+    .where(like_table.c.post_id == post_table.c.id)
+    .scalar_subquery()
+)
+reconcile_post_likes_query = (
+    post_table.update()
+    .where(post_table.c.likes != post_likes_count)
+    .values(likes=post_likes_count, version=post_table.c.version + 1)
 )
 
 engine = sqlalchemy.create_engine(
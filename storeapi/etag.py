@@ -0,0 +1,59 @@
+import hashlib
+import itertools
+import uuid
+from typing import Optional
+
+from fastapi import Request, Response
+
+
+class ResourceVersions:
+    # versions are taken from one monotonic counter and are only valid for the
+    # lifetime of the process, the boot id keeps ETags from a previous process
+    # from matching
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.boot_id = uuid.uuid4().hex[:8]
+        self._counter = itertools.count(1)
+        self.feed = 0
+        self._posts: dict[int, int] = {}
+
+    def bump_feed(self) -> None:
+        self.feed = next(self._counter)
+
+    def bump_post(self, post_id: int) -> None:
+        self._posts[post_id] = next(self._counter)
+
+    def post(self, post_id: int) -> int:
+        return self._posts.get(post_id, 0)
+
+
+resource_versions = ResourceVersions()
+
+
+def make_etag(version: int, *parts) -> str:
+    # parts identify the representation, e.g. the sorting and page of the feed
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:12]
+    return f'W/"{resource_versions.boot_id}-{version}-{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    # If-None-Match uses the weak comparison so the W/ prefix is ignored
+    opaque_tag = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == opaque_tag
+        for candidate in if_none_match.split(",")
+    )
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
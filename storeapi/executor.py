@@ -0,0 +1,116 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from fastapi import HTTPException, status
+
+logger = logging.getLogger(__name__)
+
+
+def _timed_call(func: Callable) -> tuple[float, float, object]:
+    # runs in the worker, wall clock time so it also works in a process pool
+    started = time.time()
+    result = func()
+    return started, time.time() - started, result
+
+
+class BoundedExecutor:
+    # runs blocking calls in a worker pool, created on first use, so they do
+    # not block the event loop. At most max_pending calls may be queued or
+    # running before callers are turned away with a 503
+    def __init__(
+        self,
+        name: str,
+        workers: int,
+        max_pending: int,
+        executor: str = "thread",
+        retry_after: int = 1,
+    ) -> None:
+        self.name = name
+        self.executor_type = executor
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self._executor: Optional[Executor] = None
+        self.pending = 0
+        self.calls = 0
+        self.failed = 0
+        self.rejected = 0
+        self.queue_seconds_total = 0.0
+        self.queue_seconds_max = 0.0
+        self.run_seconds_total = 0.0
+        self.run_seconds_max = 0.0
+        self.last_run_seconds = 0.0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_type == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix=self.name
+                )
+        return self._executor
+
+    def check_capacity(self) -> None:
+        # also called before work that only pays off if a slot is free, e.g.
+        # receiving the upload the pool would then refuse to store
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            logger.warning(f"{self.name} pool is saturated")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+    async def run(self, func: Callable, *args, **kwargs):
+        self.check_capacity()
+
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        submitted = time.time()
+        try:
+            started, run_seconds, result = await loop.run_in_executor(
+                self._get_executor(),
+                _timed_call,
+                functools.partial(func, *args, **kwargs),
+            )
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+
+        queue_seconds = max(started - submitted, 0.0)
+        self.calls += 1
+        self.queue_seconds_total += queue_seconds
+        self.queue_seconds_max = max(self.queue_seconds_max, queue_seconds)
+        self.run_seconds_total += run_seconds
+        self.run_seconds_max = max(self.run_seconds_max, run_seconds)
+        self.last_run_seconds = run_seconds
+
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> dict:
+        calls = max(self.calls, 1)
+        return {
+            "executor": self.executor_type,
+            "workers": self.workers,
+            "pending": self.pending,
+            "calls": self.calls,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "queue_seconds_avg": self.queue_seconds_total / calls,
+            "queue_seconds_max": self.queue_seconds_max,
+            "run_seconds_avg": self.run_seconds_total / calls,
+            "run_seconds_max": self.run_seconds_max,
+        }
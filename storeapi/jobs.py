@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import sqlalchemy
+from databases import Database
+
+from storeapi import mailer, metrics, tasks
+from storeapi.config import config
+from storeapi.database import database, job_table
+
+logger = logging.getLogger(__name__)
+
+# job name -> handler called with the database and the payload as keyword
+# arguments, payloads are stored as JSON so they only hold plain values
+HANDLERS: dict[str, Callable[..., Awaitable]] = {}
+# job name -> called like the handler once the job failed for good
+FAILURE_HANDLERS: dict[str, Callable[..., Awaitable]] = {}
+# job name -> how many due jobs of that name a worker claims and runs at once
+BATCH_SIZES: dict[str, Callable[[], int]] = {}
+
+
+def handler(
+    name: str,
+    on_failure: Optional[Callable[..., Awaitable]] = None,
+    batch_size: Optional[Callable[[], int]] = None,
+):
+    def decorator(func):
+        HANDLERS[name] = func
+        if on_failure is not None:
+            FAILURE_HANDLERS[name] = on_failure
+        if batch_size is not None:
+            BATCH_SIZES[name] = batch_size
+        return func
+
+    return decorator
+
+
+def email_batch_size() -> int:
+    # each send waits for its batch, so a worker claims a whole batch worth of
+    # emails instead of the batch only ever holding one email per worker
+    return mailer.email_batcher.max_recipients if mailer.email_batcher.running else 1
+
+
+@handler("send_user_registration_email", batch_size=email_batch_size)
+async def send_user_registration_email(
+    database: Database, email: str, confirmation_url: str
+):
+    await mailer.send_user_registration_email(email, confirmation_url)
+
+
+async def image_generation_failed(
+    database: Database, email: str, post_id: int, post_url: str, prompt: str
+):
+    # the image may have been added and only the email failed
+    if await tasks.post_image_url(post_id, database) is None:
+        await tasks.send_image_failed_email(email)
+
+
+@handler("generate_and_add_to_post", on_failure=image_generation_failed)
+async def generate_and_add_to_post(
+    database: Database, email: str, post_id: int, post_url: str, prompt: str
+):
+    # errors are raised so the job is retried with backoff, an image added by
+    # an earlier attempt is not generated again
+    await tasks.add_image_to_post(post_id, database, prompt)
+    await tasks.send_image_added_email(email, post_url)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class JobQueue:
+    # jobs are claimed with a single UPDATE ... RETURNING so several workers,
+    # in this process or in `python -m storeapi.worker`, never run the same job
+    # while its lock is held. A worker that dies leaves the job running until
+    # locked_until passes and another worker claims it again
+    def __init__(
+        self,
+        database: Database,
+        workers: int,
+        poll_interval: float,
+        visibility_timeout: float,
+        max_attempts: int,
+        backoff: float,
+        backoff_max: float,
+    ) -> None:
+        self.database = database
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._tasks: list[asyncio.Task] = []
+        self.enqueued = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        self.depth = 0
+        # seconds between a job becoming due and a worker starting it, and
+        # seconds spent running it, for the most recent jobs
+        self._wait_times: deque[float] = deque(maxlen=1000)
+        self._run_times: deque[float] = deque(maxlen=1000)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def enqueue(
+        self, name: str, delay: float = 0, max_attempts: Optional[int] = None, **payload
+    ) -> int:
+        if name not in HANDLERS:
+            raise ValueError(f"Unknown job {name}")
+
+        now = time.time()
+        query = job_table.insert().values(
+            name=name,
+            payload=payload,
+            status="queued",
+            attempts=0,
+            max_attempts=max_attempts or self.max_attempts,
+            created_at=now,
+            run_at=now + delay,
+        )
+        logger.debug(query)
+
+        job_id = await self.database.execute(query)
+        self.enqueued += 1
+        self.depth += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+        return job_id
+
+    async def claim(self, name: Optional[str] = None, limit: int = 1) -> list:
+        now = time.time()
+        next_jobs = (
+            sqlalchemy.select(job_table.c.id)
+            .where(
+                sqlalchemy.or_(
+                    sqlalchemy.and_(
+                        job_table.c.status == "queued", job_table.c.run_at <= now
+                    ),
+                    sqlalchemy.and_(
+                        job_table.c.status == "running",
+                        job_table.c.locked_until <= now,
+                    ),
+                )
+            )
+            .order_by(job_table.c.run_at)
+            .limit(limit)
+        )
+        if name is not None:
+            next_jobs = next_jobs.where(job_table.c.name == name)
+        query = (
+            job_table.update()
+            .where(job_table.c.id.in_(next_jobs))
+            .values(
+                status="running",
+                attempts=job_table.c.attempts + 1,
+                locked_until=now + self.visibility_timeout,
+            )
+            .returning(job_table)
+        )
+
+        return await self.database.fetch_all(query)
+
+    def retry_delay(self, attempts: int) -> float:
+        return min(self.backoff_max, self.backoff * 2 ** (attempts - 1))
+
+    async def _finish(self, job, error: Optional[str]) -> None:
+        now = time.time()
+        if error is None:
+            values = {"status": "done", "locked_until": None, "finished_at": now}
+            self.succeeded += 1
+        elif job.attempts >= job.max_attempts:
+            logger.error(f"Job {job.id} {job.name} failed for good: {error}")
+            values = {
+                "status": "failed",
+                "locked_until": None,
+                "finished_at": now,
+                "last_error": error,
+            }
+            self.failed += 1
+        else:
+            delay = self.retry_delay(job.attempts)
+            logger.warning(f"Job {job.id} {job.name} failed, retrying in {delay}s")
+            values = {
+                "status": "queued",
+                "locked_until": None,
+                "run_at": now + delay,
+                "last_error": error,
+            }
+            self.retried += 1
+
+        # the lock may have expired and the job been claimed again by another
+        # worker, only the holder of the current attempt records its outcome
+        query = (
+            job_table.update()
+            .where(job_table.c.id == job.id, job_table.c.attempts == job.attempts)
+            .values(values)
+        )
+        await self.database.execute(query)
+
+        if values["status"] == "failed" and job.name in FAILURE_HANDLERS:
+            try:
+                await FAILURE_HANDLERS[job.name](self.database, **job.payload)
+            except Exception:
+                logger.exception(f"Failure handler of job {job.id} {job.name} raised")
+
+    async def run_one(self) -> int:
+        # returns the number of jobs run, several when the claimed job has a
+        # batch size and more jobs of its name are due
+        jobs = await self.claim()
+        if not jobs:
+            return 0
+
+        batch_size = BATCH_SIZES.get(jobs[0].name, lambda: 1)()
+        if batch_size > 1:
+            jobs += await self.claim(jobs[0].name, batch_size - 1)
+
+        await asyncio.gather(*(self._run_job(job) for job in jobs))
+        return len(jobs)
+
+    async def _run_job(self, job) -> None:
+        started = time.time()
+        # a retried job waited on purpose, only the time past run_at counts
+        self._wait_times.append(max(0.0, started - job.run_at))
+        logger.info(f"Running job {job.id} {job.name}, attempt {job.attempts}")
+
+        error = None
+        try:
+            func = HANDLERS[job.name]
+            # past the visibility timeout another worker may claim the job
+            await asyncio.wait_for(
+                func(self.database, **job.payload), self.visibility_timeout
+            )
+        except asyncio.TimeoutError:
+            error = f"timed out after {self.visibility_timeout}s"
+        except Exception as err:
+            logger.exception(f"Job {job.id} {job.name} raised")
+            error = f"{type(err).__name__}: {err}"
+
+        self._run_times.append(time.time() - started)
+        await self._finish(job, error)
+
+    async def run_pending(self) -> int:
+        # runs due jobs until none is left, used by `storeapi.worker --burst`
+        ran = 0
+        while ran_now := await self.run_one():
+            ran += ran_now
+        await self.refresh_depth()
+        return ran
+
+    async def refresh_depth(self) -> int:
+        query = (
+            sqlalchemy.select(sqlalchemy.func.count())
+            .select_from(job_table)
+            .where(job_table.c.status.in_(["queued", "running"]))
+        )
+        self.depth = await self.database.fetch_val(query)
+        return self.depth
+
+    async def start(self) -> None:
+        logger.info(f"Starting {self.workers} job workers")
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._run(worker)) for worker in range(self.workers)
+        ]
+
+    async def stop(self) -> None:
+        if not self._tasks:
+            return
+
+        # workers finish the job they are running, unfinished jobs stay in the
+        # table and are picked up after a restart
+        logger.info("Stopping job workers")
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+
+    async def _run(self, worker: int) -> None:
+        while not self._stopping:
+            try:
+                if await self.run_one():
+                    continue
+                await self.refresh_depth()
+            except Exception:
+                logger.exception(f"Job worker {worker} failed to poll the queue")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            if not self._stopping:
+                self._wakeup.clear()
+
+    def stats(self) -> dict:
+        wait_times, run_times = list(self._wait_times), list(self._run_times)
+        return {
+            "running": self.running,
+            "workers": len(self._tasks),
+            "depth": self.depth,
+            "enqueued": self.enqueued,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "failed": self.failed,
+            "wait_seconds_p50": _percentile(wait_times, 0.5),
+            "wait_seconds_p95": _percentile(wait_times, 0.95),
+            "run_seconds_p50": _percentile(run_times, 0.5),
+            "run_seconds_p95": _percentile(run_times, 0.95),
+        }
+
+
+job_queue = JobQueue(
+    database,
+    workers=config.JOB_WORKERS,
+    poll_interval=config.JOB_POLL_INTERVAL_SECONDS,
+    visibility_timeout=config.JOB_VISIBILITY_TIMEOUT_SECONDS,
+    max_attempts=config.JOB_MAX_ATTEMPTS,
+    backoff=config.JOB_RETRY_BACKOFF_SECONDS,
+    backoff_max=config.JOB_RETRY_BACKOFF_MAX_SECONDS,
+)
+metrics.register("job_queue", job_queue.stats)
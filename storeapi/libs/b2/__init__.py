@@ -1,5 +1,9 @@
+import asyncio
+import hashlib
 import logging
-from functools import lru_cache
+import threading
+import time
+from typing import BinaryIO, Optional
 
 import b2sdk.v2 as b2
 from storeapi.config import config
@@ -7,26 +11,153 @@ from storeapi.config import config
 logger = logging.getLogger(__name__)
 
 
-# cached to run it once
-@lru_cache()
-def b2_api():
-    logger.debug("Creating and authorizing B2 API")
-    info = b2.InMemoryAccountInfo()
-    b2_api = b2.B2Api(info)
-    b2_api.authorize_account("production", config.B2_KEY_ID, config.B2_APPLICATION_KEY)
-    return b2_api
+# B2 auth tokens are valid for 24 hours
+TOKEN_LIFETIME_SECONDS = 24 * 3600
 
 
-@lru_cache()
-def b2_get_bucket(api: b2.B2Api):
-    return api().get_bucket_by_name(config.B2_BUCKET_NAME)
+class B2Client:
+    # one authorized api and the resolved bucket shared by all uploads. The
+    # app authorizes and looks the bucket up at startup and renews the token
+    # every refresh_interval seconds in the background, so an upload never
+    # waits for either. Processes that do not start it authorize on first use
+    def __init__(self, refresh_interval: float, retry_interval: float) -> None:
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._api: Optional[b2.B2Api] = None
+        self._bucket: Optional[b2.Bucket] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self.authorized_at: Optional[float] = None
+        self.authorizations = 0
+        self.bucket_lookups = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def _authorize(self) -> None:
+        # the token of an existing api is renewed in place, buckets already
+        # handed out keep working with it
+        api = self._api or b2.B2Api(b2.InMemoryAccountInfo())
+        try:
+            logger.debug("Authorizing B2 API")
+            api.authorize_account(
+                "production", config.B2_KEY_ID, config.B2_APPLICATION_KEY
+            )
+            self._api = api
+            self.authorized_at = time.time()
+            self.authorizations += 1
+            if self._bucket is None:
+                self._bucket = api.get_bucket_by_name(config.B2_BUCKET_NAME)
+                self.bucket_lookups += 1
+        except Exception as err:
+            self.failures += 1
+            self.last_error = repr(err)
+            raise
+        self.last_error = None
+
+    def authorize(self) -> None:
+        with self._lock:
+            self._authorize()
+
+    def api(self) -> b2.B2Api:
+        if self._api is None:
+            with self._lock:
+                if self._api is None:
+                    self._authorize()
+        return self._api
+
+    def bucket(self) -> b2.Bucket:
+        if self._bucket is None:
+            with self._lock:
+                if self._bucket is None:
+                    self._authorize()
+        return self._bucket
+
+    async def start(self) -> None:
+        logger.info("Authorizing B2 and resolving the bucket")
+        try:
+            await asyncio.to_thread(self.authorize)
+        except Exception:
+            # not fatal, the refresh loop retries and uploads authorize lazily
+            logger.exception("B2 warm-up failed")
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            if self.last_error is None:
+                delay = self.refresh_interval
+            else:
+                delay = self.retry_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                break
+
+            try:
+                await asyncio.to_thread(self.authorize)
+                logger.debug("Refreshed the B2 auth token")
+            except Exception:
+                logger.exception("Refreshing the B2 auth token failed")
+
+    def token_expires_in(self) -> Optional[float]:
+        if self.authorized_at is None:
+            return None
+        return self.authorized_at + TOKEN_LIFETIME_SECONDS - time.time()
+
+    def stats(self) -> dict:
+        expires_in = self.token_expires_in()
+        return {
+            "running": self.running,
+            "authorized": self._api is not None,
+            "bucket_cached": self._bucket is not None,
+            "token_expires_in_seconds": expires_in,
+            "healthy": self._bucket is not None
+            and expires_in is not None
+            and expires_in > 0,
+            "authorizations": self.authorizations,
+            "bucket_lookups": self.bucket_lookups,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+b2_client = B2Client(
+    refresh_interval=config.B2_AUTH_REFRESH_SECONDS,
+    retry_interval=config.B2_AUTH_RETRY_SECONDS,
+)
+
+
+def b2_api() -> b2.B2Api:
+    return b2_client.api()
+
+
+def b2_get_bucket() -> b2.Bucket:
+    return b2_client.bucket()
 
 
 def b2_upload_file(local_file: str, file_name: str) -> str:
     api = b2_api()
     logger.debug(f"Uploading {local_file} to B2 as {file_name}")
 
-    upload_file = b2_get_bucket(api).upload_local_file(
+    upload_file = b2_get_bucket().upload_local_file(
         local_file=local_file, file_name=file_name
     )
     download_url = api.get_download_url_for_fileid(upload_file.id_)
@@ -36,3 +167,42 @@ def b2_upload_file(local_file: str, file_name: str) -> str:
     )
 
     return download_url
+
+
+class HashingReader:
+    # hashes the bytes as the uploader reads them so the stream is read once
+    def __init__(self, source: BinaryIO) -> None:
+        self.source = source
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.source.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+
+def b2_upload_stream(
+    source: BinaryIO, file_name: str, part_size: int, buffers_count: int
+) -> tuple[str, str]:
+    # uploads as a large file, parts of part_size are sent in parallel by the
+    # b2sdk upload threads and at most buffers_count parts are held in memory.
+    # Returns the download url and the sha256 of the content
+    api = b2_api()
+    reader = HashingReader(source)
+    logger.debug(f"Streaming {file_name} to B2")
+
+    file_version = b2_get_bucket().upload_unbound_stream(
+        reader,
+        file_name,
+        recommended_upload_part_size=part_size,
+        buffers_count=buffers_count,
+    )
+    download_url = api.get_download_url_for_fileid(file_version.id_)
+
+    logger.debug(
+        f"Streamed {reader.size} bytes to B2 and got download url {download_url}"
+    )
+
+    return download_url, reader.hash.hexdigest()
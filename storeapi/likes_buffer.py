@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from databases import Database
+
+from storeapi import metrics
+from storeapi.cache import invalidate_post
+from storeapi.config import config
+from storeapi.database import (
+    database,
+    like_table,
+    post_table,
+    reconcile_post_likes_query,
+)
+from storeapi.etag import resource_versions
+
+logger = logging.getLogger(__name__)
+
+
+class LikeBuffer:
+    # accepts likes in memory and writes them in batches, flushed every
+    # flush_interval seconds or as soon as max_rows likes are pending
+    def __init__(
+        self, database: Database, flush_interval: float, max_rows: int
+    ) -> None:
+        self.database = database
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        # (post_id, user_id) -> None, a dict keeps the likes in arrival order
+        self._pending: dict[tuple[int, int], None] = {}
+        self._pending_counts: dict[int, int] = {}
+        self._known_post_ids: Optional[set[int]] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self.accepted = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self) -> None:
+        logger.info("Starting write-behind buffer for likes")
+        await self._load_post_ids()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        # let the flush loop finish on its own, cancelling it in the middle of a
+        # flush would lose the likes being written
+        logger.info(f"Draining {len(self._pending)} buffered likes")
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        self._known_post_ids = None
+
+        await self.flush()
+
+    async def _load_post_ids(self) -> None:
+        query = post_table.select().with_only_columns(post_table.c.id)
+        self._known_post_ids = {row.id async for row in self.database.iterate(query)}
+
+    def add_post(self, post_id: int) -> None:
+        if self._known_post_ids is not None:
+            self._known_post_ids.add(post_id)
+
+    async def post_exists(self, post_id: int) -> bool:
+        if self._known_post_ids is not None and post_id in self._known_post_ids:
+            return True
+
+        # the post may have been created by another process
+        query = post_table.select().where(post_table.c.id == post_id)
+        if await self.database.fetch_one(query) is None:
+            return False
+
+        self.add_post(post_id)
+        return True
+
+    async def is_stored(self, post_id: int, user_id: int) -> bool:
+        query = like_table.select().where(
+            like_table.c.post_id == post_id, like_table.c.user_id == user_id
+        )
+        return await self.database.fetch_one(query) is not None
+
+    def add(self, post_id: int, user_id: int) -> bool:
+        if (post_id, user_id) in self._pending:
+            return False
+
+        self._pending[(post_id, user_id)] = None
+        self._pending_counts[post_id] = self._pending_counts.get(post_id, 0) + 1
+        self.accepted += 1
+
+        if len(self._pending) >= self.max_rows and self._wakeup is not None:
+            self._wakeup.set()
+
+        return True
+
+    def __contains__(self, like: tuple[int, int]) -> bool:
+        return like in self._pending
+
+    def pending_likes(self, post_id: int) -> int:
+        return self._pending_counts.get(post_id, 0)
+
+    def merge(self, post: dict) -> dict:
+        # pending likes are added to the persisted count, a like that turns out
+        # to be a duplicate of a persisted one disappears on the next flush
+        pending = self.pending_likes(post["id"])
+        return {**post, "likes": post["likes"] + pending} if pending else post
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+
+        # the likes stay pending, and merged into the served counts, until the
+        # transaction writing them has committed, likes accepted meanwhile are
+        # left for the next flush
+        likes = list(self._pending)
+        post_ids = {post_id for post_id, _ in likes}
+        start = time.perf_counter()
+
+        try:
+            async with self.database.transaction():
+                await self.database.execute_many(
+                    like_table.insert().prefix_with("OR IGNORE"),
+                    [
+                        {"post_id": post_id, "user_id": user_id}
+                        for post_id, user_id in likes
+                    ],
+                )
+                # recount instead of incrementing as ignored duplicates must
+                # not be counted
+                await self.database.execute(
+                    reconcile_post_likes_query.where(post_table.c.id.in_(post_ids))
+                )
+        except Exception:
+            logger.exception(f"Flushing {len(likes)} likes failed, will retry")
+            return 0
+
+        for post_id, user_id in likes:
+            del self._pending[(post_id, user_id)]
+            self._pending_counts[post_id] -= 1
+            if not self._pending_counts[post_id]:
+                del self._pending_counts[post_id]
+
+        for post_id in post_ids:
+            invalidate_post(post_id, likes_changed=True)
+
+        self.flushed += len(likes)
+        self.flushes += 1
+        self.last_flush_seconds = time.perf_counter() - start
+        logger.debug(f"Flushed {len(likes)} likes in {self.last_flush_seconds}s")
+
+        return len(likes)
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending": len(self._pending),
+            "accepted": self.accepted,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+
+like_buffer = LikeBuffer(
+    database,
+    flush_interval=config.LIKES_FLUSH_INTERVAL_MS / 1000,
+    max_rows=config.LIKES_FLUSH_MAX_ROWS,
+)
+metrics.register("like_buffer", like_buffer.stats)
+
+
+async def accept_like(post_id: int, user_id: int) -> bool:
+    # a like already written is a duplicate too, not only a pending one
+    if (post_id, user_id) in like_buffer or await like_buffer.is_stored(
+        post_id, user_id
+    ):
+        return False
+
+    if not like_buffer.add(post_id, user_id):
+        return False
+
+    # the cached pages stay valid as pending likes are merged when serving,
+    # only the representation changes
+    resource_versions.bump_feed()
+    resource_versions.bump_post(post_id)
+    return True
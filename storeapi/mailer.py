@@ -0,0 +1,214 @@
+import asyncio
+import json
+import logging
+from typing import Optional
+
+import httpx
+
+from storeapi import metrics, tasks
+from storeapi.circuit_breaker import CircuitOpenError
+from storeapi.config import config
+from storeapi.tasks import APIResponseError
+
+logger = logging.getLogger(__name__)
+
+# Mailgun accepts at most 1000 recipients in one batch sending call
+MAILGUN_MAX_RECIPIENTS = 1000
+
+REGISTRATION_SUBJECT = "Successful signed up"
+REGISTRATION_TEMPLATE = (
+    "Hi %recipient.email%! you have successfully signed up."
+    "Please click on the link below to complete your registration."
+    "link: %recipient.confirmation_url%"
+)
+
+
+class EmailBatcher:
+    # collects the emails sent within window seconds and sends the ones sharing
+    # a subject and template in one Mailgun call, the per recipient parts of
+    # the text are filled in by Mailgun from the recipient-variables
+    def __init__(self, window: float, max_recipients: int) -> None:
+        self.window = window
+        self.max_recipients = min(max_recipients, MAILGUN_MAX_RECIPIENTS)
+        # (subject, template) -> [(to, variables, future)]
+        self._pending: dict[tuple[str, str], list] = {}
+        self._size = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self.accepted = 0
+        self.sent = 0
+        self.failed = 0
+        self.batches = 0
+        self.retried_individually = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self) -> None:
+        logger.info("Starting email batcher")
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        logger.info(f"Sending {self._size} batched emails")
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+        await self.flush()
+
+    async def send(
+        self, to: str, subject: str, template: str, variables: dict
+    ) -> httpx.Response:
+        # resolves once the batch holding this recipient was sent, or raises
+        # APIResponseError when this recipient could not be sent
+        future = asyncio.get_running_loop().create_future()
+        variables = {**variables, "email": to}
+        self._pending.setdefault((subject, template), []).append(
+            (to, variables, future)
+        )
+        self._size += 1
+        self.accepted += 1
+
+        if self._size >= self.max_recipients and self._wakeup is not None:
+            self._wakeup.set()
+
+        return await future
+
+    def _batches(self, recipients: list) -> list[list]:
+        # recipient-variables are keyed by address so an address can only
+        # appear once per call
+        batches, batch, addresses = [], [], set()
+        for recipient in recipients:
+            if len(batch) == self.max_recipients or recipient[0] in addresses:
+                batches.append(batch)
+                batch, addresses = [], set()
+            batch.append(recipient)
+            addresses.add(recipient[0])
+
+        return batches + [batch] if batch else batches
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+
+        pending, self._pending, self._size = self._pending, {}, 0
+        sent = 0
+        for (subject, template), recipients in pending.items():
+            for batch in self._batches(recipients):
+                try:
+                    sent += await self._send_batch(subject, template, batch)
+                except Exception as err:
+                    logger.exception("Sending batched emails failed")
+                    self._fail(batch, err)
+
+        return sent
+
+    async def _post(self, subject: str, template: str, batch: list) -> httpx.Response:
+        client = tasks.get_http_client()
+        async with tasks.mailgun_breaker.call():
+            response = await client.post(
+                f"{config.MAILGUN_API_URL}/{config.MAILGUN_DOMAIN}/messages",
+                auth=("api", config.MAILGUN_API_KEY),
+                data={
+                    "from": f"Store API <mailgun@{config.MAILGUN_DOMAIN}>",
+                    "to": [to for to, _, _ in batch],
+                    "subject": subject,
+                    "text": template,
+                    # also keeps every recipient from seeing the others
+                    "recipient-variables": json.dumps(
+                        {to: variables for to, variables, _ in batch}
+                    ),
+                },
+            )
+            response.raise_for_status()
+        return response
+
+    async def _send_batch(self, subject: str, template: str, batch: list) -> int:
+        try:
+            response = await self._post(subject, template, batch)
+        except httpx.HTTPStatusError as err:
+            if err.response.status_code == 400 and len(batch) > 1:
+                # a single invalid address rejects the whole call, send the
+                # recipients one by one so only that recipient fails
+                logger.warning(f"Batch of {len(batch)} emails rejected, splitting")
+                self.retried_individually += len(batch)
+                sent = 0
+                for recipient in batch:
+                    sent += await self._send_batch(subject, template, [recipient])
+                return sent
+
+            self._fail(
+                batch,
+                APIResponseError(
+                    f"API request failed with status code {err.response.status_code}"
+                ),
+            )
+            return 0
+        except (httpx.RequestError, CircuitOpenError, TimeoutError) as err:
+            self._fail(batch, APIResponseError(f"API request failed: {err!r}"))
+            return 0
+
+        self.batches += 1
+        self.sent += len(batch)
+        logger.debug(f"Sent {len(batch)} emails in one call")
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(response)
+
+        return len(batch)
+
+    def _fail(self, batch: list, error: Exception) -> None:
+        self.failed += len(batch)
+        for to, _, future in batch:
+            logger.error(f"Email to {to[:3]} failed: {error}")
+            if not future.done():
+                future.set_exception(error)
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending": self._size,
+            "accepted": self.accepted,
+            "sent": self.sent,
+            "failed": self.failed,
+            "batches": self.batches,
+            "retried_individually": self.retried_individually,
+        }
+
+
+email_batcher = EmailBatcher(
+    window=config.EMAIL_BATCH_WINDOW_MS / 1000,
+    max_recipients=config.EMAIL_BATCH_MAX_RECIPIENTS,
+)
+metrics.register("email_batcher", email_batcher.stats)
+
+
+async def send_user_registration_email(email: str, confirmation_url: str):
+    if not email_batcher.running:
+        return await tasks.send_user_registration_email(
+            email, confirmation_url=confirmation_url
+        )
+
+    return await email_batcher.send(
+        email,
+        REGISTRATION_SUBJECT,
+        REGISTRATION_TEMPLATE,
+        {"confirmation_url": str(confirmation_url)},
+    )
@@ -5,11 +5,25 @@ from fastapi import FastAPI, HTTPException
 from fastapi.exception_handlers import http_exception_handler
 from asgi_correlation_id import CorrelationIdMiddleware
 
+from storeapi.config import config
 from storeapi.loggin_conf import configure_logging
-from storeapi.database import database
+from storeapi.database import database, engine
+from storeapi.jobs import job_queue
+from storeapi.likes_buffer import like_buffer
+from storeapi.mailer import email_batcher
+from storeapi.migrations import run_migrations
+from storeapi.routers.export import router as export_router
+from storeapi.routers.health import router as health_router
+from storeapi.routers.metrics import router as metrics_router
 from storeapi.routers.post import router as post_router
 from storeapi.routers.user import router as user_router
 from storeapi.routers.upload import router as upload_router
+from storeapi.security import password_hasher
+from storeapi.storage import get_storage
+from storeapi.storage.local import LocalFiles
+from storeapi.tasks import close_http_client, get_http_client
+from storeapi.upload_pool import upload_pool
+from storeapi.upload_sessions import upload_sessions
 
 logger = logging.getLogger(__name__)
 
@@ -17,20 +31,51 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     configure_logging()
+    run_migrations(engine)
+    get_http_client()
+    storage = get_storage()
     await database.connect()
     logger.info("Database Connected")
+    if config.LIKES_WRITE_BEHIND:
+        await like_buffer.start()
+    if config.EMAIL_BATCHING:
+        await email_batcher.start()
+    if config.JOB_QUEUE_ENABLED and config.JOB_WORKERS_IN_PROCESS:
+        await job_queue.start()
+    await upload_sessions.start()
+    await storage.start()
     yield
+    await storage.stop()
+    await upload_sessions.stop()
+    await job_queue.stop()
+    await email_batcher.stop()
+    await like_buffer.stop()
     await database.disconnect()
+    password_hasher.shutdown()
+    upload_pool.shutdown()
+    await close_http_client()
 
 
 app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(CorrelationIdMiddleware)
 
+app.include_router(export_router)
+app.include_router(health_router)
+app.include_router(metrics_router)
 app.include_router(post_router)
 app.include_router(upload_router)
 app.include_router(user_router)
 
+# files of the local storage backend, unless they are served by a proxy, which
+# should then also send them with Content-Disposition: attachment
+if config.STORAGE_BACKEND == "local" and config.LOCAL_STORAGE_URL.startswith("/"):
+    app.mount(
+        config.LOCAL_STORAGE_URL,
+        LocalFiles(directory=config.LOCAL_STORAGE_PATH, check_dir=False),
+        name="files",
+    )
+
 
 @app.exception_handler(HTTPException)
 async def http_exception_handle_logging(request, exc):
@@ -0,0 +1,12 @@
+from typing import Callable
+
+# name -> callable returning the current values, collected by GET /metrics
+_sources: dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, source: Callable[[], dict]):
+    _sources[name] = source
+
+
+def snapshot() -> dict[str, dict]:
+    return {name: source() for name, source in _sources.items()}
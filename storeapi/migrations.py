@@ -0,0 +1,278 @@
+import argparse
+import logging
+
+import sqlalchemy
+
+from storeapi.database import (
+    comment_table,
+    engine,
+    job_table,
+    like_table,
+    post_likes_count,
+    post_table,
+    reconcile_post_likes_query,
+    schema_migrations_table,
+    upload_chunk_table,
+    upload_session_table,
+    upload_table,
+)
+
+logger = logging.getLogger(__name__)
+
+# (version, name, function) applied in version order, each in its own transaction
+MIGRATIONS = []
+
+
+def migration(version: int, name: str):
+    def decorator(func):
+        MIGRATIONS.append((version, name, func))
+        return func
+
+    return decorator
+
+
+# migrations 1 and 2 run before posts.version exists
+_reconcile_post_likes_counter = (
+    post_table.update()
+    .where(post_table.c.likes != post_likes_count)
+    .values(likes=post_likes_count)
+)
+
+
+def _create_index(
+    connection: sqlalchemy.Connection, table: sqlalchemy.Table, name: str
+):
+    index = next(index for index in table.indexes if index.name == name)
+    index.create(connection, checkfirst=True)
+
+
+@migration(1, "add posts.likes counter")
+def add_post_likes_counter(connection: sqlalchemy.Connection):
+    columns = {
+        column["name"] for column in sqlalchemy.inspect(connection).get_columns("posts")
+    }
+    if "likes" not in columns:
+        connection.execute(
+            sqlalchemy.text(
+                "ALTER TABLE posts ADD COLUMN likes INTEGER NOT NULL DEFAULT 0"
+            )
+        )
+        connection.execute(_reconcile_post_likes_counter)
+
+    _create_index(connection, post_table, "ix_posts_likes_id")
+
+
+@migration(2, "add indexes on comments and likes foreign keys")
+def add_foreign_key_indexes(connection: sqlalchemy.Connection):
+    # the unique index cannot be built while duplicate likes exist, keep the
+    # oldest like of every (post_id, user_id) pair
+    first_likes = sqlalchemy.select(sqlalchemy.func.min(like_table.c.id)).group_by(
+        like_table.c.post_id, like_table.c.user_id
+    )
+    connection.execute(like_table.delete().where(like_table.c.id.not_in(first_likes)))
+    connection.execute(_reconcile_post_likes_counter)
+
+    _create_index(connection, comment_table, "ix_comments_post_id")
+    _create_index(connection, like_table, "uq_likes_post_id_user_id")
+    _create_index(connection, like_table, "ix_likes_user_id")
+
+
+@migration(3, "add full-text index on posts.body")
+def add_posts_full_text_index(connection: sqlalchemy.Connection):
+    # FTS5 is specific to SQLite, posts_fts only stores the index and reads the
+    # bodies from posts, the triggers keep it in sync with every write path
+    if connection.dialect.name != "sqlite":
+        return
+
+    for statement in [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts"
+        " USING fts5(body, content='posts', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN"
+        " INSERT INTO posts_fts(rowid, body) VALUES (new.id, new.body);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN"
+        " INSERT INTO posts_fts(posts_fts, rowid, body)"
+        " VALUES ('delete', old.id, old.body);"
+        " END",
+        # only body changes touch the index, not the frequent likes updates
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF body ON posts"
+        " BEGIN"
+        " INSERT INTO posts_fts(posts_fts, rowid, body)"
+        " VALUES ('delete', old.id, old.body);"
+        " INSERT INTO posts_fts(rowid, body) VALUES (new.id, new.body);"
+        " END",
+        "INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')",
+    ]:
+        connection.exec_driver_sql(statement)
+
+
+@migration(4, "add jobs table")
+def add_jobs_table(connection: sqlalchemy.Connection):
+    job_table.create(connection, checkfirst=True)
+    _create_index(connection, job_table, "ix_jobs_status_run_at")
+
+
+@migration(5, "add uploads content index")
+def add_uploads_table(connection: sqlalchemy.Connection):
+    upload_table.create(connection, checkfirst=True)
+    _create_index(connection, upload_table, "uq_uploads_content_hash")
+
+
+@migration(6, "add resumable upload sessions")
+def add_upload_sessions_tables(connection: sqlalchemy.Connection):
+    upload_session_table.create(connection, checkfirst=True)
+    upload_chunk_table.create(connection, checkfirst=True)
+    _create_index(connection, upload_session_table, "ix_upload_sessions_updated_at")
+
+
+@migration(7, "add posts.version")
+def add_post_version(connection: sqlalchemy.Connection):
+    columns = {
+        column["name"] for column in sqlalchemy.inspect(connection).get_columns("posts")
+    }
+    if "version" not in columns:
+        connection.execute(
+            sqlalchemy.text(
+                "ALTER TABLE posts ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+            )
+        )
+
+
+@migration(8, "add upload_chunks.file")
+def add_upload_chunk_file(connection: sqlalchemy.Connection):
+    columns = {
+        column["name"]
+        for column in sqlalchemy.inspect(connection).get_columns("upload_chunks")
+    }
+    if "file" not in columns:
+        connection.execute(
+            sqlalchemy.text("ALTER TABLE upload_chunks ADD COLUMN file VARCHAR")
+        )
+
+
+def applied_migrations(engine: sqlalchemy.Engine) -> set[int]:
+    schema_migrations_table.create(engine, checkfirst=True)
+
+    with engine.connect() as connection:
+        query = sqlalchemy.select(schema_migrations_table.c.version)
+        return set(connection.execute(query).scalars())
+
+
+def run_migrations(engine: sqlalchemy.Engine) -> list[int]:
+    applied = applied_migrations(engine)
+    newly_applied = []
+
+    for version, name, func in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in applied:
+            continue
+
+        logger.info(f"Applying migration {version}: {name}")
+
+        with engine.begin() as connection:
+            func(connection)
+            connection.execute(
+                schema_migrations_table.insert().values(version=version, name=name)
+            )
+
+        newly_applied.append(version)
+
+    return newly_applied
+
+
+def reconcile_post_likes(engine: sqlalchemy.Engine) -> int:
+    # recomputes the denormalized posts.likes counter from the likes table,
+    # after a crash or a bulk import that bypassed like_post. Returns the
+    # number of posts whose counter was wrong
+    with engine.begin() as connection:
+        return connection.execute(reconcile_post_likes_query).rowcount
+
+
+def hot_queries() -> dict[str, sqlalchemy.Executable]:
+    # shaped like the queries issued by routers.post, a page of the feed is a
+    # keyset seek past the cursor
+    return {
+        "feed page new": sqlalchemy.select(post_table)
+        .where(post_table.c.id < 100)
+        .order_by(post_table.c.id.desc())
+        .limit(20),
+        "feed page most_likes": sqlalchemy.select(post_table)
+        .where(
+            sqlalchemy.or_(
+                post_table.c.likes < 10,
+                sqlalchemy.and_(post_table.c.likes == 10, post_table.c.id < 100),
+            )
+        )
+        .order_by(post_table.c.likes.desc(), post_table.c.id.desc())
+        .limit(20),
+        "comments on post": comment_table.select().where(comment_table.c.post_id == 1),
+        "likes on post": sqlalchemy.select(
+            sqlalchemy.func.count(like_table.c.id)
+        ).where(like_table.c.post_id == 1),
+        "likes by user": like_table.select().where(like_table.c.user_id == 1),
+    }
+
+
+def explain_hot_queries(engine: sqlalchemy.Engine) -> dict[str, list[str]]:
+    # EXPLAIN QUERY PLAN is specific to SQLite
+    if engine.dialect.name != "sqlite":
+        return {}
+
+    plans = {}
+    with engine.connect() as connection:
+        for name, query in hot_queries().items():
+            sql = query.compile(engine, compile_kwargs={"literal_binds": True})
+            rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")
+            plans[name] = [row[-1] for row in rows]
+
+    return plans
+
+
+def full_scans(plans: dict[str, list[str]]) -> list[str]:
+    # a plain "SCAN <table>" means the query reads every row and a temp b-tree
+    # means it sorts them without an index
+    return [
+        name
+        for name, details in plans.items()
+        if any(
+            (detail.startswith("SCAN") and "INDEX" not in detail)
+            or "USE TEMP B-TREE" in detail
+            for detail in details
+        )
+    ]
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Manage the storeapi schema")
+    parser.add_argument(
+        "command",
+        choices=["upgrade", "status", "explain", "reconcile"],
+        nargs="?",
+        default="upgrade",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "upgrade":
+        applied = run_migrations(engine)
+        print(f"Applied migrations: {applied or 'none'}")
+    elif args.command == "status":
+        applied = applied_migrations(engine)
+        for version, name, _ in sorted(MIGRATIONS, key=lambda item: item[0]):
+            state = "applied" if version in applied else "pending"
+            print(f"{version:04d} {state:8s} {name}")
+    elif args.command == "reconcile":
+        fixed = reconcile_post_likes(engine)
+        print(f"Reconciled the like counters of {fixed} posts")
+
+    if args.command in ("upgrade", "explain"):
+        plans = explain_hot_queries(engine)
+        for name, details in plans.items():
+            print(f"{name}:")
+            for detail in details:
+                print(f"    {detail}")
+
+        for name in full_scans(plans):
+            print(f"WARNING: '{name}' does a full table scan")
+
+
+if __name__ == "__main__":
+    main()
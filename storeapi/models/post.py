@@ -42,5 +42,6 @@ class PostLikeIn(BaseModel):
 
 
 class PostLike(PostLikeIn):
-    id: int
+    # None when the like was accepted by the write-behind buffer
+    id: Optional[int] = None
     user_id: int
@@ -0,0 +1,10 @@
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+
+class UploadSessionIn(BaseModel):
+    file_name: str
+    # total size when known, the server then reports the missing chunks
+    size: Optional[int] = Field(default=None, ge=0)
+    chunk_size: Optional[int] = Field(default=None, gt=0)
@@ -0,0 +1,76 @@
+import json
+import logging
+from enum import Enum
+from typing import Annotated, AsyncGenerator, Optional
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+
+from storeapi.database import comment_table, database, like_table, post_table
+from storeapi.models.user import User
+from storeapi.security import get_current_user
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+EXPORT_BATCH_SIZE = 1000
+
+
+class ExportTable(str, Enum):
+    posts = "posts"
+    comments = "comments"
+    likes = "likes"
+
+
+export_tables = {
+    ExportTable.posts: ("post", post_table),
+    ExportTable.comments: ("comment", comment_table),
+    ExportTable.likes: ("like", like_table),
+}
+
+
+async def export_rows(
+    tables: list[ExportTable], min_id: Optional[int], max_id: Optional[int]
+) -> AsyncGenerator[bytes, None]:
+    # each table is read in pages of EXPORT_BATCH_SIZE rows after the last id
+    # sent, no statement stays open while a slow client drains the response.
+    # An open read would hold the database lock and make every write wait
+    for table_name in tables:
+        row_type, table = export_tables[table_name]
+        last_id = min_id - 1 if min_id is not None else None
+
+        while True:
+            query = table.select().order_by(table.c.id).limit(EXPORT_BATCH_SIZE)
+            if last_id is not None:
+                query = query.where(table.c.id > last_id)
+            if max_id is not None:
+                query = query.where(table.c.id <= max_id)
+
+            logger.debug(query)
+
+            rows = await database.fetch_all(query)
+            if not rows:
+                break
+
+            # one chunk per page instead of one send per row
+            yield "".join(
+                json.dumps({"type": row_type, **row._mapping}) + "\n" for row in rows
+            ).encode()
+
+            if len(rows) < EXPORT_BATCH_SIZE:
+                break
+            last_id = rows[-1].id
+
+
+@router.get("/export")
+async def export(
+    current_user: Annotated[User, Depends(get_current_user)],
+    tables: Annotated[list[ExportTable], Query()] = list(ExportTable),
+    min_id: Annotated[Optional[int], Query(ge=1)] = None,
+    max_id: Annotated[Optional[int], Query(ge=1)] = None,
+):  # https://api.com/export?tables=posts&tables=likes&min_id=1000
+    logger.info(f"Exporting {', '.join(table.value for table in tables)}")
+
+    return StreamingResponse(
+        export_rows(tables, min_id, max_id), media_type="application/x-ndjson"
+    )
@@ -0,0 +1,32 @@
+import logging
+
+from fastapi import APIRouter, Response, status
+
+from storeapi.database import database
+from storeapi.storage import get_storage
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+
+@router.get("/health")
+async def get_health(response: Response):
+    # 503 until the database answers and the storage backend is ready to
+    # upload without setting anything up first
+    try:
+        await database.fetch_val("SELECT 1")
+        database_ok = True
+    except Exception:
+        logger.exception("Health check could not reach the database")
+        database_ok = False
+
+    storage = get_storage().stats()
+    healthy = database_ok and storage["healthy"]
+    if not healthy:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return {
+        "status": "ok" if healthy else "unavailable",
+        "database": database_ok,
+        "storage": storage,
+    }
@@ -0,0 +1,15 @@
+import logging
+
+from fastapi import APIRouter
+
+from storeapi import metrics
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def get_metrics():
+    logger.info("Getting Metrics")
+
+    return metrics.snapshot()
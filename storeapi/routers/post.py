@@ -1,8 +1,21 @@
+import base64
+import binascii
+import json
 import logging
-from typing import Annotated
+import sqlite3
+from typing import Annotated, Optional
 from enum import Enum
 
-from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Request
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    Depends,
+    BackgroundTasks,
+    Body,
+    Query,
+    Request,
+    Response,
+)
 import sqlalchemy
 
 from storeapi.models.post import (
@@ -15,9 +28,26 @@ from storeapi.models.post import (
     PostLikeIn,
     UserPostWithLikes,
 )
-from storeapi.database import comment_table, post_table, database, like_table
+from storeapi.cache import (
+    invalidate_comments,
+    invalidate_new_post,
+    invalidate_post,
+    post_cache,
+)
+from storeapi.config import config
+from storeapi.etag import make_etag, not_modified, resource_versions
+from storeapi.database import (
+    comment_table,
+    post_table,
+    database,
+    like_table,
+    posts_fts_table,
+    reconcile_post_likes_query,
+)
+from storeapi.jobs import job_queue
+from storeapi.likes_buffer import accept_like, like_buffer
 from storeapi.models.user import User
-from storeapi.security import get_current_user
+from storeapi.security import get_current_user_claims
 from storeapi.tasks import generate_and_add_to_post
 
 router = APIRouter()
@@ -28,12 +58,32 @@ router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
-# in this we are selecting the post table and creating a column likes
-# the we are using select_from and joining the two tables ans then we are grouping based on post_table ids
-select_post_and_like = (
-    sqlalchemy.select(post_table, sqlalchemy.func.count(like_table.c.id).label("likes"))
-    .select_from(post_table.outerjoin(like_table))
-    .group_by(post_table.c.id)
+# likes is a denormalized counter on the posts table so the feed does not need
+# to join and group the likes table
+select_post_and_like = sqlalchemy.select(post_table)
+
+# the comments of a post aggregated into a JSON array by SQLite, so the detail
+# page is fetched in a single round trip
+comments_as_json = (
+    sqlalchemy.select(
+        sqlalchemy.func.json_group_array(
+            sqlalchemy.func.json_object(
+                "id",
+                comment_table.c.id,
+                "body",
+                comment_table.c.body,
+                "post_id",
+                comment_table.c.post_id,
+                "user_id",
+                comment_table.c.user_id,
+            )
+        )
+    )
+    .where(comment_table.c.post_id == post_table.c.id)
+    .scalar_subquery()
+)
+select_post_with_comments = sqlalchemy.select(
+    post_table, comments_as_json.label("comments")
 )
 
 
@@ -47,10 +97,30 @@ async def find_post(post_id: int):
     return await database.fetch_one(query)
 
 
+async def find_missing_posts(post_ids: set[int]) -> set[int]:
+    logger.info(f"Find {len(post_ids)} posts")
+
+    query = sqlalchemy.select(post_table.c.id).where(post_table.c.id.in_(post_ids))
+
+    logger.debug(query)
+
+    return post_ids - {row.id for row in await database.fetch_all(query)}
+
+
+async def insert_many(table: sqlalchemy.Table, values: list[dict]) -> list[int]:
+    # a single multi-row INSERT, rowids are assigned in insertion order but
+    # RETURNING does not guarantee its order so the ids are sorted
+    query = table.insert().values(values).returning(table.c.id)
+
+    logger.debug(query)
+
+    return sorted(row.id for row in await database.fetch_all(query))
+
+
 @router.post("/post", response_model=UserPost, status_code=201)
 async def create_post(
     post: UserPostIn,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[User, Depends(get_current_user_claims)],
     background_task: BackgroundTasks,
     request: Request,
     prompt: str = None,
@@ -65,16 +135,28 @@ async def create_post(
     logger.debug(query)
 
     last_record_id = await database.execute(query)
+    invalidate_new_post()
+    like_buffer.add_post(last_record_id)
 
     if prompt:
-        background_task.add_task(
-            generate_and_add_to_post,
-            current_user.email,
-            last_record_id,
-            request.url_for("get_post_with_comments", post_id=last_record_id),
-            database,
-            prompt,
-        )
+        post_url = request.url_for("get_post_with_comments", post_id=last_record_id)
+        if config.JOB_QUEUE_ENABLED:
+            await job_queue.enqueue(
+                "generate_and_add_to_post",
+                email=current_user.email,
+                post_id=last_record_id,
+                post_url=str(post_url),
+                prompt=prompt,
+            )
+        else:
+            background_task.add_task(
+                generate_and_add_to_post,
+                current_user.email,
+                last_record_id,
+                post_url,
+                database,
+                prompt,
+            )
 
     return {**data, "id": last_record_id}
 
@@ -85,12 +167,39 @@ class PostSorting(str, Enum):
     most_likes = "most_likes"
 
 
-@router.get("/post", response_model=list[UserPostWithLikes])
-async def get_post(
-    sorting: PostSorting = PostSorting.new,
-):  # https://api.com/post?sorting=new
-    logger.info("Getting All Posts")
+def encode_cursor(sorting: PostSorting, post) -> str:
+    # the cursor carries the sort key of the last row so the next page can seek
+    # past it instead of using OFFSET
+    key = [post["likes"], post["id"]]
+    if sorting != PostSorting.most_likes:
+        key = [post["id"]]
+    raw = json.dumps({"s": sorting.value, "k": key}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(sorting: PostSorting, cursor: str) -> list[int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        key = data["k"]
+        # ids and like counts only, within the range SQLite can bind
+        if not isinstance(key, list) or not all(
+            type(value) is int and -(2**63) <= value < 2**63 for value in key
+        ):
+            raise ValueError(key)
+    except (binascii.Error, ValueError, TypeError, KeyError, OverflowError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    expected_length = 2 if sorting == PostSorting.most_likes else 1
+    if data.get("s") != sorting.value or len(key) != expected_length:
+        raise HTTPException(status_code=400, detail="Cursor does not match sorting")
+
+    return key
 
+
+async def fetch_post_page(
+    sorting: PostSorting, limit: Optional[int], after: Optional[str]
+) -> tuple[list[dict], Optional[str]]:
     # # can be done using match
     # match sorting:
     #     case PostSorting.new:
@@ -101,16 +210,122 @@ async def get_post(
     elif sorting == PostSorting.old:
         query = select_post_and_like.order_by(post_table.c.id.asc())
     elif sorting == PostSorting.most_likes:
-        query = select_post_and_like.order_by(sqlalchemy.desc("likes"))
+        query = select_post_and_like.order_by(
+            post_table.c.likes.desc(), post_table.c.id.desc()
+        )
+
+    if after is not None:
+        key = decode_cursor(sorting, after)
+        if sorting == PostSorting.new:
+            query = query.where(post_table.c.id < key[0])
+        elif sorting == PostSorting.old:
+            query = query.where(post_table.c.id > key[0])
+        elif sorting == PostSorting.most_likes:
+            query = query.where(
+                sqlalchemy.or_(
+                    post_table.c.likes < key[0],
+                    sqlalchemy.and_(
+                        post_table.c.likes == key[0], post_table.c.id < key[1]
+                    ),
+                )
+            )
+
+    if limit is not None:
+        # fetch one extra row to know whether there is a next page
+        query = query.limit(limit + 1)
+
+    logger.debug(query)
+
+    posts = [{**post._mapping} for post in await database.fetch_all(query)]
+
+    next_cursor = None
+    if limit is not None and len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = encode_cursor(sorting, posts[-1])
+
+    return posts, next_cursor
+
+
+@router.get("/post", response_model=list[UserPostWithLikes])
+async def get_post(
+    request: Request,
+    response: Response,
+    sorting: PostSorting = PostSorting.new,
+    limit: Annotated[Optional[int], Query(ge=1, le=100)] = None,
+    after: Optional[str] = None,
+):  # https://api.com/post?sorting=new&limit=20&after=<cursor>
+    logger.info("Getting All Posts")
+
+    version = resource_versions.feed
+    key = ("feed", sorting.value, limit, after)
+    page = post_cache.get(key)
+    if page is None:
+        page = await fetch_post_page(sorting, limit, after)
+        # a write during the query may have invalidated the page already read
+        if resource_versions.feed == version:
+            post_cache.set(key, page)
+
+    posts, next_cursor = page
+    # the persisted post versions also change for updates made by another
+    # process, whose invalidations only reach its own resource versions
+    etag = make_etag(
+        version, sorting.value, limit, after, [post["version"] for post in posts]
+    )
+    if unchanged := not_modified(request, etag):
+        return unchanged
+    response.headers["ETag"] = etag
+
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    if like_buffer.running:
+        return [like_buffer.merge(post) for post in posts]
+
+    return posts
+
+
+def full_text_query(q: str) -> str:
+    # every word becomes a quoted FTS5 string so user input cannot use the
+    # query syntax, the words are ANDed together
+    return " ".join('"' + word.replace('"', '""') + '"' for word in q.split())
+
+
+@router.get("/post/search", response_model=list[UserPostWithLikes])
+async def search_posts(
+    q: Annotated[str, Query(min_length=1, max_length=200)],
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    offset: Annotated[int, Query(ge=0)] = 0,
+):  # https://api.com/post/search?q=cat&limit=20&offset=0
+    logger.info("Searching Posts")
+
+    match_query = full_text_query(q)
+    if not match_query:
+        return []
+
+    fts = sqlalchemy.literal_column("posts_fts")
+    query = (
+        select_post_and_like.join(
+            posts_fts_table, posts_fts_table.c.rowid == post_table.c.id
+        )
+        .where(fts.op("MATCH")(match_query))
+        .order_by(sqlalchemy.func.bm25(fts), post_table.c.id.desc())
+        .limit(limit)
+        .offset(offset)
+    )
 
     logger.debug(query)
 
-    return await database.fetch_all(query)
+    posts = [{**post._mapping} for post in await database.fetch_all(query)]
+
+    if like_buffer.running:
+        return [like_buffer.merge(post) for post in posts]
+
+    return posts
 
 
 @router.post("/comment", response_model=Comment, status_code=201)
 async def create_comment(
-    comment: CommentIn, current_user: Annotated[User, Depends(get_current_user)]
+    comment: CommentIn, current_user: Annotated[User, Depends(get_current_user_claims)]
 ):
     logger.info("Creating Comment")
 
@@ -126,26 +341,38 @@ async def create_comment(
     logger.debug(query)
 
     last_recorded_id = await database.execute(query)
+    invalidate_comments(comment.post_id)
 
     return {**data, "id": last_recorded_id}
 
 
 @router.get("/post/{post_id}/comment", response_model=list[Comment])
-async def get_comments_on_post(post_id: int):
+async def get_comments_on_post(post_id: int, request: Request, response: Response):
     logger.info("Getting Comments on Post")
 
+    etag = make_etag(resource_versions.post(post_id), "comments", post_id)
+    if unchanged := not_modified(request, etag):
+        return unchanged
+    response.headers["ETag"] = etag
+
+    comments = post_cache.get(("comments", post_id))
+    if comments is not None:
+        return comments
+
+    version = resource_versions.post(post_id)
     query = comment_table.select().where(comment_table.c.post_id == post_id)
     logger.debug(query)
 
-    return await database.fetch_all(query)
+    comments = [{**comment._mapping} for comment in await database.fetch_all(query)]
+    if resource_versions.post(post_id) == version:
+        post_cache.set(("comments", post_id), comments)
 
+    return comments
 
-@router.get("/post/{post_id}", response_model=UserPostWithComments)
-async def get_post_with_comments(post_id: int):
-    logger.info("Getting Post and its Comments")
 
+async def fetch_post_with_comments(post_id: int) -> dict:
     # post = await find_post(post_id)
-    query = select_post_and_like.where(post_table.c.id == post_id)
+    query = select_post_with_comments.where(post_table.c.id == post_id)
     logger.debug(query)
 
     post = await database.fetch_one(query)
@@ -154,25 +381,158 @@ async def get_post_with_comments(post_id: int):
         # logger.error(f"Post with post id {post_id} not found")
         raise HTTPException(status_code=404, detail="Post not found")
 
-    return {"post": post, "comments": await get_comments_on_post(post_id)}
+    return {
+        "post": {column.name: post[column.name] for column in post_table.columns},
+        "comments": json.loads(post.comments),
+    }
+
+
+@router.get("/post/{post_id}", response_model=UserPostWithComments)
+async def get_post_with_comments(post_id: int, request: Request, response: Response):
+    logger.info("Getting Post and its Comments")
+
+    version = resource_versions.post(post_id)
+    post_with_comments = post_cache.get(("post", post_id))
+    if post_with_comments is None:
+        post_with_comments = await fetch_post_with_comments(post_id)
+        if resource_versions.post(post_id) == version:
+            post_cache.set(("post", post_id), post_with_comments)
+
+    etag = make_etag(version, "post", post_id, post_with_comments["post"]["version"])
+    if unchanged := not_modified(request, etag):
+        return unchanged
+    response.headers["ETag"] = etag
+
+    if like_buffer.running:
+        post = like_buffer.merge(post_with_comments["post"])
+        return {**post_with_comments, "post": post}
+
+    return post_with_comments
 
 
 @router.post("/like", response_model=PostLike, status_code=201)
 async def like_post(
-    like: PostLikeIn, currentUser: Annotated[User, Depends(get_current_user)]
+    like: PostLikeIn,
+    currentUser: Annotated[User, Depends(get_current_user_claims)],
+    response: Response,
 ):
     logger.info("Liking Post")
 
+    data = {**like.model_dump(), "user_id": currentUser.id}
+
+    if like_buffer.running:
+        if not await like_buffer.post_exists(like.post_id):
+            raise HTTPException(status_code=404, detail="Post not found")
+
+        if not await accept_like(like.post_id, currentUser.id):
+            raise HTTPException(status_code=409, detail="Post already liked")
+
+        # written by the next flush of the buffer
+        response.status_code = 202
+        return data
+
     post = await find_post(like.post_id)
 
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
 
-    data = {**like.model_dump(), "user_id": currentUser.id}
-
     query = like_table.insert().values(data)
     logger.debug(query)
 
-    last_record_id = await database.execute(query)
+    # the counter update happens in the same transaction as the insert so the
+    # two can never drift apart
+    try:
+        async with database.transaction():
+            last_record_id = await database.execute(query)
+            await database.execute(
+                post_table.update()
+                .where(post_table.c.id == like.post_id)
+                .values(likes=post_table.c.likes + 1)
+            )
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=409, detail="Post already liked")
+
+    invalidate_post(like.post_id, likes_changed=True)
 
     return {**data, "id": last_record_id}
+
+
+BulkItems = Body(min_length=1, max_length=config.BULK_MAX_ITEMS)
+
+
+@router.post("/post/bulk", response_model=list[UserPost], status_code=201)
+async def create_posts(
+    posts: Annotated[list[UserPostIn], BulkItems],
+    current_user: Annotated[User, Depends(get_current_user_claims)],
+):
+    logger.info(f"Creating {len(posts)} Posts")
+
+    values = [{**post.model_dump(), "user_id": current_user.id} for post in posts]
+
+    async with database.transaction():
+        ids = await insert_many(post_table, values)
+
+    invalidate_new_post()
+    for post_id in ids:
+        like_buffer.add_post(post_id)
+
+    return [{**data, "id": post_id} for data, post_id in zip(values, ids)]
+
+
+@router.post("/comment/bulk", response_model=list[Comment], status_code=201)
+async def create_comments(
+    comments: Annotated[list[CommentIn], BulkItems],
+    current_user: Annotated[User, Depends(get_current_user_claims)],
+):
+    logger.info(f"Creating {len(comments)} Comments")
+
+    post_ids = {comment.post_id for comment in comments}
+    if missing := await find_missing_posts(post_ids):
+        raise HTTPException(
+            status_code=404, detail=f"Posts not found: {sorted(missing)}"
+        )
+
+    values = [
+        {**comment.model_dump(), "user_id": current_user.id} for comment in comments
+    ]
+
+    async with database.transaction():
+        ids = await insert_many(comment_table, values)
+
+    for post_id in post_ids:
+        invalidate_comments(post_id)
+
+    return [{**data, "id": comment_id} for data, comment_id in zip(values, ids)]
+
+
+@router.post("/like/bulk", response_model=list[PostLike], status_code=201)
+async def like_posts(
+    likes: Annotated[list[PostLikeIn], BulkItems],
+    current_user: Annotated[User, Depends(get_current_user_claims)],
+):
+    logger.info(f"Liking {len(likes)} Posts")
+
+    post_ids = {like.post_id for like in likes}
+    if len(post_ids) != len(likes):
+        raise HTTPException(status_code=409, detail="Post liked more than once")
+
+    if missing := await find_missing_posts(post_ids):
+        raise HTTPException(
+            status_code=404, detail=f"Posts not found: {sorted(missing)}"
+        )
+
+    values = [{**like.model_dump(), "user_id": current_user.id} for like in likes]
+
+    try:
+        async with database.transaction():
+            ids = await insert_many(like_table, values)
+            await database.execute(
+                reconcile_post_likes_query.where(post_table.c.id.in_(post_ids))
+            )
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=409, detail="Post already liked")
+
+    for post_id in post_ids:
+        invalidate_post(post_id, likes_changed=True)
+
+    return [{**data, "id": like_id} for data, like_id in zip(values, ids)]
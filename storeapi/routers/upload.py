@@ -1,35 +1,272 @@
+import asyncio
+import hashlib
 import logging
 import tempfile
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Optional
 
 import aiofiles
-from fastapi import APIRouter, HTTPException, UploadFile, status
-from storeapi.libs.b2 import b2_upload_file
+from fastapi import APIRouter, HTTPException, Request, Response, UploadFile, status
+from fastapi.routing import APIRoute
+from storeapi.config import config
+from storeapi.models.upload import UploadSessionIn
+from storeapi.storage import get_storage
+from storeapi.upload_index import upload_index
+from storeapi.upload_pool import upload_pool
+from storeapi.upload_sessions import upload_sessions
 
 logger = logging.getLogger(__name__)
 
+
+class UploadPoolRoute(APIRoute):
+    # FastAPI receives a form body before the endpoint and its dependencies
+    # run, the pool is checked first so a saturated server turns the upload
+    # away before taking in the whole body
+    def get_route_handler(self) -> Callable[[Request], Awaitable[Response]]:
+        route_handler = super().get_route_handler()
+
+        async def check_capacity_first(request: Request) -> Response:
+            upload_pool.check_capacity()
+            return await route_handler(request)
+
+        return check_capacity_first
+
+
 router = APIRouter()
+# the uploads that go through the upload pool
+pooled_router = APIRouter(route_class=UploadPoolRoute)
 
 CHUNK_SIZE = 1024 * 1024
 
 
-@router.post("/upload", status_code=201)
-async def upload_file(file: UploadFile):
+class StreamReader:
+    # a blocking read() over an async iterator of chunks, called from the
+    # upload thread while the chunks are received on the event loop. Only
+    # the bytes asked for are pulled from the request so memory stays bounded
+    def __init__(
+        self, chunks: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop
+    ) -> None:
+        self._chunks = chunks
+        self._loop = loop
+        self._buffer = bytearray()
+        self._eof = False
+        # the bytes read so far, the body size once the storage read it all
+        self.size = 0
+
+    async def _next_chunk(self) -> bytes:
+        return await self._chunks.__anext__()
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            future = asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop)
+            try:
+                self._buffer += future.result()
+            except StopAsyncIteration:
+                self._eof = True
+
+        size = len(self._buffer) if size < 0 else size
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.size += len(data)
+        return data
+
+
+def stored(file_url: str, content_hash: str, deduplicated: bool) -> dict:
+    return {
+        "file_url": file_url,
+        "sha256": content_hash,
+        "deduplicated": deduplicated,
+    }
+
+
+def hash_file(source: BinaryIO) -> str:
+    content_hash = hashlib.sha256()
+    while chunk := source.read(CHUNK_SIZE):
+        content_hash.update(chunk)
+    source.seek(0)
+    return content_hash.hexdigest()
+
+
+async def upload_through_temp_file(
+    read_chunk: Callable[[], Awaitable[bytes]], file_name: str
+) -> dict:
+    # spooled where the storage can take the file over without copying it
+    with tempfile.NamedTemporaryFile(dir=get_storage().temp_dir) as temp_file:
+        filename = temp_file.name
+        logger.info(f"Saving uploading file temporarily to {filename}")
+        size = 0
+        content_hash = hashlib.sha256()
+        async with aiofiles.open(filename, "wb") as f:
+            while chunk := await read_chunk():
+                await f.write(chunk)
+                content_hash.update(chunk)
+                size += len(chunk)
+
+        content_hash = content_hash.hexdigest()
+        if file_url := await upload_index.lookup(content_hash, size):
+            return stored(file_url, content_hash, deduplicated=True)
+
+        # the storage clients block, the upload runs in the upload pool
+        file_url = await upload_pool.run(
+            get_storage().upload_file,
+            local_file=filename,
+            file_name=file_name,
+            content_hash=content_hash,
+            size=size,
+        )
+
+    await upload_index.record(content_hash, file_url, size, file_name)
+    return stored(file_url, content_hash, deduplicated=False)
+
+
+async def upload_streaming(source, file_name: str, size: Optional[int]) -> dict:
+    # size is None for a StreamReader over a body without Content-Length, it
+    # is counted as the storage reads it
+    file_url, content_hash = await upload_pool.run(
+        get_storage().upload_stream,
+        source,
+        file_name,
+        size=lambda: source.size if size is None else size,
+    )
+    if size is None:
+        size = source.size
+    await upload_index.record(content_hash, file_url, size, file_name)
+    return stored(file_url, content_hash, deduplicated=False)
+
+
+async def verify_duplicate(
+    chunks: AsyncIterator[bytes], content_hash: str, file_url: str
+) -> dict:
+    # the body is still read so only a client holding the content gets the url
+    actual_hash = hashlib.sha256()
+    size = 0
+    async for chunk in chunks:
+        actual_hash.update(chunk)
+        size += len(chunk)
+
+    if actual_hash.hexdigest() != content_hash:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The content does not match X-Content-SHA256",
+        )
+
+    upload_index.saved(size)
+    return stored(file_url, content_hash, deduplicated=True)
+
+
+def content_length(request: Request) -> int:
+    # 0 when the body is chunked and its size is not known upfront
     try:
-        with tempfile.NamedTemporaryFile() as temp_file:
-            filename = temp_file.name
-            logger.info(f"Saving uploading file temporarily to {filename}")
-            async with aiofiles.open(filename, "wb") as f:
-                while chunk := await file.read(CHUNK_SIZE):
-                    await f.write(chunk)
-
-                file_url = b2_upload_file(local_file=filename, file_name=file.filename)
-    except Exception:
+        size = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        size = -1
+    if size < 0:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="There was an error uploading the file",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid Content-Length header",
         )
+    return size
+
+
+def upload_error() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail="There was an error uploading the file",
+    )
+
+
+@pooled_router.post("/upload", status_code=201)
+async def upload_file(file: UploadFile):
+    # files smaller than a part go through a temp file, larger ones are
+    # streamed from the spooled upload as a large file without a second copy
+    try:
+        if file.size is not None and file.size >= config.UPLOAD_PART_SIZE:
+            # the spooled file can be read twice, hashing it first avoids
+            # sending content that is already stored
+            content_hash = await asyncio.to_thread(hash_file, file.file)
+            if file_url := await upload_index.lookup(content_hash, file.size):
+                result = stored(file_url, content_hash, deduplicated=True)
+            else:
+                result = await upload_streaming(file.file, file.filename, file.size)
+        else:
+            result = await upload_through_temp_file(
+                lambda: file.read(CHUNK_SIZE), file.filename
+            )
+    except HTTPException:
+        raise
+    except Exception:
+        raise upload_error()
+
+    return {"detail": f"Successfully uploaded file {file.filename}", **result}
+
+
+@pooled_router.put("/upload/{file_name}", status_code=201)
+async def upload_file_stream(file_name: str, request: Request):
+    # the raw request body is piped into the upload as it is received, the
+    # temp file is only used when the body is known to be smaller than a part.
+    # A client sending X-Content-SHA256 for content already stored skips the
+    # transfer to storage
+    size = content_length(request)
+    content_hash = request.headers.get("x-content-sha256", "").lower()
+    chunks = request.stream()
+    try:
+        if content_hash and (file_url := await upload_index.lookup(content_hash, None)):
+            result = await verify_duplicate(chunks, content_hash, file_url)
+        elif size and size < config.UPLOAD_PART_SIZE:
+
+            async def read_chunk() -> bytes:
+                return await anext(chunks, b"")
+
+            result = await upload_through_temp_file(read_chunk, file_name)
+        else:
+            reader = StreamReader(chunks, asyncio.get_running_loop())
+            result = await upload_streaming(reader, file_name, size or None)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception(f"Streaming upload of {file_name} failed")
+        raise upload_error()
+
+    return {"detail": f"Successfully uploaded file {file_name}", **result}
+
+
+# resumable uploads, see UploadSessions
+@router.post("/upload/sessions", status_code=201)
+async def create_upload_session(session: UploadSessionIn):
+    return await upload_sessions.create(
+        session.file_name, session.size, session.chunk_size
+    )
+
+
+@router.get("/upload/sessions/{session_id}")
+async def get_upload_session(session_id: str):
+    return await upload_sessions.get(session_id)
+
+
+@router.put("/upload/sessions/{session_id}/chunks/{chunk}")
+async def put_upload_chunk(session_id: str, chunk: int, request: Request):
+    size = await upload_sessions.put_chunk(session_id, chunk, request.stream())
+    return {"chunk": chunk, "size": size}
+
+
+@router.post("/upload/sessions/{session_id}/complete", status_code=201)
+async def complete_upload_session(session_id: str):
+    try:
+        session = await upload_sessions.complete(session_id)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception(f"Completing upload session {session_id} failed")
+        raise upload_error()
 
     return {
-        "detail": f"Successfully uploaded file {file.filename}",
-        "file_url": file_url,
+        "detail": f"Successfully uploaded file {session['file_name']}",
+        **session,
     }
+
+
+@router.delete("/upload/sessions/{session_id}", status_code=204)
+async def delete_upload_session(session_id: str):
+    await upload_sessions.delete(session_id)
+
+
+router.include_router(pooled_router)
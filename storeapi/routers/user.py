@@ -5,14 +5,17 @@ from fastapi import APIRouter, HTTPException, status, Request, BackgroundTasks
 from storeapi.models.user import UserIn
 from storeapi.security import (
     get_user,
-    get_password_hash,
+    hash_password,
     authenticate_user,
     create_access_token,
     get_subject_for_token_type,
     create_confirmation_token,
+    invalidate_user,
 )
+from storeapi.config import config
 from storeapi.database import database, user_table
-from storeapi import tasks
+from storeapi.jobs import job_queue
+from storeapi import mailer
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -26,21 +29,30 @@ async def register(user: UserIn, background_tasks: BackgroundTasks, request: Req
             detail="A user with that email already exists",
         )
 
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await hash_password(user.password)
 
     query = user_table.insert().values(email=user.email, password=hashed_password)
 
     logger.debug(query)
 
     await database.execute(query)
+    invalidate_user(user.email)
 
-    background_tasks.add_task(
-        tasks.send_user_registration_email, # function
-        user.email,
-        confirmation_url=request.url_for(
-            "confirm_email", token=create_confirmation_token(user.email)
-        ),
+    confirmation_url = request.url_for(
+        "confirm_email", token=create_confirmation_token(user.email)
     )
+    if config.JOB_QUEUE_ENABLED:
+        await job_queue.enqueue(
+            "send_user_registration_email",
+            email=user.email,
+            confirmation_url=str(confirmation_url),
+        )
+    else:
+        background_tasks.add_task(
+            mailer.send_user_registration_email, # function
+            user.email,
+            confirmation_url=confirmation_url,
+        )
 
     return {
         "detail": "User Created. Please confirm your email",
@@ -50,7 +62,7 @@ async def register(user: UserIn, background_tasks: BackgroundTasks, request: Req
 @router.post("/token")
 async def login(user: UserIn):
     user = await authenticate_user(user.email, user.password)
-    access_token = create_access_token(user.email)
+    access_token = create_access_token(user.email, user.id, user.confirmed)
     return {"access_token": access_token, "token_type": "bearer"}
 
 
@@ -65,5 +77,6 @@ async def confirm_email(token: str):
     logger.debug(query)
 
     await database.execute(query)
+    invalidate_user(email)
 
     return {"detail": "User confirmed"}
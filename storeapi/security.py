@@ -1,13 +1,19 @@
 import datetime
 import logging
-from typing import Annotated, Literal
+import time
+from typing import Annotated, Literal, Optional
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, ExpiredSignatureError, JWTError
 from passlib.context import CryptContext
 
+from storeapi import metrics
+from storeapi.cache import TTLCache
+from storeapi.config import config
 from storeapi.database import database, user_table
+from storeapi.executor import BoundedExecutor
+from storeapi.models.user import UserClaims
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +23,14 @@ ALGORITHM = "HS256"
 # here "token" is /token route, used to populate documentation
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 pwd_context = CryptContext(schemes=["bcrypt"])
+# email -> user row, saves a query on every authenticated request
+user_cache = TTLCache(
+    maxsize=config.USER_CACHE_MAXSIZE, ttl=config.USER_CACHE_TTL_SECONDS
+)
+metrics.register("user_cache", user_cache.stats)
+# (type, token) -> verified payload, every entry expires together with its token
+token_cache = TTLCache(maxsize=config.TOKEN_CACHE_MAXSIZE, ttl=0)
+metrics.register("token_cache", token_cache.stats)
 
 
 def create_credentials_exception(detail: str) -> HTTPException:
@@ -35,12 +49,18 @@ def confirm_token_expire_minutes() -> int:
     return 1440
 
 
-def create_access_token(email: str):
+def create_access_token(
+    email: str, user_id: Optional[int] = None, confirmed: Optional[bool] = None
+):
     logger.debug("Creating access token", extra={"email": email})
     expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
         minutes=access_token_expire_minutes()
     )
     jwt_data = {"sub": email, "exp": expire, "type": "access"}
+    # signed claims that let get_current_user_claims skip the user lookup
+    if user_id is not None:
+        jwt_data["uid"] = user_id
+        jwt_data["confirmed"] = bool(confirmed)
     encoded_jwt = jwt.encode(jwt_data, key=SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -55,9 +75,11 @@ def create_confirmation_token(email: str):
     return encoded_jwt
 
 
-def get_subject_for_token_type(
-    token: str, type: Literal["access", "confirmation"]
-) -> str:
+def decode_token(token: str, type: Literal["access", "confirmation"]) -> dict:
+    payload = token_cache.get((type, token))
+    if payload is not None:
+        return payload
+
     try:
         payload = jwt.decode(token, key=SECRET_KEY, algorithms=[ALGORITHM])
 
@@ -76,7 +98,17 @@ def get_subject_for_token_type(
             f"Token has incorrect type, expected '{type}'"
         )
 
-    return email
+    # only verified tokens are cached and never beyond their expiry
+    expires_in = payload["exp"] - time.time() if "exp" in payload else 0
+    token_cache.set((type, token), payload, ttl=expires_in)
+
+    return payload
+
+
+def get_subject_for_token_type(
+    token: str, type: Literal["access", "confirmation"]
+) -> str:
+    return decode_token(token, type)["sub"]
 
 
 def get_password_hash(password: str):
@@ -87,7 +119,29 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+# bcrypt runs off the event loop, in processes if PASSWORD_HASH_EXECUTOR says so
+password_hasher = BoundedExecutor(
+    "password-hash",
+    workers=config.PASSWORD_HASH_WORKERS,
+    max_pending=config.PASSWORD_HASH_MAX_PENDING,
+    executor=config.PASSWORD_HASH_EXECUTOR,
+)
+metrics.register("password_hasher", password_hasher.stats)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.run(get_password_hash, password)
+
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.run(verify_password, plain_password, hashed_password)
+
+
 async def get_user(email: str):
+    user = user_cache.get(email)
+    if user is not None:
+        return user
+
     logger.debug("Fetching user from the database", extra={"email": email})
 
     query = user_table.select().where(user_table.c.email == email)
@@ -95,15 +149,20 @@ async def get_user(email: str):
     result = await database.fetch_one(query)
 
     if result:
+        user_cache.set(email, result)
         return result
 
 
+def invalidate_user(email: str):
+    user_cache.delete(email)
+
+
 async def authenticate_user(email: str, password: str):
     logger.debug("Authenticating user", extra={"email": email})
     user = await get_user(email)
     if not user:
         raise create_credentials_exception("Invalid email or password")
-    if not verify_password(password, user.password):
+    if not await check_password(password, user.password):
         raise create_credentials_exception("Invalid email or password")
     return user
 
@@ -115,3 +174,18 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     if user is None:
         raise create_credentials_exception("Could not find user for the token")
     return user
+
+
+async def get_current_user_claims(
+    token: Annotated[str, Depends(oauth2_scheme)],
+) -> UserClaims:
+    payload = decode_token(token, "access")
+
+    # tokens issued before the claims were added still need the lookup
+    if config.ACCESS_TOKEN_FRESH_USER or "uid" not in payload:
+        user = await get_current_user(token)
+        return UserClaims(id=user.id, email=user.email, confirmed=bool(user.confirmed))
+
+    return UserClaims(
+        id=payload["uid"], email=payload["sub"], confirmed=payload["confirmed"]
+    )
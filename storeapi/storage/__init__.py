@@ -0,0 +1,62 @@
+import logging
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import BinaryIO, Optional
+
+from storeapi import metrics
+from storeapi.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend(ABC):
+    # the methods block and are called from the upload pool, both return the
+    # url the stored file is served from
+    name = "base"
+    # where uploads are spooled before upload_file, None for the system temp
+    # dir. A backend that can take the spooled file over without copying it
+    # points this at its own filesystem
+    temp_dir: Optional[str] = None
+
+    @abstractmethod
+    def upload_file(
+        self, local_file: str, file_name: str, content_hash: Optional[str] = None
+    ) -> str:
+        # content_hash is the sha256 of the file when the caller already has it
+        ...
+
+    @abstractmethod
+    def upload_stream(self, source: BinaryIO, file_name: str) -> tuple[str, str]:
+        # reads source until it is exhausted, returns the url and the sha256
+        # of the content
+        ...
+
+    async def start(self) -> None:
+        # connections and credentials are set up here so the first upload
+        # does not pay for them
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "healthy": True}
+
+
+@lru_cache()
+def get_storage() -> StorageBackend:
+    logger.info(f"Using {config.STORAGE_BACKEND} storage")
+    if config.STORAGE_BACKEND == "local":
+        from storeapi.storage.local import LocalStorage
+
+        return LocalStorage(config.LOCAL_STORAGE_PATH, config.LOCAL_STORAGE_URL)
+
+    if config.STORAGE_BACKEND == "b2":
+        from storeapi.storage.b2 import B2Storage
+
+        return B2Storage(config.UPLOAD_PART_SIZE, config.UPLOAD_STREAM_BUFFERS)
+
+    raise ValueError(f"Unknown storage backend {config.STORAGE_BACKEND}")
+
+
+metrics.register("storage", lambda: get_storage().stats())
@@ -0,0 +1,43 @@
+import logging
+from typing import BinaryIO, Optional
+
+from storeapi.config import config
+from storeapi.libs.b2 import b2_client, b2_upload_file, b2_upload_stream
+from storeapi.storage import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+
+class B2Storage(StorageBackend):
+    name = "b2"
+
+    def __init__(self, part_size: int, buffers_count: int) -> None:
+        self.part_size = part_size
+        self.buffers_count = buffers_count
+
+    def upload_file(
+        self, local_file: str, file_name: str, content_hash: Optional[str] = None
+    ) -> str:
+        return b2_upload_file(local_file=local_file, file_name=file_name)
+
+    def upload_stream(self, source: BinaryIO, file_name: str) -> tuple[str, str]:
+        return b2_upload_stream(
+            source,
+            file_name,
+            part_size=self.part_size,
+            buffers_count=self.buffers_count,
+        )
+
+    async def start(self) -> None:
+        if not (
+            config.B2_KEY_ID and config.B2_APPLICATION_KEY and config.B2_BUCKET_NAME
+        ):
+            logger.warning("B2 credentials are not set, uploads will fail")
+            return
+        await b2_client.start()
+
+    async def stop(self) -> None:
+        await b2_client.stop()
+
+    def stats(self) -> dict:
+        return {"backend": self.name, **b2_client.stats()}
@@ -0,0 +1,179 @@
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Optional
+
+from fastapi import HTTPException, status
+from fastapi.staticfiles import StaticFiles
+
+from storeapi.storage import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+# errors meaning the zero-copy call is not supported for these two files, e.g.
+# across filesystems on older kernels, the next method is tried
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+# errors meaning the file cannot be linked into root, it is copied instead
+LINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP}
+
+
+def copy_fd(src: int, dst: int, size: int) -> str:
+    # copies size bytes between two files without going through user space
+    # when the kernel allows it, returns the method that was used
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+
+        os.lseek(src, 0, os.SEEK_SET)
+        os.lseek(dst, 0, os.SEEK_SET)
+        os.ftruncate(dst, 0)
+        copied = 0
+        try:
+            while copied < size:
+                if method == "copy_file_range":
+                    sent = os.copy_file_range(src, dst, size - copied)
+                else:
+                    sent = os.sendfile(dst, src, copied, size - copied)
+                if sent == 0:
+                    break
+                copied += sent
+            return method
+        except OSError as err:
+            if err.errno not in UNSUPPORTED:
+                raise
+            logger.debug(f"{method} is not supported here: {err}")
+
+    os.lseek(src, 0, os.SEEK_SET)
+    os.lseek(dst, 0, os.SEEK_SET)
+    os.ftruncate(dst, 0)
+    while chunk := os.read(src, CHUNK_SIZE):
+        os.write(dst, chunk)
+    return "read_write"
+
+
+def hash_fd(fd: int) -> str:
+    content_hash = hashlib.sha256()
+    os.lseek(fd, 0, os.SEEK_SET)
+    while chunk := os.read(fd, CHUNK_SIZE):
+        content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+class LocalStorage(StorageBackend):
+    # files are stored under their content hash, ab/cd/abcd...<suffix>, so
+    # storing the same content twice keeps a single file. Files are written
+    # to a temp file in root/.tmp first and renamed into place, a reader never
+    # sees a partial file
+    name = "local"
+
+    def __init__(self, root: str, base_url: str) -> None:
+        self.root = Path(root)
+        self.base_url = base_url.rstrip("/")
+        # uploads are spooled here, on the same filesystem as root
+        self.temp_dir = str(self.root / ".tmp")
+        Path(self.temp_dir).mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, content_hash: str, file_name: str) -> PurePosixPath:
+        suffix = PurePosixPath(file_name).suffix.lower()
+        return PurePosixPath(
+            content_hash[:2], content_hash[2:4], f"{content_hash}{suffix}"
+        )
+
+    def url_for(self, path: PurePosixPath) -> str:
+        return f"{self.base_url}/{path}"
+
+    def _store(self, temp_path: str, content_hash: str, file_name: str) -> str:
+        path = self.path_for(content_hash, file_name)
+        target = self.root / path
+        if target.exists():
+            os.unlink(temp_path)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # both are under root so this is a rename, not a copy
+            os.replace(temp_path, target)
+        return self.url_for(path)
+
+    def _temp_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.temp_dir, delete=False)
+
+    def upload_file(
+        self, local_file: str, file_name: str, content_hash: Optional[str] = None
+    ) -> str:
+        if content_hash is None:
+            src = os.open(local_file, os.O_RDONLY)
+            try:
+                content_hash = hash_fd(src)
+            finally:
+                os.close(src)
+
+        path = self.path_for(content_hash, file_name)
+        target = self.root / path
+        if target.exists():
+            return self.url_for(path)
+
+        # a file spooled in temp_dir is stored as a second name for it, no
+        # byte is copied and the caller still removes its own name. The
+        # caller must not write to local_file afterwards
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(local_file, target)
+        except FileExistsError:
+            # the same content was stored concurrently
+            pass
+        except OSError as err:
+            if err.errno not in LINK_UNSUPPORTED:
+                raise
+            return self._copy(local_file, content_hash, file_name)
+        return self.url_for(path)
+
+    def _copy(self, local_file: str, content_hash: str, file_name: str) -> str:
+        # local_file is on another filesystem, e.g. spooled in the system
+        # temp dir
+        src = os.open(local_file, os.O_RDONLY)
+        try:
+            with self._temp_file() as temp_file:
+                try:
+                    method = copy_fd(src, temp_file.fileno(), os.fstat(src).st_size)
+                except BaseException:
+                    os.unlink(temp_file.name)
+                    raise
+            logger.debug(f"Copied {local_file} with {method}")
+        finally:
+            os.close(src)
+
+        return self._store(temp_file.name, content_hash, file_name)
+
+    def upload_stream(self, source: BinaryIO, file_name: str) -> tuple[str, str]:
+        content_hash = hashlib.sha256()
+        with self._temp_file() as temp_file:
+            try:
+                while chunk := source.read(CHUNK_SIZE):
+                    temp_file.write(chunk)
+                    content_hash.update(chunk)
+            except BaseException:
+                os.unlink(temp_file.name)
+                raise
+
+        content_hash = content_hash.hexdigest()
+        return self._store(temp_file.name, content_hash, file_name), content_hash
+
+
+class LocalFiles(StaticFiles):
+    # stored files keep the suffix the uploader chose, served inline an .html
+    # or .svg upload would run its scripts on this origin, so every file is
+    # sent as a download. The temp dir is not served
+    async def get_response(self, path: str, scope):
+        if any(part.startswith(".") for part in PurePosixPath(path).parts):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        return await super().get_response(path, scope)
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Content-Disposition"] = "attachment"
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        return response
@@ -1,9 +1,17 @@
+import asyncio
+import hashlib
+import importlib.util
 import logging
 from json import JSONDecodeError
+from typing import Optional
 
 import httpx
+import sqlalchemy
 from databases import Database
 
+from storeapi import metrics
+from storeapi.cache import TTLCache, invalidate_post
+from storeapi.circuit_breaker import CircuitBreaker, CircuitOpenError
 from storeapi.config import config
 from storeapi.database import post_table
 
@@ -14,12 +22,77 @@ class APIResponseError(Exception):
     pass
 
 
+# one pooled client shared by all outbound calls so connections are reused
+# instead of doing a new TCP and TLS handshake per email or image
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def create_http_client() -> httpx.AsyncClient:
+    http2 = config.HTTP_CLIENT_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP/2 requested but the h2 package is not installed")
+        http2 = False
+
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config.HTTP_CLIENT_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.HTTP_CLIENT_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=config.HTTP_CLIENT_TIMEOUT_SECONDS,
+        http2=http2,
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    # created by the lifespan handler, lazily when used outside of the app
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = create_http_client()
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def is_outage(err: BaseException) -> bool:
+    # only errors that say the API is down or overloaded trip the breakers
+    if isinstance(err, httpx.HTTPStatusError):
+        return err.response.status_code >= 500 or err.response.status_code == 429
+    return isinstance(err, httpx.TransportError)
+
+
+mailgun_breaker = CircuitBreaker(
+    "mailgun",
+    failure_threshold=config.BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=config.BREAKER_RESET_TIMEOUT_SECONDS,
+    deadline=config.MAILGUN_DEADLINE_SECONDS,
+    max_pending=config.MAILGUN_MAX_PENDING,
+    is_failure=is_outage,
+)
+deepai_breaker = CircuitBreaker(
+    "deepai",
+    failure_threshold=config.BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=config.BREAKER_RESET_TIMEOUT_SECONDS,
+    deadline=config.DEEPAI_DEADLINE_SECONDS,
+    max_pending=config.DEEPAI_MAX_PENDING,
+    is_failure=is_outage,
+)
+metrics.register("mailgun_breaker", mailgun_breaker.stats)
+metrics.register("deepai_breaker", deepai_breaker.stats)
+
+
 async def send_simple_email(to: str, subject: str, body: str):
     logger.debug(f"Sending email to {to[:3]} with subject {subject[:20]}")
-    async with httpx.AsyncClient() as client:
-        try:
+    client = get_http_client()
+    try:
+        async with mailgun_breaker.call():
             response = await client.post(
-                f"https://api.mailgun.net/v3/{config.MAILGUN_DOMAIN}/messages",
+                f"{config.MAILGUN_API_URL}/{config.MAILGUN_DOMAIN}/messages",
                 auth=("api", config.MAILGUN_API_KEY),
                 data={
                     "from": f"Store API <mailgun@{config.MAILGUN_DOMAIN}>",
@@ -29,13 +102,15 @@ async def send_simple_email(to: str, subject: str, body: str):
                 },
             )
             response.raise_for_status()
-            logger.debug(response.content)
-            return response
+        logger.debug(response.content)
+        return response
 
-        except httpx.RequestError as err:
-            raise APIResponseError(
-                f"API request failed with status code {err.response.status_code}"
-            ) from err
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code {err.response.status_code}"
+        ) from err
+    except (httpx.RequestError, CircuitOpenError, TimeoutError) as err:
+        raise APIResponseError(f"API request failed: {err!r}") from err
 
 
 async def send_user_registration_email(email: str, confirmation_url: str):
@@ -52,8 +127,9 @@ async def send_user_registration_email(email: str, confirmation_url: str):
 
 async def _generate_cute_creature_api(propmt: str):
     logger.debug(f"Generating cute creature with prompt {propmt[:20]}")
-    async with httpx.AsyncClient() as client:
-        try:
+    client = get_http_client()
+    try:
+        async with deepai_breaker.call():
             response = await client.post(
                 "https://api.deepai.org/api/cute-creature-generator",
                 data={"text": propmt},
@@ -62,55 +138,140 @@ async def _generate_cute_creature_api(propmt: str):
             )
             logger.debug(response)
             response.raise_for_status()
-            return response.json()
-        except httpx.RequestError as err:
-            raise APIResponseError(
-                f"API request failed with status code {err.response.status_code}"
-            ) from err
-        except JSONDecodeError as err:
-            raise APIResponseError("API response is not valid JSON") from err
+        return response.json()
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code {err.response.status_code}"
+        ) from err
+    except (httpx.RequestError, CircuitOpenError, TimeoutError) as err:
+        raise APIResponseError(f"API request failed: {err!r}") from err
+    except JSONDecodeError as err:
+        raise APIResponseError("API response parsing failed") from err
 
 
-async def generate_and_add_to_post(
-    email: str,
-    post_id: int,
-    post_url: str,
-    database: Database,
-    prompt: str = "A blue british shorthair cat is sitting on a couch",
-):
-    try:
+# normalized prompt hash -> DeepAI response, concurrent calls for the same
+# prompt share the request in flight and at most DEEPAI_MAX_CONCURRENCY
+# requests run at once, the others wait for a slot
+image_cache = TTLCache(
+    maxsize=config.IMAGE_CACHE_MAXSIZE, ttl=config.IMAGE_CACHE_TTL_SECONDS
+)
+_image_requests: dict[str, asyncio.Future] = {}
+_deepai_slots = asyncio.Semaphore(config.DEEPAI_MAX_CONCURRENCY)
+_image_stats = {"shared": 0, "requests": 0}
+
+
+def prompt_key(prompt: str) -> str:
+    normalized = " ".join(prompt.casefold().split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+async def _generate_and_cache(key: str, prompt: str):
+    async with _deepai_slots:
+        _image_stats["requests"] += 1
         response = await _generate_cute_creature_api(prompt)
-    except APIResponseError:
-        return await send_simple_email(
-            email,
-            "Error generating image",
-            (
-                f"Hi {email}! Unfortunately there was an error generating your image"
-                " for your post."
-            ),
-        )
+
+    # failures are not cached so the next post with the prompt tries again
+    image_cache.set(key, response)
+    return response
+
+
+async def generate_cute_creature_api(prompt: str):
+    key = prompt_key(prompt)
+    response = image_cache.get(key)
+    if response is not None:
+        return response
+
+    request = _image_requests.get(key)
+    if request is None:
+        request = asyncio.ensure_future(_generate_and_cache(key, prompt))
+        _image_requests[key] = request
+        request.add_done_callback(lambda _: _image_requests.pop(key, None))
+    else:
+        _image_stats["shared"] += 1
+
+    # shielded so a cancelled caller does not cancel the request of the others
+    return await asyncio.shield(request)
+
+
+def image_generation_stats() -> dict:
+    return {
+        **image_cache.stats(),
+        **_image_stats,
+        "in_flight": len(_image_requests),
+        "max_concurrency": config.DEEPAI_MAX_CONCURRENCY,
+    }
+
+
+metrics.register("image_generation", image_generation_stats)
+
+
+async def send_image_failed_email(email: str):
+    return await send_simple_email(
+        email,
+        "Error generating image",
+        (
+            f"Hi {email}! Unfortunately there was an error generating your image"
+            " for your post."
+        ),
+    )
+
+
+async def send_image_added_email(email: str, post_url: str):
+    return await send_simple_email(
+        email,
+        "Image generation completed",
+        (
+            f"Hi {email}! Your image for your post has been generated and added to your post."
+            f" please click on the following link to view your post: {post_url}"
+        ),
+    )
+
+
+async def post_image_url(post_id: int, database: Database) -> Optional[str]:
+    query = sqlalchemy.select(post_table.c.image_url).where(post_table.c.id == post_id)
+    return await database.fetch_val(query)
+
+
+async def add_image_to_post(post_id: int, database: Database, prompt: str) -> str:
+    # raises APIResponseError when the image could not be generated. A post
+    # that already has its image keeps it, so running this again, e.g. for a
+    # retried job, does not generate and pay for a second one
+    if image_url := await post_image_url(post_id, database):
+        return image_url
+
+    response = await generate_cute_creature_api(prompt)
 
     logger.debug("Connecting to database to update the post")
 
     query = (
         post_table.update()
         .where(post_table.c.id == post_id)
-        .values(image_url=response["output_url"])
+        .values(image_url=response["output_url"], version=post_table.c.version + 1)
     )
 
     logger.debug(query)
 
     await database.execute(query)
+    invalidate_post(post_id)
 
     logger.debug("Database connection in background task closed")
 
-    await send_simple_email(
-        email,
-        "Image generation completed",
-        (
-            f"Hi {email}! Your image for your post has been generated and added to your post."
-            f" please click on the following link to view your post: {post_url}"
-        ),
-    )
+    return response["output_url"]
 
-    return response
+
+async def generate_and_add_to_post(
+    email: str,
+    post_id: int,
+    post_url: str,
+    database: Database,
+    prompt: str = "A blue british shorthair cat is sitting on a couch",
+):
+    # run as a background task there is no retry, the user is told right away
+    try:
+        image_url = await add_image_to_post(post_id, database, prompt)
+    except APIResponseError:
+        return await send_image_failed_email(email)
+
+    await send_image_added_email(email, post_url)
+
+    return image_url
@@ -13,7 +13,12 @@ from storeapi.tests.helpers import create_post
 os.environ["ENV_STATE"] = "test"
 
 from storeapi.main import app  # noqa: E402
-from storeapi.database import database, user_table  # noqa: E402
+from storeapi.cache import post_cache  # noqa: E402
+from storeapi.database import database, engine, user_table  # noqa: E402
+from storeapi.etag import resource_versions  # noqa: E402
+from storeapi.migrations import run_migrations  # noqa: E402
+from storeapi.security import token_cache, user_cache  # noqa: E402
+from storeapi.tasks import deepai_breaker, image_cache, mailgun_breaker  # noqa: E402
 
 
 # "session" means run only once for the test session
@@ -27,6 +32,11 @@ def client() -> Generator:
     yield TestClient(app)
 
 
+@pytest.fixture(scope="session", autouse=True)
+def migrated_database() -> None:
+    run_migrations(engine)
+
+
 # auto is to run on every test
 @pytest.fixture(autouse=True)
 async def db() -> AsyncGenerator:
@@ -34,6 +44,14 @@ async def db() -> AsyncGenerator:
     # comment_table.clear()
 
     # after every disconnect database will rollback as DB_FORCE_ROLLBACK is True
+    # so anything cached from the previous test would be stale
+    post_cache.clear()
+    user_cache.clear()
+    token_cache.clear()
+    image_cache.clear()
+    mailgun_breaker.reset()
+    deepai_breaker.reset()
+    resource_versions.reset()
     await database.connect()
     yield database
     await database.disconnect()
@@ -85,12 +103,15 @@ async def logged_in_token(async_client: AsyncClient, confirmed_user: dict) -> st
 
 @pytest.fixture(autouse=True)
 def mock_httpx(mocker):
-    mocked_client = mocker.patch("storeapi.tasks.httpx.AsyncClient")
-
     mocked_async_client = Mock()
     response = Response(200, content="", request=Request("POST", "//"))
 
     mocked_async_client.post = AsyncMock(return_value=response)
-    mocked_client.return_value.__aenter__.return_value = mocked_async_client
+    mocker.patch("storeapi.tasks.get_http_client", return_value=mocked_async_client)
 
     return mocked_async_client
+
+
+@pytest.fixture()
+def mock_httpx_client(mock_httpx):
+    return mock_httpx
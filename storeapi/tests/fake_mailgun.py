@@ -0,0 +1,63 @@
+# a local stand-in for the Mailgun messages API, it records the messages it
+# accepts and rejects the calls that contain an address from invalid_addresses
+# the way Mailgun does, with a 400 for the whole call
+#
+#     python -m storeapi.tests.fake_mailgun --port 8025
+#
+# and point MAILGUN_API_URL at http://localhost:8025/v3
+import argparse
+import json
+import uuid
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+class FakeMailgun:
+    def __init__(self) -> None:
+        self.calls: list[dict] = []
+        self.messages: list[dict] = []
+        self.invalid_addresses: set[str] = set()
+        # status code returned for every call, e.g. 500 or 429
+        self.fail_with: int | None = None
+        self.app = Starlette(
+            routes=[Route("/v3/{domain}/messages", self.send, methods=["POST"])]
+        )
+
+    async def send(self, request: Request) -> JSONResponse:
+        form = await request.form()
+        to = form.getlist("to")
+        recipient_variables = json.loads(form.get("recipient-variables") or "{}")
+        self.calls.append({"to": to, "recipient_variables": recipient_variables})
+
+        if self.fail_with is not None:
+            return JSONResponse({"message": "Fake failure"}, self.fail_with)
+
+        if not to or self.invalid_addresses.intersection(to):
+            return JSONResponse(
+                {"message": "'to' parameter is not a valid address"}, 400
+            )
+
+        for address in to:
+            text = form["text"]
+            for name, value in recipient_variables.get(address, {}).items():
+                text = text.replace(f"%recipient.{name}%", str(value))
+            self.messages.append(
+                {"to": address, "subject": form["subject"], "text": text}
+            )
+
+        return JSONResponse(
+            {"id": f"<{uuid.uuid4().hex}@fake>", "message": "Queued. Thank you."}
+        )
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a fake Mailgun API")
+    parser.add_argument("--port", type=int, default=8025)
+    args = parser.parse_args()
+
+    uvicorn.run(FakeMailgun().app, port=args.port)
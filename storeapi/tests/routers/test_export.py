@@ -0,0 +1,94 @@
+import json
+import pathlib
+
+import pytest
+import sqlalchemy
+from databases import Database
+from httpx import AsyncClient
+
+from storeapi.database import metadata, post_table, user_table
+from storeapi.routers import export
+from storeapi.tests.helpers import create_comment, create_post, like_post
+
+
+async def call_export_endpoint(
+    async_client: AsyncClient, token: str, params: dict = None
+) -> list[dict]:
+    response = await async_client.get(
+        "/export", params=params, headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+@pytest.mark.anyio
+async def test_export(
+    async_client: AsyncClient, logged_in_token: str, confirmed_user: dict
+):
+    post = await create_post("Test Post", async_client, logged_in_token)
+    comment = await create_comment(
+        "Test Comment", post["id"], async_client, logged_in_token
+    )
+    like = await like_post(post["id"], async_client, logged_in_token)
+
+    rows = await call_export_endpoint(async_client, logged_in_token)
+
+    assert rows == [
+        {"type": "post", **post, "likes": 1, "version": 0},
+        {"type": "comment", **comment},
+        {"type": "like", **like},
+    ]
+
+
+@pytest.mark.anyio
+async def test_export_id_range(async_client: AsyncClient, logged_in_token: str):
+    for i in range(1, 5):
+        await create_post(f"Test post {i}", async_client, logged_in_token)
+
+    rows = await call_export_endpoint(
+        async_client,
+        logged_in_token,
+        {"tables": ["posts", "likes"], "min_id": 2, "max_id": 3},
+    )
+
+    assert [(row["type"], row["id"]) for row in rows] == [("post", 2), ("post", 3)]
+
+
+@pytest.mark.anyio
+async def test_export_requires_login(async_client: AsyncClient):
+    response = await async_client.get("/export")
+
+    assert response.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_export_does_not_block_writes(tmp_path: pathlib.Path, mocker):
+    # a file database without the forced rollback, where an open read would
+    # keep a writer on another connection waiting for the lock
+    url = f"sqlite:///{tmp_path / 'export.db'}"
+    engine = sqlalchemy.create_engine(url)
+    metadata.create_all(engine)
+    engine.dispose()
+    reader, writer = Database(url), Database(url, timeout=0.2)
+    await reader.connect()
+    await writer.connect()
+    mocker.patch.object(export, "database", reader)
+    mocker.patch.object(export, "EXPORT_BATCH_SIZE", 2)
+    rows = export.export_rows([export.ExportTable.posts], None, None)
+    try:
+        await writer.execute(user_table.insert().values(id=1, email="a@example.net"))
+        for i in range(3):
+            await writer.execute(post_table.insert().values(body=f"{i}", user_id=1))
+
+        first = await anext(rows)
+        await writer.execute(post_table.insert().values(body="3", user_id=1))
+        rest = [chunk async for chunk in rows]
+    finally:
+        await rows.aclose()
+        await reader.disconnect()
+        await writer.disconnect()
+
+    lines = (first + b"".join(rest)).decode().splitlines()
+    assert len(first.decode().splitlines()) == 2
+    assert [json.loads(line)["body"] for line in lines] == ["0", "1", "2", "3"]
@@ -0,0 +1,32 @@
+import pytest
+from httpx import AsyncClient
+
+
+@pytest.fixture()
+def storage(mocker):
+    storage = mocker.Mock()
+    storage.stats.return_value = {"backend": "b2", "healthy": True}
+    mocker.patch("storeapi.routers.health.get_storage", return_value=storage)
+    return storage
+
+
+@pytest.mark.anyio
+async def test_health(async_client: AsyncClient, storage):
+    response = await async_client.get("/health")
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "status": "ok",
+        "database": True,
+        "storage": {"backend": "b2", "healthy": True},
+    }
+
+
+@pytest.mark.anyio
+async def test_health_storage_not_ready(async_client: AsyncClient, storage):
+    storage.stats.return_value = {"backend": "b2", "healthy": False}
+
+    response = await async_client.get("/health")
+
+    assert response.status_code == 503
+    assert response.json()["status"] == "unavailable"
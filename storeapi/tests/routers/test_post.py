@@ -1,7 +1,15 @@
+import base64
+from unittest.mock import patch
+
 import pytest
 from httpx import AsyncClient
 
-from storeapi import security
+from storeapi import jobs, security
+from storeapi.cache import TTLCache, invalidate_comments, post_cache
+from storeapi.database import database
+from storeapi.etag import ResourceVersions
+from storeapi.likes_buffer import like_buffer
+from storeapi.routers import post as post_router
 from storeapi.tests.helpers import create_comment, create_post, like_post
 
 
@@ -43,6 +51,22 @@ async def test_create_post(
     }.items() <= response.json().items()
 
 
+@pytest.mark.anyio
+async def test_create_post_skips_user_lookup(
+    async_client: AsyncClient, logged_in_token: str, mocker
+):
+    get_user = mocker.spy(security, "get_user")
+
+    response = await async_client.post(
+        "/post",
+        json={"body": "Test Post"},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 201
+    get_user.assert_not_called()
+
+
 @pytest.mark.anyio
 async def test_create_post_with_prompt(
     async_client: AsyncClient, logged_in_token: str, mock_generate_cute_creature_api
@@ -52,6 +76,7 @@ async def test_create_post_with_prompt(
     response = await async_client.post(
         "/post",
         json={"body": body},
+        params={"prompt": "A cat"},
         headers={"Authorization": f"Bearer {logged_in_token}"},
     )
 
@@ -106,6 +131,94 @@ async def test_like_post(
     assert response.status_code == 201
 
 
+@pytest.mark.anyio
+async def test_like_post_twice(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await like_post(created_post["id"], async_client, logged_in_token)
+
+    response = await async_client.post(
+        "/like",
+        json={"post_id": created_post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 409
+
+
+@pytest.fixture()
+async def write_behind_likes(db):
+    await like_buffer.start()
+    yield like_buffer
+    await like_buffer.stop()
+
+
+@pytest.mark.anyio
+async def test_like_post_write_behind(
+    async_client: AsyncClient,
+    created_post: dict,
+    logged_in_token: str,
+    write_behind_likes,
+):
+    response = await async_client.post(
+        "/like",
+        json={"post_id": created_post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 202
+    assert response.json()["id"] is None
+
+    response = await async_client.get("/post")
+    assert response.json()[0]["likes"] == 1
+
+    await write_behind_likes.flush()
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 1
+
+
+@pytest.mark.anyio
+async def test_like_stored_post_twice_write_behind(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await like_post(created_post["id"], async_client, logged_in_token)
+    await like_buffer.start()
+    try:
+        response = await async_client.post(
+            "/like",
+            json={"post_id": created_post["id"]},
+            headers={"Authorization": f"Bearer {logged_in_token}"},
+        )
+    finally:
+        await like_buffer.stop()
+
+    assert response.status_code == 409
+
+
+@pytest.mark.anyio
+async def test_like_missing_post_write_behind(
+    async_client: AsyncClient, logged_in_token: str, write_behind_likes
+):
+    response = await async_client.post(
+        "/like",
+        json={"post_id": 1},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_like_post_increments_counter(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await like_post(created_post["id"], async_client, logged_in_token)
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+
+    assert response.json()["post"]["likes"] == 1
+
+
 @pytest.mark.anyio
 async def test_get_all_posts(async_client: AsyncClient, created_post: dict):
     response = await async_client.get("/post")
@@ -158,6 +271,124 @@ async def test_get_all_posts_sort_likes(
     assert expected_order == post_ids
 
 
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "sorting, expected_pages",
+    [("new", [[3, 2], [1]]), ("old", [[1, 2], [3]]), ("most_likes", [[2, 3], [1]])],
+)
+async def test_get_all_posts_paginated(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sorting: str,
+    expected_pages: list[list[int]],
+):
+    await create_post("Test post 1", async_client, logged_in_token)
+    await create_post("Test post 2", async_client, logged_in_token)
+    await create_post("Test post 3", async_client, logged_in_token)
+    await like_post(2, async_client, logged_in_token)
+
+    pages = []
+    params = {"sorting": sorting, "limit": 2}
+    while True:
+        response = await async_client.get("/post", params=params)
+        assert response.status_code == 200
+        pages.append([post["id"] for post in response.json()])
+
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        params["after"] = cursor
+
+    assert expected_pages == pages
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "!!",
+        base64.urlsafe_b64encode(b'{"s":"new","k":[1e400]}').decode(),
+        base64.urlsafe_b64encode(b'{"s":"new","k":[99999999999999999999999]}').decode(),
+        base64.urlsafe_b64encode(b'{"s":"new","k":["1"]}').decode(),
+    ],
+)
+async def test_get_all_posts_invalid_cursor(async_client: AsyncClient, cursor: str):
+    response = await async_client.get("/post", params={"limit": 2, "after": cursor})
+
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_cursor_wrong_sorting(
+    async_client: AsyncClient, logged_in_token: str
+):
+    await create_post("Test post 1", async_client, logged_in_token)
+    await create_post("Test post 2", async_client, logged_in_token)
+
+    response = await async_client.get("/post", params={"limit": 1})
+    cursor = response.headers["X-Next-Cursor"]
+
+    response = await async_client.get(
+        "/post", params={"sorting": "most_likes", "limit": 1, "after": cursor}
+    )
+
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_search_posts(async_client: AsyncClient, logged_in_token: str):
+    await create_post("A cat on a couch", async_client, logged_in_token)
+    await create_post("A dog", async_client, logged_in_token)
+    await create_post("Cat, cat and another cat", async_client, logged_in_token)
+
+    response = await async_client.get("/post/search", params={"q": "cat"})
+
+    assert response.status_code == 200
+    assert [post["id"] for post in response.json()] == [3, 1]
+
+
+@pytest.mark.anyio
+async def test_search_posts_write_behind(
+    async_client: AsyncClient,
+    created_post: dict,
+    logged_in_token: str,
+    write_behind_likes,
+):
+    await async_client.post(
+        "/like",
+        json={"post_id": created_post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    response = await async_client.get("/post/search", params={"q": "test"})
+
+    assert response.json()[0]["likes"] == 1
+
+
+@pytest.mark.anyio
+async def test_search_posts_paginated(async_client: AsyncClient, logged_in_token: str):
+    for i in range(3):
+        await create_post(f"Test post {i}", async_client, logged_in_token)
+
+    response = await async_client.get(
+        "/post/search", params={"q": "test post", "limit": 2, "offset": 2}
+    )
+
+    assert len(response.json()) == 1
+
+
+@pytest.mark.anyio
+async def test_search_posts_query_syntax_is_escaped(
+    async_client: AsyncClient, logged_in_token: str
+):
+    await create_post('A "quoted" post', async_client, logged_in_token)
+
+    response = await async_client.get("/post/search", params={"q": '"quoted* OR ('})
+
+    assert response.status_code == 200
+    assert response.json() == []
+
+
 async def test_get_all_posts_wrong_sort(
     async_client: AsyncClient,
     logged_in_token: str,
@@ -224,6 +455,160 @@ async def test_get_post_with_comment(
     }
 
 
+@pytest.mark.anyio
+async def test_get_post_without_comments(async_client: AsyncClient, created_post: dict):
+    response = await async_client.get(f"/post/{created_post['id']}")
+
+    assert response.status_code == 200
+    assert response.json() == {"post": {**created_post, "likes": 0}, "comments": []}
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comment_after_new_comment(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await async_client.get(f"/post/{created_post['id']}")
+    await async_client.get(f"/post/{created_post['id']}/comment")
+    comment = await create_comment(
+        "Test Comment", created_post["id"], async_client, logged_in_token
+    )
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["comments"] == [comment]
+
+    response = await async_client.get(f"/post/{created_post['id']}/comment")
+    assert response.json() == [comment]
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comment_written_during_read_is_not_cached(
+    async_client: AsyncClient, created_post: dict, mocker
+):
+    fetch = post_router.fetch_post_with_comments
+
+    async def fetch_then_comment(post_id: int):
+        post_with_comments = await fetch(post_id)
+        # a comment created while the read was in flight
+        invalidate_comments(post_id)
+        return post_with_comments
+
+    mocker.patch.object(
+        post_router, "fetch_post_with_comments", side_effect=fetch_then_comment
+    )
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+
+    assert response.status_code == 200
+    assert ("post", created_post["id"]) not in post_cache
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_after_new_post_and_like(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await async_client.get("/post")
+    await async_client.get("/post", params={"sorting": "most_likes"})
+    new_post = await create_post("Test post 2", async_client, logged_in_token)
+    await like_post(created_post["id"], async_client, logged_in_token)
+
+    response = await async_client.get("/post")
+    assert [(post["id"], post["likes"]) for post in response.json()] == [
+        (new_post["id"], 0),
+        (created_post["id"], 1),
+    ]
+
+    response = await async_client.get("/post", params={"sorting": "most_likes"})
+    assert [post["id"] for post in response.json()] == [
+        created_post["id"],
+        new_post["id"],
+    ]
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_not_modified(
+    async_client: AsyncClient, created_post: dict, mocker
+):
+    response = await async_client.get("/post")
+    etag = response.headers["ETag"]
+
+    fetch_all = mocker.spy(database, "fetch_all")
+    response = await async_client.get("/post", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+    fetch_all.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_etag_changes_after_like(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.get("/post")
+    etag = response.headers["ETag"]
+
+    await like_post(created_post["id"], async_client, logged_in_token)
+    response = await async_client.get("/post", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comment_etag_changes_after_comment(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.get(f"/post/{created_post['id']}")
+    etag = response.headers["ETag"]
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    await create_comment(
+        "Test Comment", created_post["id"], async_client, logged_in_token
+    )
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-None-Match": etag}
+    )
+
+    assert response.status_code == 200
+    assert len(response.json()["comments"]) == 1
+
+
+@pytest.mark.anyio
+async def test_etags_change_after_image_added_by_worker_process(
+    async_client: AsyncClient, created_post: dict, mock_generate_cute_creature_api
+):
+    post_etag = (await async_client.get(f"/post/{created_post['id']}")).headers["ETag"]
+    feed_etag = (await async_client.get("/post")).headers["ETag"]
+
+    # the worker process invalidates its own caches and resource versions
+    with patch("storeapi.cache.post_cache", TTLCache(maxsize=10, ttl=60)), patch(
+        "storeapi.cache.resource_versions", ResourceVersions()
+    ):
+        await jobs.generate_and_add_to_post(
+            database,
+            email="test@example.net",
+            post_id=created_post["id"],
+            post_url="/post/1",
+            prompt="A cat",
+        )
+    # until the copies cached by the API process expire
+    post_cache.clear()
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-None-Match": post_etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["post"]["image_url"] == "http://example.net/image.jpg"
+
+    response = await async_client.get("/post", headers={"If-None-Match": feed_etag})
+    assert response.status_code == 200
+    assert response.json()[0]["image_url"] == "http://example.net/image.jpg"
+
+
 @pytest.mark.anyio
 async def test_get_missing_post_with_comment(
     async_client: AsyncClient, created_post: dict, created_comment: dict
@@ -231,3 +616,118 @@ async def test_get_missing_post_with_comment(
     response = await async_client.get("/post/2")
 
     assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_create_posts_bulk(
+    async_client: AsyncClient, logged_in_token: str, confirmed_user: dict
+):
+    response = await async_client.post(
+        "/post/bulk",
+        json=[{"body": "Test post 1"}, {"body": "Test post 2"}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 201
+    assert response.json() == [
+        {
+            "id": 1,
+            "body": "Test post 1",
+            "user_id": confirmed_user["id"],
+            "image_url": None,
+        },
+        {
+            "id": 2,
+            "body": "Test post 2",
+            "user_id": confirmed_user["id"],
+            "image_url": None,
+        },
+    ]
+
+    response = await async_client.get("/post", params={"sorting": "old"})
+    assert [post["body"] for post in response.json()] == ["Test post 1", "Test post 2"]
+
+
+@pytest.mark.anyio
+async def test_create_posts_bulk_empty(async_client: AsyncClient, logged_in_token: str):
+    response = await async_client.post(
+        "/post/bulk", json=[], headers={"Authorization": f"Bearer {logged_in_token}"}
+    )
+
+    assert response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_create_comments_bulk(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.post(
+        "/comment/bulk",
+        json=[
+            {"body": "Test Comment 1", "post_id": created_post["id"]},
+            {"body": "Test Comment 2", "post_id": created_post["id"]},
+        ],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 201
+    assert [comment["id"] for comment in response.json()] == [1, 2]
+
+    response = await async_client.get(f"/post/{created_post['id']}/comment")
+    assert len(response.json()) == 2
+
+
+@pytest.mark.anyio
+async def test_create_comments_bulk_missing_post(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.post(
+        "/comment/bulk",
+        json=[
+            {"body": "Test Comment 1", "post_id": created_post["id"]},
+            {"body": "Test Comment 2", "post_id": 99},
+        ],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 404
+    assert "99" in response.json()["detail"]
+
+    response = await async_client.get(f"/post/{created_post['id']}/comment")
+    assert response.json() == []
+
+
+@pytest.mark.anyio
+async def test_like_posts_bulk(async_client: AsyncClient, logged_in_token: str):
+    await create_post("Test post 1", async_client, logged_in_token)
+    await create_post("Test post 2", async_client, logged_in_token)
+
+    response = await async_client.post(
+        "/like/bulk",
+        json=[{"post_id": 2}, {"post_id": 1}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 201
+    assert [(like["id"], like["post_id"]) for like in response.json()] == [
+        (1, 2),
+        (2, 1),
+    ]
+
+    response = await async_client.get("/post")
+    assert [post["likes"] for post in response.json()] == [1, 1]
+
+
+@pytest.mark.anyio
+async def test_like_posts_bulk_already_liked(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await like_post(created_post["id"], async_client, logged_in_token)
+
+    response = await async_client.post(
+        "/like/bulk",
+        json=[{"post_id": created_post["id"]}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 409
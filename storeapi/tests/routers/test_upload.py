@@ -1,4 +1,6 @@
+import asyncio
 import contextlib
+import hashlib
 import os
 import pathlib
 import tempfile
@@ -6,6 +8,12 @@ import tempfile
 import pytest
 from httpx import AsyncClient
 
+from storeapi.config import config
+from storeapi.storage import b2 as b2_storage
+from storeapi.upload_index import upload_index
+from storeapi.upload_pool import upload_pool
+from storeapi.upload_sessions import upload_sessions
+
 
 @pytest.fixture()
 def sample_image(fs) -> pathlib.Path:
@@ -16,13 +24,45 @@ def sample_image(fs) -> pathlib.Path:
 
 @pytest.fixture(autouse=True)
 def mock_b2_upload_file(mocker):
-    return mocker.patch(
-        "storeapi.routers.upload.b2_upload_file", return_value="https://fakeurl.com"
+    return mocker.patch.object(
+        b2_storage, "b2_upload_file", return_value="https://fakeurl.com"
     )
 
 
-@pytest.fixture(autoouse=True)
-def aiofile_mock_open(mocker, fs):
+@pytest.fixture()
+def mock_b2_bucket(mocker):
+    # reads the stream the way b2sdk does, in part sized pieces
+    def upload_unbound_stream(reader, file_name, recommended_upload_part_size, **_):
+        while reader.read(recommended_upload_part_size):
+            pass
+        return mocker.Mock(id_="file-id")
+
+    bucket = mocker.Mock()
+    bucket.upload_unbound_stream.side_effect = upload_unbound_stream
+    api = mocker.Mock()
+    api.get_download_url_for_fileid.return_value = "https://fakeurl.com/streamed"
+    mocker.patch("storeapi.libs.b2.b2_api", return_value=api)
+    mocker.patch("storeapi.libs.b2.b2_get_bucket", return_value=bucket)
+    return bucket
+
+
+@pytest.fixture()
+def small_part_size(mocker):
+    mocker.patch.object(config, "UPLOAD_PART_SIZE", 10)
+
+
+@pytest.fixture(autouse=True)
+def upload_session_path(tmp_path: pathlib.Path, mocker):
+    path = tmp_path / "upload_sessions"
+    mocker.patch.object(config, "UPLOAD_SESSION_PATH", str(path))
+    mocker.patch.object(upload_sessions, "root", path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def aiofile_mock_open(mocker, upload_session_path, fs):
+    # upload_session_path first, tmp_path cannot be created in the fake
+    # filesystem
     mock_open = mocker.patch("aiofiles.open")
 
     @contextlib.asynccontextmanager
@@ -68,3 +108,392 @@ async def test_temp_file_removed_after_upload(
 
     created_temp_file = named_temp_file_spy.spy_return
     assert not os.path.exists(created_temp_file.name)
+
+
+@pytest.mark.anyio
+async def test_upload_large_file_streams(
+    async_client: AsyncClient,
+    mock_b2_upload_file,
+    mock_b2_bucket,
+    small_part_size,
+):
+    content = b"x" * 100
+
+    response = await async_client.post(
+        "/upload", files={"file": ("large.bin", content)}
+    )
+
+    assert response.status_code == 201
+    assert response.json()["file_url"] == "https://fakeurl.com/streamed"
+    assert response.json()["sha256"] == hashlib.sha256(content).hexdigest()
+    mock_b2_upload_file.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_stream_upload(
+    async_client: AsyncClient, mock_b2_upload_file, mock_b2_bucket, small_part_size
+):
+    async def body():
+        for _ in range(10):
+            yield b"0123456789abc"
+
+    response = await async_client.put("/upload/large.bin", content=body())
+
+    assert response.status_code == 201
+    assert response.json()["file_url"] == "https://fakeurl.com/streamed"
+    assert (
+        response.json()["sha256"] == hashlib.sha256(b"0123456789abc" * 10).hexdigest()
+    )
+    mock_b2_upload_file.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_stream_upload_small_file_uses_temp_file(
+    async_client: AsyncClient, mock_b2_upload_file, mock_b2_bucket
+):
+    response = await async_client.put("/upload/small.bin", content=b"small")
+
+    assert response.status_code == 201
+    assert response.json()["file_url"] == "https://fakeurl.com"
+    assert response.json()["sha256"] == hashlib.sha256(b"small").hexdigest()
+    mock_b2_bucket.upload_unbound_stream.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_stream_upload_error(
+    async_client: AsyncClient, mock_b2_bucket, small_part_size
+):
+    mock_b2_bucket.upload_unbound_stream.side_effect = RuntimeError("B2 is down")
+
+    response = await async_client.put("/upload/large.bin", content=b"x" * 100)
+
+    assert response.status_code == 500
+
+
+@pytest.mark.anyio
+async def test_upload_duplicate_skips_transfer(
+    async_client: AsyncClient, mock_b2_upload_file, mocker
+):
+    mocker.patch.object(upload_index, "hits", 0)
+    mocker.patch.object(upload_index, "bytes_saved", 0)
+
+    first = await async_client.post("/upload", files={"file": ("a.jpg", b"image")})
+    second = await async_client.post("/upload", files={"file": ("b.jpg", b"image")})
+
+    assert first.json()["deduplicated"] is False
+    assert second.status_code == 201
+    assert second.json()["deduplicated"] is True
+    assert second.json()["file_url"] == first.json()["file_url"]
+    mock_b2_upload_file.assert_called_once()
+    assert upload_index.stats()["hits"] == 1
+    assert upload_index.stats()["bytes_saved"] == len(b"image")
+
+
+@pytest.mark.anyio
+async def test_upload_large_duplicate_skips_transfer(
+    async_client: AsyncClient, mock_b2_bucket, small_part_size
+):
+    content = b"x" * 100
+
+    await async_client.post("/upload", files={"file": ("a.bin", content)})
+    response = await async_client.post("/upload", files={"file": ("b.bin", content)})
+
+    assert response.json()["deduplicated"] is True
+    mock_b2_bucket.upload_unbound_stream.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_stream_upload_duplicate_with_hash_header(
+    async_client: AsyncClient, mock_b2_bucket, small_part_size
+):
+    content = b"x" * 100
+    headers = {"X-Content-SHA256": hashlib.sha256(content).hexdigest()}
+
+    await async_client.put("/upload/a.bin", content=content, headers=headers)
+    response = await async_client.put("/upload/b.bin", content=content, headers=headers)
+
+    assert response.status_code == 201
+    assert response.json()["deduplicated"] is True
+    mock_b2_bucket.upload_unbound_stream.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_stream_upload_without_content_length_counts_bytes(
+    async_client: AsyncClient, mock_b2_bucket, small_part_size, mocker
+):
+    mocker.patch.object(upload_index, "bytes_saved", 0)
+    mocker.patch.object(upload_index, "bytes_stored", 0)
+    content = b"x" * 100
+    headers = {"X-Content-SHA256": hashlib.sha256(content).hexdigest()}
+
+    async def body():
+        yield content
+
+    await async_client.put("/upload/a.bin", content=body(), headers=headers)
+    response = await async_client.put("/upload/b.bin", content=body(), headers=headers)
+
+    assert response.json()["deduplicated"] is True
+    assert upload_index.stats()["bytes_stored"] == len(content)
+    assert upload_index.stats()["bytes_saved"] == len(content)
+
+
+@pytest.mark.anyio
+async def test_stream_upload_duplicate_hash_mismatch(
+    async_client: AsyncClient, mock_b2_bucket, small_part_size
+):
+    content = b"x" * 100
+    await async_client.put("/upload/a.bin", content=content)
+
+    response = await async_client.put(
+        "/upload/b.bin",
+        content=b"y" * 100,
+        headers={"X-Content-SHA256": hashlib.sha256(content).hexdigest()},
+    )
+
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("content_length", ["abc", "-1"])
+async def test_stream_upload_invalid_content_length(
+    async_client: AsyncClient, mock_b2_upload_file, content_length: str
+):
+    response = await async_client.put(
+        "/upload/a.bin", content=b"x", headers={"Content-Length": content_length}
+    )
+
+    assert response.status_code == 400
+    mock_b2_upload_file.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_upload_saturated_is_rejected_before_body(
+    async_client: AsyncClient, mock_b2_upload_file, mocker
+):
+    mocker.patch.object(upload_pool, "pending", upload_pool.max_pending)
+    received = []
+
+    async def body():
+        received.append(True)
+        yield b"x" * 10
+
+    response = await async_client.put("/upload/a.bin", content=body())
+    form_response = await async_client.post(
+        "/upload", files={"file": ("a.jpg", b"image")}
+    )
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert received == []
+    assert form_response.status_code == 503
+    mock_b2_upload_file.assert_not_called()
+
+
+async def create_session(async_client: AsyncClient, **session) -> str:
+    response = await async_client.post(
+        "/upload/sessions", json={"file_name": "large.bin", **session}
+    )
+    assert response.status_code == 201
+    return response.json()["session_id"]
+
+
+async def put_chunk(async_client: AsyncClient, session_id: str, chunk: int, data):
+    return await async_client.put(
+        f"/upload/sessions/{session_id}/chunks/{chunk}", content=data
+    )
+
+
+@pytest.mark.anyio
+async def test_upload_session_chunks_out_of_order(
+    async_client: AsyncClient, mock_b2_bucket
+):
+    content = b"0123456789" * 2 + b"abcde"
+    session_id = await create_session(async_client, size=25, chunk_size=10)
+
+    await asyncio.gather(
+        put_chunk(async_client, session_id, 2, content[20:]),
+        put_chunk(async_client, session_id, 0, content[:10]),
+        put_chunk(async_client, session_id, 1, content[10:20]),
+    )
+    response = await async_client.post(f"/upload/sessions/{session_id}/complete")
+
+    assert response.status_code == 201
+    assert response.json()["file_url"] == "https://fakeurl.com/streamed"
+    assert response.json()["sha256"] == hashlib.sha256(content).hexdigest()
+    assert response.json()["status"] == "complete"
+    # the chunks are removed once they are stored
+    assert not os.path.exists(upload_sessions.root / session_id)
+
+
+@pytest.mark.anyio
+async def test_upload_session_reports_missing_chunks(
+    async_client: AsyncClient, mock_b2_bucket
+):
+    session_id = await create_session(async_client, size=25, chunk_size=10)
+    await put_chunk(async_client, session_id, 1, b"x" * 10)
+
+    session = await async_client.get(f"/upload/sessions/{session_id}")
+    response = await async_client.post(f"/upload/sessions/{session_id}/complete")
+
+    assert session.json()["received"] == [1]
+    assert session.json()["missing"] == [0, 2]
+    assert response.status_code == 409
+    mock_b2_bucket.upload_unbound_stream.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_upload_session_resumes_failed_chunk(
+    async_client: AsyncClient, mock_b2_bucket
+):
+    session_id = await create_session(async_client, chunk_size=10)
+    await put_chunk(async_client, session_id, 0, b"x" * 10)
+    # a chunk sent again replaces the one received before
+    await put_chunk(async_client, session_id, 1, b"partial")
+    await put_chunk(async_client, session_id, 1, b"y" * 5)
+    assert len(os.listdir(upload_sessions.root / session_id)) == 2
+
+    response = await async_client.post(f"/upload/sessions/{session_id}/complete")
+
+    assert response.status_code == 201
+    assert response.json()["sha256"] == hashlib.sha256(b"x" * 10 + b"y" * 5).hexdigest()
+
+
+@pytest.mark.anyio
+async def test_upload_session_short_chunk(async_client: AsyncClient, mock_b2_bucket):
+    session_id = await create_session(async_client, chunk_size=10)
+    await put_chunk(async_client, session_id, 0, b"x" * 5)
+    await put_chunk(async_client, session_id, 1, b"x" * 5)
+
+    response = await async_client.post(f"/upload/sessions/{session_id}/complete")
+
+    assert response.status_code == 409
+
+
+@pytest.mark.anyio
+async def test_upload_session_chunk_too_large(async_client: AsyncClient):
+    session_id = await create_session(async_client, chunk_size=10)
+
+    response = await put_chunk(async_client, session_id, 0, b"x" * 11)
+
+    assert response.status_code == 413
+    assert os.listdir(upload_sessions.root / session_id) == []
+
+
+@pytest.mark.anyio
+async def test_upload_session_chunk_out_of_range(async_client: AsyncClient):
+    session_id = await create_session(async_client, size=10, chunk_size=10)
+
+    response = await put_chunk(async_client, session_id, 1, b"x")
+
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_upload_session_unknown_size_is_bounded(
+    async_client: AsyncClient, mocker
+):
+    mocker.patch.object(upload_sessions, "max_size", 20)
+    session_id = await create_session(async_client, chunk_size=10)
+
+    in_range = await put_chunk(async_client, session_id, 1, b"x")
+    out_of_range = await put_chunk(async_client, session_id, 2, b"x")
+    too_large = await async_client.post(
+        "/upload/sessions", json={"file_name": "large.bin", "size": 21}
+    )
+
+    assert in_range.status_code == 200
+    assert out_of_range.status_code == 400
+    assert too_large.status_code == 413
+
+
+@pytest.mark.anyio
+async def test_upload_session_reopened_after_failed_complete(
+    async_client: AsyncClient, mock_b2_bucket
+):
+    session_id = await create_session(async_client, size=20, chunk_size=10)
+    await put_chunk(async_client, session_id, 0, b"x" * 10)
+    missing = await async_client.post(f"/upload/sessions/{session_id}/complete")
+
+    await put_chunk(async_client, session_id, 1, b"y" * 10)
+    response = await async_client.post(f"/upload/sessions/{session_id}/complete")
+
+    assert missing.status_code == 409
+    assert response.status_code == 201
+    assert response.json()["status"] == "complete"
+
+
+@pytest.mark.anyio
+async def test_upload_session_completed_once(async_client: AsyncClient, mock_b2_bucket):
+    session_id = await create_session(async_client, chunk_size=10)
+    await put_chunk(async_client, session_id, 0, b"x" * 10)
+
+    responses = await asyncio.gather(
+        *(
+            async_client.post(f"/upload/sessions/{session_id}/complete")
+            for _ in range(3)
+        )
+    )
+
+    assert {response.status_code for response in responses} <= {201, 409}
+    assert 201 in {response.status_code for response in responses}
+    mock_b2_bucket.upload_unbound_stream.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_upload_session_refuses_chunks_while_completing(
+    async_client: AsyncClient, mock_b2_bucket, mocker
+):
+    session_id = await create_session(async_client, chunk_size=10)
+    await put_chunk(async_client, session_id, 0, b"x" * 10)
+    run = upload_pool.run
+    during_upload = []
+
+    async def put_during_upload(*args, **kwargs):
+        during_upload.append(await put_chunk(async_client, session_id, 0, b"y" * 10))
+        during_upload.append(
+            await async_client.delete(f"/upload/sessions/{session_id}")
+        )
+        return await run(*args, **kwargs)
+
+    mocker.patch.object(upload_pool, "run", put_during_upload)
+
+    response = await async_client.post(f"/upload/sessions/{session_id}/complete")
+
+    assert [r.status_code for r in during_upload] == [409, 409]
+    assert response.status_code == 201
+    assert response.json()["sha256"] == hashlib.sha256(b"x" * 10).hexdigest()
+
+
+@pytest.mark.anyio
+async def test_upload_session_not_found(async_client: AsyncClient):
+    response = await put_chunk(async_client, "missing", 0, b"x")
+
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_upload_session_duplicate_skips_transfer(
+    async_client: AsyncClient, mock_b2_bucket
+):
+    for _ in range(2):
+        session_id = await create_session(async_client, chunk_size=10)
+        await put_chunk(async_client, session_id, 0, b"x" * 10)
+        response = await async_client.post(f"/upload/sessions/{session_id}/complete")
+
+    assert response.json()["deduplicated"] is True
+    mock_b2_bucket.upload_unbound_stream.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_abandoned_upload_sessions_are_collected(
+    async_client: AsyncClient, mocker
+):
+    session_id = await create_session(async_client, chunk_size=10)
+    await put_chunk(async_client, session_id, 0, b"x" * 10)
+    mocker.patch.object(upload_sessions, "ttl", -1)
+
+    assert await upload_sessions.collect_garbage() == 1
+
+    response = await async_client.get(f"/upload/sessions/{session_id}")
+    assert response.status_code == 404
+    assert not os.path.exists(upload_sessions.root / session_id)
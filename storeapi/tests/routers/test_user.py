@@ -1,6 +1,12 @@
 import pytest
 from fastapi import BackgroundTasks
 from httpx import AsyncClient
+from jose import jwt
+
+from storeapi import security
+from storeapi.config import config
+from storeapi.jobs import job_queue
+from storeapi.security import get_user, password_hasher
 
 # from storeapi import tasks
 
@@ -42,6 +48,17 @@ async def test_confirm_user(async_client: AsyncClient, mocker):
     assert "User confirmed" in responde.json()["detail"]
 
 
+@pytest.mark.anyio
+async def test_confirm_user_invalidates_cached_user(async_client: AsyncClient, mocker):
+    spy = mocker.spy(BackgroundTasks, "add_task")
+    await register_user(async_client, "test@example.com", "1234")
+    assert not (await get_user("test@example.com")).confirmed
+
+    await async_client.get(str(spy.call_args[1]["confirmation_url"]))
+
+    assert (await get_user("test@example.com")).confirmed
+
+
 @pytest.mark.anyio
 async def test_confirm_user_invalid_token(async_client: AsyncClient):
     response = await async_client.get("/confirm/invalid-token")
@@ -85,6 +102,20 @@ async def test_login_user_not_confirmed(
     assert response.status_code == 401
 
 
+@pytest.mark.anyio
+async def test_login_user_busy(async_client: AsyncClient, confirmed_user: dict, mocker):
+    mocker.patch.object(password_hasher, "max_pending", 0)
+
+    response = await async_client.post(
+        "/token",
+        json={
+            "email": confirmed_user["email"],
+            "password": confirmed_user["password"],
+        },
+    )
+    assert response.status_code == 503
+
+
 @pytest.mark.anyio
 async def test_login_user(async_client: AsyncClient, confirmed_user: dict):
     response = await async_client.post(
@@ -95,3 +126,36 @@ async def test_login_user(async_client: AsyncClient, confirmed_user: dict):
         },
     )
     assert response.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_login_user_token_claims(async_client: AsyncClient, confirmed_user: dict):
+    response = await async_client.post(
+        "/token",
+        json={
+            "email": confirmed_user["email"],
+            "password": confirmed_user["password"],
+        },
+    )
+
+    payload = jwt.decode(
+        response.json()["access_token"],
+        key=security.SECRET_KEY,
+        algorithms=[security.ALGORITHM],
+    )
+    assert payload["uid"] == confirmed_user["id"]
+    assert payload["confirmed"]
+
+
+@pytest.mark.anyio
+async def test_register_user_enqueues_email(
+    async_client: AsyncClient, mock_httpx_client, mocker
+):
+    mocker.patch.object(config, "JOB_QUEUE_ENABLED", True)
+    spy = mocker.spy(BackgroundTasks, "add_task")
+
+    await register_user(async_client, "test@example.com", "1234")
+
+    assert spy.call_count == 0
+    assert await job_queue.run_pending() == 1
+    mock_httpx_client.post.assert_called_once()
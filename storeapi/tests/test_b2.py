@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from storeapi.libs import b2 as b2_lib
+from storeapi.libs.b2 import B2Client
+
+
+@pytest.fixture()
+def b2_api(mocker):
+    api = mocker.Mock()
+    mocker.patch.object(b2_lib.b2, "B2Api", return_value=api)
+    return api
+
+
+@pytest.fixture()
+def b2_client() -> B2Client:
+    return B2Client(refresh_interval=3600, retry_interval=60)
+
+
+def test_bucket_is_resolved_once(b2_api, b2_client: B2Client):
+    assert b2_client.bucket() is b2_client.bucket()
+    assert b2_client.api() is b2_api
+
+    b2_api.authorize_account.assert_called_once()
+    b2_api.get_bucket_by_name.assert_called_once()
+
+
+def test_authorize_renews_token_and_keeps_bucket(b2_api, b2_client: B2Client):
+    bucket = b2_client.bucket()
+
+    b2_client.authorize()
+
+    assert b2_api.authorize_account.call_count == 2
+    assert b2_client.bucket() is bucket
+    b2_api.get_bucket_by_name.assert_called_once()
+
+
+def test_failed_authorization_is_retried(b2_api, b2_client: B2Client):
+    b2_api.authorize_account.side_effect = [RuntimeError("B2 is down"), None]
+
+    with pytest.raises(RuntimeError):
+        b2_client.bucket()
+    assert b2_client.stats()["healthy"] is False
+    assert b2_client.stats()["last_error"] == "RuntimeError('B2 is down')"
+
+    b2_client.bucket()
+    assert b2_client.stats()["healthy"] is True
+    assert b2_client.stats()["last_error"] is None
+
+
+@pytest.mark.anyio
+async def test_start_warms_up_and_refreshes(b2_api, mocker):
+    b2_client = B2Client(refresh_interval=0.01, retry_interval=0.01)
+
+    await b2_client.start()
+    assert b2_client.stats()["bucket_cached"] is True
+    await asyncio.sleep(0.1)
+    await b2_client.stop()
+
+    assert b2_client.stats()["running"] is False
+    assert b2_client.stats()["authorizations"] > 1
+    assert b2_client.stats()["bucket_lookups"] == 1
+    assert b2_client.stats()["token_expires_in_seconds"] > 0
+
+
+@pytest.mark.anyio
+async def test_start_survives_failed_warm_up(b2_api, b2_client: B2Client):
+    b2_api.authorize_account.side_effect = RuntimeError("B2 is down")
+
+    await b2_client.start()
+    await b2_client.stop()
+
+    assert b2_client.stats()["authorized"] is False
+    assert b2_client.stats()["failures"] == 1
@@ -0,0 +1,53 @@
+from storeapi.cache import TTLCache
+
+
+def test_get_and_set():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert {"hits": 1, "misses": 1}.items() <= cache.stats().items()
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_expire(mocker):
+    monotonic = mocker.patch("storeapi.cache.time.monotonic", return_value=100)
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=30)
+
+    monotonic.return_value = 111
+
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.stats()["expirations"] == 1
+
+
+def test_delete_where():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set(("feed", 1), [1])
+    cache.set(("feed", 2), [2])
+    cache.set(("post", 1), {})
+
+    assert cache.delete_where(lambda key, value: 1 in value) == 1
+    assert len(cache) == 2
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_zero_maxsize_disables_cache():
+    cache = TTLCache(maxsize=0, ttl=60)
+    cache.set("a", 1)
+
+    assert cache.get("a") is None
@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+import pytest
+
+from storeapi.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class Outage(Exception):
+    pass
+
+
+@pytest.fixture()
+def breaker() -> CircuitBreaker:
+    return CircuitBreaker(
+        "test",
+        failure_threshold=2,
+        reset_timeout=30,
+        deadline=1,
+        max_pending=2,
+        is_failure=lambda err: isinstance(err, Outage),
+    )
+
+
+async def fail(breaker: CircuitBreaker, error: Exception = Outage()):
+    with pytest.raises(type(error)):
+        async with breaker.call():
+            raise error
+
+
+async def succeed(breaker: CircuitBreaker):
+    async with breaker.call():
+        pass
+
+
+def expire(breaker: CircuitBreaker, mocker):
+    # monotonic is read before patching as mocker patches the time module
+    # for everyone
+    now = time.monotonic() + breaker.reset_timeout
+    mocker.patch("storeapi.circuit_breaker.time.monotonic", return_value=now)
+
+
+@pytest.mark.anyio
+async def test_opens_after_consecutive_failures(breaker: CircuitBreaker):
+    await fail(breaker)
+    await succeed(breaker)
+    await fail(breaker)
+    assert breaker.state == "closed"
+
+    await fail(breaker)
+
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        await succeed(breaker)
+    assert breaker.stats()["rejected"] == 1
+
+
+@pytest.mark.anyio
+async def test_other_errors_do_not_count(breaker: CircuitBreaker):
+    for _ in range(3):
+        await fail(breaker, ValueError())
+
+    assert breaker.state == "closed"
+
+
+@pytest.mark.anyio
+async def test_half_open_probe_closes(breaker: CircuitBreaker, mocker):
+    await fail(breaker)
+    await fail(breaker)
+    expire(breaker, mocker)
+
+    assert breaker.state == "half_open"
+    await succeed(breaker)
+    assert breaker.state == "closed"
+
+
+@pytest.mark.anyio
+async def test_half_open_probe_failure_opens(breaker: CircuitBreaker, mocker):
+    await fail(breaker)
+    await fail(breaker)
+    expire(breaker, mocker)
+
+    await fail(breaker)
+
+    assert breaker._state == "open"
+    assert breaker.stats()["opened"] == 2
+
+
+@pytest.mark.anyio
+async def test_half_open_lets_one_probe_through(breaker: CircuitBreaker, mocker):
+    await fail(breaker)
+    await fail(breaker)
+    expire(breaker, mocker)
+    release = asyncio.Event()
+
+    async def probe():
+        async with breaker.call():
+            await release.wait()
+
+    task = asyncio.create_task(probe())
+    await asyncio.sleep(0)
+    with pytest.raises(CircuitOpenError):
+        await succeed(breaker)
+    release.set()
+    await task
+
+    assert breaker.state == "closed"
+
+
+@pytest.mark.anyio
+async def test_deadline(breaker: CircuitBreaker):
+    breaker.deadline = 0.01
+
+    with pytest.raises(TimeoutError):
+        async with breaker.call():
+            await asyncio.sleep(1)
+
+    assert breaker.stats()["timeouts"] == 1
+    assert breaker.consecutive_failures == 1
+
+
+@pytest.mark.anyio
+async def test_max_pending(breaker: CircuitBreaker):
+    release = asyncio.Event()
+
+    async def slow():
+        async with breaker.call():
+            await release.wait()
+
+    tasks = [asyncio.create_task(slow()) for _ in range(2)]
+    await asyncio.sleep(0)
+    with pytest.raises(CircuitOpenError):
+        await succeed(breaker)
+    release.set()
+    await asyncio.gather(*tasks)
+
+    assert breaker.pending == 0
@@ -0,0 +1,37 @@
+import pytest
+
+from storeapi.etag import ResourceVersions, etag_matches
+
+
+@pytest.mark.parametrize(
+    "if_none_match, expected",
+    [
+        (None, False),
+        ('W/"abc"', True),
+        ('"abc"', True),
+        ('W/"other", W/"abc"', True),
+        ('W/"other"', False),
+        ("*", True),
+    ],
+)
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, 'W/"abc"') == expected
+
+
+def test_resource_versions_are_monotonic():
+    versions = ResourceVersions()
+    versions.bump_post(1)
+    first = versions.post(1)
+    versions.bump_feed()
+    versions.bump_post(1)
+
+    assert versions.post(2) == 0
+    assert 0 < first < versions.feed < versions.post(1)
+
+
+def test_resource_versions_reset_changes_boot_id():
+    versions = ResourceVersions()
+    boot_id = versions.boot_id
+    versions.reset()
+
+    assert versions.boot_id != boot_id
@@ -0,0 +1,266 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from databases import Database
+
+from storeapi import jobs, worker
+from storeapi.config import config
+from storeapi.database import database, job_table, post_table
+from storeapi.jobs import JobQueue
+from storeapi.tasks import APIResponseError
+
+
+@pytest.fixture()
+def queue(db: Database) -> JobQueue:
+    return JobQueue(
+        db,
+        workers=2,
+        poll_interval=0.01,
+        visibility_timeout=5,
+        max_attempts=2,
+        backoff=0,
+        backoff_max=0,
+    )
+
+
+@pytest.fixture()
+def calls(mocker) -> list:
+    calls = []
+
+    async def record(database, **payload):
+        calls.append(payload)
+
+    mocker.patch.dict(jobs.HANDLERS, {"record": record})
+    return calls
+
+
+async def get_job(job_id: int):
+    return await database.fetch_one(job_table.select().where(job_table.c.id == job_id))
+
+
+@pytest.mark.anyio
+async def test_enqueue_unknown_job(queue: JobQueue):
+    with pytest.raises(ValueError):
+        await queue.enqueue("unknown")
+
+
+@pytest.mark.anyio
+async def test_run_pending(queue: JobQueue, calls: list):
+    job_id = await queue.enqueue("record", value=1)
+
+    assert await queue.run_pending() == 1
+    assert calls == [{"value": 1}]
+    job = await get_job(job_id)
+    assert job.status == "done"
+    assert job.attempts == 1
+    assert queue.stats()["succeeded"] == 1
+    assert queue.stats()["depth"] == 0
+
+
+@pytest.mark.anyio
+async def test_delayed_job_is_not_claimed(queue: JobQueue, calls: list):
+    await queue.enqueue("record", delay=60)
+
+    assert await queue.run_pending() == 0
+    assert queue.stats()["depth"] == 1
+
+
+@pytest.mark.anyio
+async def test_failed_job_is_retried(queue: JobQueue, mocker):
+    failing = mocker.AsyncMock(side_effect=[RuntimeError("boom"), None])
+    mocker.patch.dict(jobs.HANDLERS, {"failing": failing})
+    job_id = await queue.enqueue("failing")
+
+    assert await queue.run_pending() == 2
+    job = await get_job(job_id)
+    assert job.status == "done"
+    assert job.attempts == 2
+    assert job.last_error == "RuntimeError: boom"
+    assert queue.stats()["retried"] == 1
+
+
+@pytest.mark.anyio
+async def test_job_fails_after_max_attempts(queue: JobQueue, mocker):
+    failing = mocker.AsyncMock(side_effect=RuntimeError("boom"))
+    mocker.patch.dict(jobs.HANDLERS, {"failing": failing})
+    job_id = await queue.enqueue("failing")
+
+    await queue.run_pending()
+
+    assert failing.await_count == 2
+    assert (await get_job(job_id)).status == "failed"
+    assert queue.stats()["failed"] == 1
+
+
+def test_retry_delay_backs_off():
+    queue = JobQueue(
+        None,
+        workers=1,
+        poll_interval=1,
+        visibility_timeout=1,
+        max_attempts=5,
+        backoff=2,
+        backoff_max=10,
+    )
+
+    assert [queue.retry_delay(attempt) for attempt in range(1, 5)] == [2, 4, 8, 10]
+
+
+@pytest.mark.anyio
+async def test_expired_lock_is_claimed_again(queue: JobQueue, calls: list):
+    job_id = await queue.enqueue("record", value=1)
+    # a worker that died after claiming the job
+    await database.execute(
+        job_table.update()
+        .where(job_table.c.id == job_id)
+        .values(status="running", attempts=1, locked_until=time.time() - 1)
+    )
+
+    assert await queue.run_pending() == 1
+    assert calls == [{"value": 1}]
+    assert (await get_job(job_id)).attempts == 2
+
+
+@pytest.mark.anyio
+async def test_workers_run_enqueued_jobs(queue: JobQueue, calls: list):
+    await queue.start()
+    try:
+        for value in range(5):
+            await queue.enqueue("record", value=value)
+        for _ in range(100):
+            if len(calls) == 5:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await queue.stop()
+
+    assert sorted(call["value"] for call in calls) == list(range(5))
+    assert not queue.running
+
+
+@pytest.mark.anyio
+async def test_generate_and_add_to_post_job(
+    queue: JobQueue, created_post: dict, mock_httpx_client, mocker
+):
+    mocker.patch(
+        "storeapi.tasks._generate_cute_creature_api",
+        return_value={"output_url": "http://example.net/image.jpg"},
+    )
+    await queue.enqueue(
+        "generate_and_add_to_post",
+        email="test@example.net",
+        post_id=created_post["id"],
+        post_url="/post/1",
+        prompt="A cat",
+    )
+
+    await queue.run_pending()
+
+    query = post_table.select().where(post_table.c.id == created_post["id"])
+    post = await database.fetch_one(query)
+    assert post.image_url == "http://example.net/image.jpg"
+
+
+def email_subjects(mock_httpx_client) -> list[str]:
+    return [
+        call.kwargs["data"]["subject"] for call in mock_httpx_client.post.call_args_list
+    ]
+
+
+@pytest.mark.anyio
+async def test_generate_and_add_to_post_job_is_retried(
+    queue: JobQueue, created_post: dict, mock_httpx_client, mocker
+):
+    # leaves out the registration email
+    mock_httpx_client.post.reset_mock()
+    mocker.patch(
+        "storeapi.tasks._generate_cute_creature_api",
+        side_effect=[
+            APIResponseError("failed"),
+            {"output_url": "http://example.net/image.jpg"},
+        ],
+    )
+    job_id = await queue.enqueue(
+        "generate_and_add_to_post",
+        email="test@example.net",
+        post_id=created_post["id"],
+        post_url="/post/1",
+        prompt="A cat",
+    )
+
+    await queue.run_pending()
+
+    assert (await get_job(job_id)).attempts == 2
+    assert email_subjects(mock_httpx_client) == ["Image generation completed"]
+
+
+@pytest.mark.anyio
+async def test_generate_and_add_to_post_job_fails_after_max_attempts(
+    queue: JobQueue, created_post: dict, mock_httpx_client, mocker
+):
+    # leaves out the registration email
+    mock_httpx_client.post.reset_mock()
+    mocker.patch(
+        "storeapi.tasks._generate_cute_creature_api",
+        side_effect=APIResponseError("failed"),
+    )
+    job_id = await queue.enqueue(
+        "generate_and_add_to_post",
+        email="test@example.net",
+        post_id=created_post["id"],
+        post_url="/post/1",
+        prompt="A cat",
+    )
+
+    await queue.run_pending()
+
+    assert (await get_job(job_id)).status == "failed"
+    assert email_subjects(mock_httpx_client) == ["Error generating image"]
+
+
+@pytest.mark.anyio
+async def test_generate_and_add_to_post_job_retry_keeps_image(
+    queue: JobQueue, created_post: dict, mock_httpx_client, mocker
+):
+    # leaves out the registration email
+    mock_httpx_client.post.reset_mock()
+    generate = mocker.patch(
+        "storeapi.tasks.generate_cute_creature_api",
+        return_value={"output_url": "http://example.net/image.jpg"},
+    )
+    request = httpx.Request("POST", "//")
+    mock_httpx_client.post.side_effect = [
+        httpx.Response(500, request=request),
+        httpx.Response(200, request=request),
+    ]
+    job_id = await queue.enqueue(
+        "generate_and_add_to_post",
+        email="test@example.net",
+        post_id=created_post["id"],
+        post_url="/post/1",
+        prompt="A cat",
+    )
+
+    await queue.run_pending()
+
+    assert (await get_job(job_id)).status == "done"
+    generate.assert_awaited_once()
+    assert mock_httpx_client.post.await_count == 2
+
+
+@pytest.mark.anyio
+async def test_worker_runs_email_batcher(db: Database, mocker):
+    mocker.patch.object(config, "EMAIL_BATCHING", True)
+    # the test database stays connected
+    mocker.patch.object(worker.database, "connect")
+    mocker.patch.object(worker.database, "disconnect")
+    mocker.patch.object(worker.job_queue, "run_pending", return_value=0)
+    start = mocker.patch.object(worker.email_batcher, "start")
+    stop = mocker.patch.object(worker.email_batcher, "stop")
+
+    await worker.run(workers=1, burst=True)
+
+    start.assert_awaited_once()
+    stop.assert_awaited_once()
@@ -0,0 +1,103 @@
+import pytest
+from databases import Database
+
+from storeapi.database import database, post_table
+from storeapi.likes_buffer import LikeBuffer
+
+
+@pytest.fixture()
+async def buffer(db: Database) -> LikeBuffer:
+    like_buffer = LikeBuffer(db, flush_interval=3600, max_rows=100)
+    await like_buffer.start()
+    yield like_buffer
+    await like_buffer.stop()
+
+
+async def get_likes(post_id: int) -> int:
+    query = post_table.select().where(post_table.c.id == post_id)
+    return (await database.fetch_one(query)).likes
+
+
+@pytest.mark.anyio
+async def test_post_exists(buffer: LikeBuffer, created_post: dict):
+    assert await buffer.post_exists(created_post["id"])
+    assert not await buffer.post_exists(created_post["id"] + 1)
+
+
+@pytest.mark.anyio
+async def test_pending_likes_are_merged(
+    buffer: LikeBuffer, created_post: dict, confirmed_user: dict
+):
+    assert buffer.add(created_post["id"], confirmed_user["id"])
+    assert not buffer.add(created_post["id"], confirmed_user["id"])
+
+    assert buffer.merge({"id": created_post["id"], "likes": 2})["likes"] == 3
+    assert await get_likes(created_post["id"]) == 0
+
+
+@pytest.mark.anyio
+async def test_flush(buffer: LikeBuffer, created_post: dict, confirmed_user: dict):
+    buffer.add(created_post["id"], confirmed_user["id"])
+
+    assert await buffer.flush() == 1
+    assert buffer.pending_likes(created_post["id"]) == 0
+    assert await get_likes(created_post["id"]) == 1
+
+
+@pytest.mark.anyio
+async def test_flush_ignores_persisted_likes(
+    buffer: LikeBuffer, created_post: dict, confirmed_user: dict
+):
+    buffer.add(created_post["id"], confirmed_user["id"])
+    await buffer.flush()
+    buffer.add(created_post["id"], confirmed_user["id"])
+    await buffer.flush()
+
+    assert await get_likes(created_post["id"]) == 1
+
+
+@pytest.mark.anyio
+async def test_stop_drains_buffer(
+    buffer: LikeBuffer, created_post: dict, confirmed_user: dict
+):
+    buffer.add(created_post["id"], confirmed_user["id"])
+
+    await buffer.stop()
+
+    assert not buffer.running
+    assert buffer.stats()["pending"] == 0
+    assert await get_likes(created_post["id"]) == 1
+
+
+@pytest.mark.anyio
+async def test_likes_stay_merged_while_flushing(
+    buffer: LikeBuffer, created_post: dict, confirmed_user: dict, mocker
+):
+    buffer.add(created_post["id"], confirmed_user["id"])
+    execute_many = buffer.database.execute_many
+    merged = []
+
+    async def write_then_read(*args, **kwargs):
+        await execute_many(*args, **kwargs)
+        # the stored counter is not updated yet
+        merged.append(buffer.merge({"id": created_post["id"], "likes": 0})["likes"])
+
+    mocker.patch.object(buffer.database, "execute_many", side_effect=write_then_read)
+
+    await buffer.flush()
+
+    assert merged == [1]
+    assert buffer.pending_likes(created_post["id"]) == 0
+
+
+@pytest.mark.anyio
+async def test_failed_flush_keeps_likes_pending(
+    buffer: LikeBuffer, created_post: dict, confirmed_user: dict, mocker
+):
+    buffer.add(created_post["id"], confirmed_user["id"])
+    mocker.patch.object(
+        buffer.database, "execute_many", side_effect=RuntimeError("locked")
+    )
+
+    assert await buffer.flush() == 0
+    assert buffer.pending_likes(created_post["id"]) == 1
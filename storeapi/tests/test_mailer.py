@@ -0,0 +1,172 @@
+import asyncio
+
+import httpx
+import pytest
+
+from storeapi import mailer
+from storeapi.config import config
+from storeapi.jobs import JobQueue
+from storeapi.mailer import EmailBatcher
+from storeapi.tasks import APIResponseError
+from storeapi.tests.fake_mailgun import FakeMailgun
+
+
+@pytest.fixture()
+async def fake_mailgun(mocker) -> FakeMailgun:
+    fake = FakeMailgun()
+    mocker.patch.object(config, "MAILGUN_API_URL", "http://mailgun.test/v3")
+    mocker.patch.object(config, "MAILGUN_API_KEY", "key")
+    mocker.patch.object(config, "MAILGUN_DOMAIN", "example.net")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=fake.app)) as client:
+        mocker.patch("storeapi.tasks.get_http_client", return_value=client)
+        yield fake
+
+
+@pytest.fixture()
+async def batcher() -> EmailBatcher:
+    email_batcher = EmailBatcher(window=3600, max_recipients=1000)
+    await email_batcher.start()
+    yield email_batcher
+    await email_batcher.stop()
+
+
+async def send_many(batcher: EmailBatcher, addresses: list[str]) -> list:
+    sends = [
+        asyncio.create_task(
+            batcher.send(
+                address,
+                mailer.REGISTRATION_SUBJECT,
+                mailer.REGISTRATION_TEMPLATE,
+                {"confirmation_url": f"http://test/confirm/{address}"},
+            )
+        )
+        for address in addresses
+    ]
+    # let every send queue its recipient before flushing
+    await asyncio.sleep(0)
+    await batcher.flush()
+    return await asyncio.gather(*sends, return_exceptions=True)
+
+
+@pytest.mark.anyio
+async def test_send_batches_recipients(fake_mailgun: FakeMailgun, batcher):
+    addresses = [f"user{i}@example.net" for i in range(3)]
+
+    results = await send_many(batcher, addresses)
+
+    assert all(isinstance(result, httpx.Response) for result in results)
+    assert len(fake_mailgun.calls) == 1
+    assert fake_mailgun.calls[0]["to"] == addresses
+    assert fake_mailgun.messages[0]["text"].endswith(
+        "link: http://test/confirm/user0@example.net"
+    )
+    assert "Hi user0@example.net!" in fake_mailgun.messages[0]["text"]
+
+
+@pytest.mark.anyio
+async def test_send_splits_at_max_recipients(fake_mailgun: FakeMailgun):
+    batcher = EmailBatcher(window=3600, max_recipients=2)
+
+    await send_many(batcher, [f"user{i}@example.net" for i in range(5)])
+
+    assert [len(call["to"]) for call in fake_mailgun.calls] == [2, 2, 1]
+
+
+def test_max_recipients_is_capped():
+    assert EmailBatcher(window=1, max_recipients=5000).max_recipients == 1000
+
+
+@pytest.mark.anyio
+async def test_same_address_goes_to_separate_calls(fake_mailgun: FakeMailgun):
+    batcher = EmailBatcher(window=3600, max_recipients=10)
+
+    await send_many(batcher, ["a@example.net", "a@example.net", "b@example.net"])
+
+    assert [call["to"] for call in fake_mailgun.calls] == [
+        ["a@example.net"],
+        ["a@example.net", "b@example.net"],
+    ]
+
+
+@pytest.mark.anyio
+async def test_invalid_recipient_only_fails_itself(fake_mailgun: FakeMailgun, batcher):
+    fake_mailgun.invalid_addresses = {"bad@example.net"}
+
+    results = await send_many(
+        batcher, ["a@example.net", "bad@example.net", "b@example.net"]
+    )
+
+    assert isinstance(results[0], httpx.Response)
+    assert isinstance(results[1], APIResponseError)
+    assert isinstance(results[2], httpx.Response)
+    assert {message["to"] for message in fake_mailgun.messages} == {
+        "a@example.net",
+        "b@example.net",
+    }
+    assert batcher.stats()["failed"] == 1
+
+
+@pytest.mark.anyio
+async def test_server_error_fails_the_batch(fake_mailgun: FakeMailgun, batcher):
+    fake_mailgun.fail_with = 500
+
+    results = await send_many(batcher, ["a@example.net", "b@example.net"])
+
+    assert all(isinstance(result, APIResponseError) for result in results)
+    assert len(fake_mailgun.calls) == 1
+
+
+@pytest.mark.anyio
+async def test_window_flushes_pending_emails(fake_mailgun: FakeMailgun):
+    batcher = EmailBatcher(window=0.01, max_recipients=1000)
+    await batcher.start()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                batcher.send("a@example.net", "Subject", "Text", {}),
+                batcher.send("b@example.net", "Subject", "Text", {}),
+            ),
+            1,
+        )
+    finally:
+        await batcher.stop()
+
+    assert len(fake_mailgun.calls) == 1
+
+
+@pytest.mark.anyio
+async def test_registration_email_without_batcher(fake_mailgun: FakeMailgun):
+    await mailer.send_user_registration_email("a@example.net", "http://test/confirm")
+
+    assert fake_mailgun.calls[0]["to"] == ["a@example.net"]
+    assert fake_mailgun.messages[0]["text"].endswith("link: http://test/confirm")
+
+
+@pytest.mark.anyio
+async def test_queued_emails_fill_one_batch(fake_mailgun: FakeMailgun, db, mocker):
+    batcher = EmailBatcher(window=0.01, max_recipients=1000)
+    mocker.patch.object(mailer, "email_batcher", batcher)
+    queue = JobQueue(
+        db,
+        workers=1,
+        poll_interval=0.01,
+        visibility_timeout=5,
+        max_attempts=2,
+        backoff=0,
+        backoff_max=0,
+    )
+    addresses = [f"user{i}@example.net" for i in range(5)]
+    for address in addresses:
+        await queue.enqueue(
+            "send_user_registration_email",
+            email=address,
+            confirmation_url=f"http://test/confirm/{address}",
+        )
+
+    await batcher.start()
+    try:
+        assert await queue.run_pending() == 5
+    finally:
+        await batcher.stop()
+
+    assert [call["to"] for call in fake_mailgun.calls] == [addresses]
@@ -0,0 +1,113 @@
+import pathlib
+
+import pytest
+import sqlalchemy
+
+from storeapi import migrations
+
+
+@pytest.fixture()
+def legacy_engine(tmp_path: pathlib.Path) -> sqlalchemy.Engine:
+    # the schema as created by metadata.create_all before the migrations existed
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        for statement in [
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR UNIQUE,"
+            " password VARCHAR, confirmed BOOLEAN)",
+            "CREATE TABLE posts (id INTEGER PRIMARY KEY, body VARCHAR,"
+            " user_id INTEGER NOT NULL REFERENCES users (id), image_url VARCHAR)",
+            "CREATE TABLE comments (id INTEGER PRIMARY KEY, body VARCHAR,"
+            " post_id INTEGER NOT NULL REFERENCES posts (id),"
+            " user_id INTEGER NOT NULL REFERENCES users (id))",
+            "CREATE TABLE likes (id INTEGER PRIMARY KEY,"
+            " post_id INTEGER NOT NULL REFERENCES posts (id),"
+            " user_id INTEGER NOT NULL REFERENCES users (id))",
+            "INSERT INTO users (id, email) VALUES (1, 'test@example.net')",
+            "INSERT INTO posts (id, body, user_id) VALUES (1, 'Test Post', 1)",
+            "INSERT INTO likes (post_id, user_id) VALUES (1, 1), (1, 1)",
+        ]:
+            connection.exec_driver_sql(statement)
+
+    yield engine
+    engine.dispose()
+
+
+def test_run_migrations_upgrades_legacy_schema(legacy_engine: sqlalchemy.Engine):
+    assert migrations.run_migrations(legacy_engine) == [1, 2, 3, 4, 5, 6, 7, 8]
+
+    with legacy_engine.connect() as connection:
+        likes = connection.exec_driver_sql("SELECT likes FROM posts").scalar_one()
+        like_rows = connection.exec_driver_sql(
+            "SELECT count(*) FROM likes"
+        ).scalar_one()
+
+    indexes = {
+        index["name"]
+        for table in ["posts", "comments", "likes"]
+        for index in sqlalchemy.inspect(legacy_engine).get_indexes(table)
+    }
+
+    assert likes == 1
+    assert like_rows == 1
+    assert {
+        "ix_posts_likes_id",
+        "ix_comments_post_id",
+        "uq_likes_post_id_user_id",
+        "ix_likes_user_id",
+    } <= indexes
+
+
+def test_run_migrations_indexes_existing_posts(legacy_engine: sqlalchemy.Engine):
+    migrations.run_migrations(legacy_engine)
+
+    with legacy_engine.connect() as connection:
+        post_ids = connection.exec_driver_sql(
+            "SELECT rowid FROM posts_fts WHERE posts_fts MATCH 'test'"
+        ).scalars()
+
+        assert list(post_ids) == [1]
+
+
+def test_run_migrations_is_idempotent(legacy_engine: sqlalchemy.Engine):
+    migrations.run_migrations(legacy_engine)
+
+    assert migrations.run_migrations(legacy_engine) == []
+
+
+def test_reconcile_post_likes(legacy_engine: sqlalchemy.Engine):
+    migrations.run_migrations(legacy_engine)
+    with legacy_engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE posts SET likes = 5")
+
+    assert migrations.reconcile_post_likes(legacy_engine) == 1
+    assert migrations.reconcile_post_likes(legacy_engine) == 0
+
+    with legacy_engine.connect() as connection:
+        post = connection.exec_driver_sql("SELECT likes, version FROM posts").one()
+
+    # the version is in the post ETags, clients polling them see the change
+    assert (post.likes, post.version) == (1, 1)
+
+
+def test_reconcile_command(legacy_engine: sqlalchemy.Engine, mocker, capsys):
+    migrations.run_migrations(legacy_engine)
+    mocker.patch.object(migrations, "engine", legacy_engine)
+
+    migrations.main(["reconcile"])
+
+    assert capsys.readouterr().out == "Reconciled the like counters of 0 posts\n"
+
+
+def test_hot_queries_use_indexes(legacy_engine: sqlalchemy.Engine):
+    migrations.run_migrations(legacy_engine)
+
+    plans = migrations.explain_hot_queries(legacy_engine)
+
+    assert plans.keys() == migrations.hot_queries().keys()
+    assert migrations.full_scans(plans) == []
+
+
+def test_full_scans():
+    plans = {"indexed": ["SEARCH likes USING INDEX ix"], "scan": ["SCAN likes"]}
+
+    assert migrations.full_scans(plans) == ["scan"]
@@ -20,6 +20,13 @@ def test_create_access_token():
     ).items()
 
 
+def test_create_access_token_with_claims():
+    token = security.create_access_token("123", 1, True)
+    assert {"sub": "123", "uid": 1, "confirmed": True}.items() <= jwt.decode(
+        token, key=security.SECRET_KEY, algorithms=[security.ALGORITHM]
+    ).items()
+
+
 def test_create_confirmation_token():
     token = security.create_confirmation_token("123")
     assert {"sub": "123", "type": "confirmation"}.items() <= jwt.decode(
@@ -83,11 +90,59 @@ def test_get_subject_for_token_type_wrong_type():
     assert "Token has incorrect type, expected 'access'" == exc_info.value.detail
 
 
+def test_get_subject_for_token_type_is_cached(mocker):
+    email = "test@example.com"
+    token = security.create_access_token(email)
+    security.get_subject_for_token_type(token, "access")
+    decode = mocker.spy(security.jwt, "decode")
+
+    assert email == security.get_subject_for_token_type(token, "access")
+    decode.assert_not_called()
+
+
+def test_get_subject_for_token_type_cache_keeps_types_apart():
+    token = security.create_confirmation_token("test@example.com")
+    security.get_subject_for_token_type(token, "confirmation")
+
+    with pytest.raises(security.HTTPException):
+        security.get_subject_for_token_type(token, "access")
+
+
+def test_get_subject_for_token_type_cache_expires_with_token(mocker):
+    token = security.create_access_token("test@example.com")
+    security.get_subject_for_token_type(token, "access")
+    exp = security.token_cache.get(("access", token))["exp"]
+    expires_at = security.time.monotonic() + exp - security.time.time()
+
+    mocker.patch("storeapi.cache.time.monotonic", return_value=expires_at + 1)
+
+    assert ("access", token) not in security.token_cache
+
+
 def test_password_hashes():
     password = "password"
     assert security.verify_password(password, security.get_password_hash(password))
 
 
+@pytest.mark.anyio
+async def test_hash_and_check_password():
+    hashed_password = await security.hash_password("password")
+
+    assert await security.check_password("password", hashed_password)
+    assert not await security.check_password("wrong password", hashed_password)
+    assert security.password_hasher.stats()["calls"] >= 3
+
+
+@pytest.mark.anyio
+async def test_hash_password_saturated(mocker):
+    mocker.patch.object(security.password_hasher, "max_pending", 0)
+
+    with pytest.raises(security.HTTPException) as exc_info:
+        await security.hash_password("password")
+
+    assert exc_info.value.status_code == 503
+
+
 @pytest.mark.anyio
 async def test_get_user(registered_user: dict):
     user = await security.get_user(registered_user["email"])
@@ -95,6 +150,24 @@ async def test_get_user(registered_user: dict):
     assert user.email == registered_user["email"]
 
 
+@pytest.mark.anyio
+async def test_get_user_is_cached(registered_user: dict, mocker):
+    await security.get_user(registered_user["email"])
+    fetch_one = mocker.spy(security.database, "fetch_one")
+
+    user = await security.get_user(registered_user["email"])
+
+    assert user.email == registered_user["email"]
+    fetch_one.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_get_user_not_found_is_not_cached():
+    await security.get_user("test@example.net")
+
+    assert "test@example.net" not in security.user_cache
+
+
 @pytest.mark.anyio
 async def test_get_user_not_found():
     user = await security.get_user("test@example.net")
@@ -142,3 +215,35 @@ async def test_get_current_user_wrong_type_token(registered_user: dict):
 
     with pytest.raises(security.HTTPException):
         await security.get_current_user(token)
+
+
+@pytest.mark.anyio
+async def test_get_current_user_claims(mocker):
+    token = security.create_access_token("test@example.net", 1, True)
+    fetch_one = mocker.spy(security.database, "fetch_one")
+
+    user = await security.get_current_user_claims(token)
+
+    assert user == security.UserClaims(id=1, email="test@example.net", confirmed=True)
+    fetch_one.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_get_current_user_claims_without_claims(confirmed_user: dict):
+    token = security.create_access_token(confirmed_user["email"])
+
+    user = await security.get_current_user_claims(token)
+
+    assert user.id == confirmed_user["id"]
+    assert user.confirmed
+
+
+@pytest.mark.anyio
+async def test_get_current_user_claims_fresh_user(registered_user: dict, mocker):
+    mocker.patch.object(security.config, "ACCESS_TOKEN_FRESH_USER", True)
+    token = security.create_access_token(registered_user["email"], 99, True)
+
+    user = await security.get_current_user_claims(token)
+
+    assert user.id == registered_user["id"]
+    assert not user.confirmed
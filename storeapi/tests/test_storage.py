@@ -0,0 +1,173 @@
+import errno
+import hashlib
+import io
+import os
+import pathlib
+
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from storeapi.config import config
+from storeapi.storage import StorageBackend, get_storage
+from storeapi.storage.b2 import B2Storage
+from storeapi.storage.local import LocalFiles, LocalStorage, copy_fd
+
+
+@pytest.fixture()
+def storage(tmp_path: pathlib.Path) -> LocalStorage:
+    return LocalStorage(str(tmp_path / "files"), "/files/")
+
+
+@pytest.fixture()
+def local_file(tmp_path: pathlib.Path) -> pathlib.Path:
+    path = tmp_path / "upload.tmp"
+    path.write_bytes(b"image content")
+    return path
+
+
+def stored_path(storage: LocalStorage, url: str) -> pathlib.Path:
+    return storage.root / url.removeprefix("/files/")
+
+
+def test_upload_file(storage: LocalStorage, local_file: pathlib.Path):
+    content_hash = hashlib.sha256(b"image content").hexdigest()
+
+    url = storage.upload_file(str(local_file), "Cat.JPG")
+
+    assert url == f"/files/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.jpg"
+    assert stored_path(storage, url).read_bytes() == b"image content"
+    assert local_file.exists()
+
+
+def test_upload_file_same_content_stored_once(
+    storage: LocalStorage, local_file: pathlib.Path
+):
+    first = storage.upload_file(str(local_file), "a.jpg")
+    second = storage.upload_file(str(local_file), "b.jpg")
+
+    assert first == second
+    assert os.listdir(storage.temp_dir) == []
+
+
+def test_upload_file_is_linked_not_copied(
+    storage: LocalStorage, local_file: pathlib.Path
+):
+    url = storage.upload_file(str(local_file), "a.jpg")
+
+    assert stored_path(storage, url).stat().st_ino == local_file.stat().st_ino
+
+
+def test_upload_file_across_filesystems_is_copied(
+    storage: LocalStorage, local_file: pathlib.Path, mocker
+):
+    mocker.patch.object(os, "link", side_effect=OSError(errno.EXDEV, "cross-device"))
+
+    url = storage.upload_file(str(local_file), "a.jpg")
+
+    stored = stored_path(storage, url)
+    assert stored.read_bytes() == b"image content"
+    assert stored.stat().st_ino != local_file.stat().st_ino
+    assert os.listdir(storage.temp_dir) == []
+
+
+def test_upload_stream(storage: LocalStorage):
+    content = os.urandom(3 * 1024 * 1024 + 1)
+
+    url, content_hash = storage.upload_stream(io.BytesIO(content), "big.bin")
+
+    assert content_hash == hashlib.sha256(content).hexdigest()
+    assert stored_path(storage, url).read_bytes() == content
+
+
+def test_upload_stream_failure_leaves_no_temp_file(storage: LocalStorage, mocker):
+    source = mocker.Mock()
+    source.read.side_effect = OSError("connection reset")
+
+    with pytest.raises(OSError):
+        storage.upload_stream(source, "big.bin")
+
+    assert os.listdir(storage.temp_dir) == []
+    assert [path.name for path in storage.root.iterdir()] == [".tmp"]
+
+
+def test_storage_backend_requires_upload_methods():
+    class PartialStorage(StorageBackend):
+        def upload_file(self, local_file, file_name, content_hash=None):
+            return ""
+
+    with pytest.raises(TypeError):
+        PartialStorage()
+
+
+@pytest.mark.parametrize(
+    "missing", [[], ["copy_file_range"], ["copy_file_range", "sendfile"]]
+)
+def test_copy_fd_falls_back(tmp_path: pathlib.Path, mocker, missing: list[str]):
+    for name in missing:
+        mocker.patch.object(os, name, side_effect=OSError(errno.ENOSYS, "nope"))
+    content = os.urandom(100_000)
+    (tmp_path / "src").write_bytes(content)
+
+    src = os.open(tmp_path / "src", os.O_RDONLY)
+    dst = os.open(tmp_path / "dst", os.O_RDWR | os.O_CREAT)
+    try:
+        method = copy_fd(src, dst, len(content))
+    finally:
+        os.close(src)
+        os.close(dst)
+
+    expected = ["copy_file_range", "sendfile", "read_write"][len(missing)]
+    assert method == expected
+    assert (tmp_path / "dst").read_bytes() == content
+
+
+def test_get_storage(mocker, tmp_path: pathlib.Path):
+    mocker.patch.object(config, "STORAGE_BACKEND", "local")
+    mocker.patch.object(config, "LOCAL_STORAGE_PATH", str(tmp_path))
+    get_storage.cache_clear()
+    try:
+        assert isinstance(get_storage(), LocalStorage)
+
+        mocker.patch.object(config, "STORAGE_BACKEND", "b2")
+        get_storage.cache_clear()
+        assert isinstance(get_storage(), B2Storage)
+
+        mocker.patch.object(config, "STORAGE_BACKEND", "ftp")
+        get_storage.cache_clear()
+        with pytest.raises(ValueError):
+            get_storage()
+    finally:
+        get_storage.cache_clear()
+
+
+@pytest.mark.anyio
+async def test_upload_to_local_storage(
+    async_client: AsyncClient, storage: LocalStorage, mocker
+):
+    mocker.patch("storeapi.routers.upload.get_storage", return_value=storage)
+
+    response = await async_client.post(
+        "/upload", files={"file": ("cat.jpg", b"image content")}
+    )
+
+    assert response.status_code == 201
+    url = response.json()["file_url"]
+    assert stored_path(storage, url).read_bytes() == b"image content"
+
+
+@pytest.mark.anyio
+async def test_local_files_are_downloads(storage: LocalStorage):
+    url, _ = storage.upload_stream(io.BytesIO(b"<script></script>"), "page.html")
+    (pathlib.Path(storage.temp_dir) / "partial").write_bytes(b"partial")
+    app = FastAPI()
+    app.mount("/files", LocalFiles(directory=storage.root), name="files")
+
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get(url)
+        temp_response = await client.get("/files/.tmp/partial")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"] == "attachment"
+    assert response.headers["X-Content-Type-Options"] == "nosniff"
+    assert temp_response.status_code == 404
@@ -1,3 +1,5 @@
+import asyncio
+
 import httpx
 import pytest
 from databases import Database
@@ -5,9 +7,13 @@ from databases import Database
 from storeapi.database import database, post_table
 from storeapi.tasks import (
     APIResponseError,
+    deepai_breaker,
+    mailgun_breaker,
     send_simple_email,
     _generate_cute_creature_api,
     generate_and_add_to_post,
+    generate_cute_creature_api,
+    prompt_key,
 )
 
 
@@ -81,3 +87,111 @@ async def test_generate_and_add_to_post_success(
     updated_post = await database.fetch_one(query)
 
     assert updated_post.image_url == json_data["output_url"]
+
+
+def test_prompt_key_normalizes_prompt():
+    assert prompt_key("A  cat ") == prompt_key("a cat")
+    assert prompt_key("a cat") != prompt_key("a dog")
+
+
+@pytest.mark.anyio
+async def test_generate_cute_creature_api_cached(mock_httpx_client):
+    mock_httpx_client.post.return_value = httpx.Response(
+        status_code=200,
+        json={"output_url": "https://example.com/image.jpg"},
+        request=httpx.Request("POST", "//"),
+    )
+
+    first = await generate_cute_creature_api("A cat")
+    second = await generate_cute_creature_api(" a  CAT")
+
+    assert first == second
+    assert mock_httpx_client.post.await_count == 1
+
+
+@pytest.mark.anyio
+async def test_generate_cute_creature_api_shares_request(mocker):
+    release = asyncio.Event()
+
+    async def slow_api(prompt: str):
+        await release.wait()
+        return {"output_url": "https://example.com/image.jpg"}
+
+    api = mocker.patch(
+        "storeapi.tasks._generate_cute_creature_api", side_effect=slow_api
+    )
+
+    calls = [asyncio.create_task(generate_cute_creature_api("A cat")) for _ in range(3)]
+    await asyncio.sleep(0)
+    release.set()
+
+    results = await asyncio.gather(*calls)
+
+    assert api.await_count == 1
+    assert all(result == results[0] for result in results)
+
+
+@pytest.mark.anyio
+async def test_generate_cute_creature_api_limits_concurrency(mocker):
+    mocker.patch("storeapi.tasks._deepai_slots", asyncio.Semaphore(2))
+    running, peak = 0, 0
+
+    async def api(prompt: str):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return {"output_url": f"https://example.com/{prompt}.jpg"}
+
+    mocker.patch("storeapi.tasks._generate_cute_creature_api", side_effect=api)
+
+    await asyncio.gather(*(generate_cute_creature_api(f"prompt {i}") for i in range(6)))
+
+    assert peak == 2
+
+
+@pytest.mark.anyio
+async def test_generate_cute_creature_api_failure_not_cached(mocker):
+    api = mocker.patch(
+        "storeapi.tasks._generate_cute_creature_api",
+        side_effect=[
+            APIResponseError("failed"),
+            {"output_url": "https://example.com/image.jpg"},
+        ],
+    )
+
+    with pytest.raises(APIResponseError):
+        await generate_cute_creature_api("A cat")
+    await generate_cute_creature_api("A cat")
+
+    assert api.await_count == 2
+
+
+@pytest.mark.anyio
+async def test_send_simple_email_fails_fast_when_circuit_open(mock_httpx_client):
+    mock_httpx_client.post.return_value = httpx.Response(
+        status_code=503, content="", request=httpx.Request("POST", "//")
+    )
+    for _ in range(mailgun_breaker.failure_threshold):
+        with pytest.raises(APIResponseError):
+            await send_simple_email("test@example.com", "Test subject", "Test body")
+    mock_httpx_client.post.reset_mock()
+
+    with pytest.raises(APIResponseError, match="circuit is open"):
+        await send_simple_email("test@example.com", "Test subject", "Test body")
+
+    mock_httpx_client.post.assert_not_called()
+    assert mailgun_breaker.stats()["state"] == "open"
+
+
+@pytest.mark.anyio
+async def test_client_errors_do_not_open_circuit(mock_httpx_client):
+    mock_httpx_client.post.return_value = httpx.Response(
+        status_code=400, content="", request=httpx.Request("POST", "//")
+    )
+    for _ in range(deepai_breaker.failure_threshold):
+        with pytest.raises(APIResponseError):
+            await _generate_cute_creature_api("A cat")
+
+    assert deepai_breaker.state == "closed"
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from storeapi.upload_pool import UploadPool
+
+
+@pytest.fixture()
+def pool() -> UploadPool:
+    upload_pool = UploadPool(workers=2, max_pending=3)
+    yield upload_pool
+    upload_pool.shutdown()
+
+
+@pytest.mark.anyio
+async def test_run_in_thread(pool: UploadPool):
+    def upload(local_file: str, file_name: str) -> str:
+        assert threading.current_thread() is not threading.main_thread()
+        return f"https://example.net/{file_name}"
+
+    url = await pool.run(upload, local_file="/tmp/x", file_name="x.jpg", size=10)
+
+    assert url == "https://example.net/x.jpg"
+    stats = pool.stats()
+    assert stats["uploads"] == 1
+    assert stats["bytes"] == 10
+
+
+@pytest.mark.anyio
+async def test_failed_upload(pool: UploadPool):
+    def upload():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        await pool.run(upload)
+
+    assert pool.stats()["failed"] == 1
+    assert pool.pending == 0
+
+
+@pytest.mark.anyio
+async def test_saturated(pool: UploadPool):
+    pool.pending = pool.max_pending
+
+    with pytest.raises(HTTPException) as exc_info:
+        await pool.run(time.sleep, 0)
+
+    assert exc_info.value.status_code == 503
+    assert pool.stats()["rejected"] == 1
+
+
+@pytest.mark.anyio
+async def test_concurrency_limited_to_workers(pool: UploadPool):
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def upload():
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+
+    await asyncio.gather(*(pool.run(upload) for _ in range(3)))
+
+    assert peak == 2
@@ -0,0 +1,70 @@
+import logging
+from typing import Optional
+
+from databases import Database
+
+from storeapi import metrics
+from storeapi.database import database, upload_table
+
+logger = logging.getLogger(__name__)
+
+
+class UploadIndex:
+    # maps the sha256 of uploaded content to the url it was stored at, an
+    # upload whose content is already stored returns that url instead of
+    # being transferred again
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self.lookups = 0
+        self.hits = 0
+        self.bytes_saved = 0
+        self.bytes_stored = 0
+
+    async def lookup(self, content_hash: str, size: Optional[int]) -> Optional[str]:
+        # size is None when the content was not read yet, the caller counts it
+        # with saved() once it was
+        query = upload_table.select().where(upload_table.c.content_hash == content_hash)
+        row = await self.database.fetch_one(query)
+        self.lookups += 1
+        if row is None:
+            return None
+
+        self.hits += 1
+        if size is not None:
+            self.saved(size)
+        logger.debug(f"Upload deduplicated to {row.file_url}")
+        return row.file_url
+
+    def saved(self, size: int) -> None:
+        self.bytes_saved += size
+
+    async def record(
+        self, content_hash: str, file_url: str, size: int, file_name: str
+    ) -> None:
+        # concurrent uploads of the same content both store it, the first one
+        # recorded wins
+        query = (
+            upload_table.insert()
+            .prefix_with("OR IGNORE")
+            .values(
+                content_hash=content_hash,
+                file_url=file_url,
+                size=size,
+                file_name=file_name,
+            )
+        )
+        await self.database.execute(query)
+        self.bytes_stored += size
+
+    def stats(self) -> dict:
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "bytes_stored": self.bytes_stored,
+        }
+
+
+upload_index = UploadIndex(database)
+metrics.register("upload_dedup", upload_index.stats)
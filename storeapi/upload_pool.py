@@ -0,0 +1,51 @@
+import logging
+from typing import Callable, Union
+
+from storeapi import metrics
+from storeapi.config import config
+from storeapi.executor import BoundedExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class UploadPool(BoundedExecutor):
+    # runs the blocking storage client calls in their own threads so a long
+    # transfer does not block the event loop, and counts the bytes stored
+    def __init__(self, workers: int, max_pending: int) -> None:
+        super().__init__("storage-upload", workers, max_pending, retry_after=5)
+        self.bytes = 0
+
+    async def run(
+        self, func: Callable, *args, size: Union[int, Callable[[], int]] = 0, **kwargs
+    ):
+        result = await super().run(func, *args, **kwargs)
+        # a callable for a stream whose size is only known once it was read
+        size = size() if callable(size) else size
+        self.bytes += size
+        logger.debug(f"Uploaded {size} bytes in {self.last_run_seconds:.3f}s")
+        return result
+
+    def stats(self) -> dict:
+        uploads = max(self.calls, 1)
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "uploads": self.calls,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "bytes": self.bytes,
+            "queue_seconds_avg": self.queue_seconds_total / uploads,
+            "queue_seconds_max": self.queue_seconds_max,
+            "upload_seconds_avg": self.run_seconds_total / uploads,
+            "upload_seconds_max": self.run_seconds_max,
+            "last_upload_seconds": self.last_run_seconds,
+            "bytes_per_second": (
+                self.bytes / self.run_seconds_total if self.run_seconds_total else 0.0
+            ),
+        }
+
+
+upload_pool = UploadPool(
+    workers=config.UPLOAD_WORKERS, max_pending=config.UPLOAD_MAX_PENDING
+)
+metrics.register("upload_pool", upload_pool.stats)
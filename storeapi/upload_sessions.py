@@ -0,0 +1,463 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+import aiofiles
+import sqlalchemy
+from databases import Database
+from fastapi import HTTPException, status
+
+from storeapi import metrics
+from storeapi.config import config
+from storeapi.database import database, upload_chunk_table, upload_session_table
+from storeapi.storage import get_storage
+from storeapi.upload_index import upload_index
+from storeapi.upload_pool import upload_pool
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ChunkReader:
+    # a blocking read() over the chunk files in order, the storage backend
+    # pulls the assembled file through it one piece at a time so it is never
+    # held in memory as a whole
+    def __init__(self, paths: list[Path]) -> None:
+        self._paths = list(paths)
+        self._file = None
+
+    def read(self, size: int = -1) -> bytes:
+        data = bytearray()
+        while size < 0 or len(data) < size:
+            if self._file is None:
+                if not self._paths:
+                    break
+                self._file = open(self._paths.pop(0), "rb")
+
+            chunk = self._file.read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self._file.close()
+                self._file = None
+                continue
+            data += chunk
+        return bytes(data)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def hash_files(paths: list[Path]) -> str:
+    content_hash = hashlib.sha256()
+    reader = ChunkReader(paths)
+    try:
+        while chunk := reader.read(CHUNK_SIZE):
+            content_hash.update(chunk)
+    finally:
+        reader.close()
+    return content_hash.hexdigest()
+
+
+def not_found() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found"
+    )
+
+
+class UploadSessions:
+    # resumable uploads: a session is created, its numbered chunks are put in
+    # any order, possibly at the same time, and the session is completed once
+    # all of them are received. Each chunk is a file under root/<session id>
+    # and a row in upload_chunks, a failed chunk is simply put again. Sessions
+    # not touched for ttl seconds are removed every gc_interval seconds
+    def __init__(
+        self,
+        database: Database,
+        root: str,
+        max_chunk_size: int,
+        max_size: int,
+        ttl: float,
+        gc_interval: float,
+    ) -> None:
+        self.database = database
+        self.root = Path(root)
+        self.max_chunk_size = max_chunk_size
+        self.max_size = max_size
+        self.ttl = ttl
+        self.gc_interval = gc_interval
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self.created = 0
+        self.chunks = 0
+        self.chunk_bytes = 0
+        self.completed = 0
+        self.collected = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def _dir(self, session_id: str) -> Path:
+        return self.root / session_id
+
+    def _chunk_path(self, session_id: str, row) -> Path:
+        # chunks put before upload_chunks.file existed have no file name
+        return self._dir(session_id) / (row.file or f"{row.chunk:08d}")
+
+    async def create(
+        self, file_name: str, size: Optional[int], chunk_size: Optional[int]
+    ) -> dict:
+        chunk_size = chunk_size or self.max_chunk_size
+        if chunk_size > self.max_chunk_size:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"chunk_size can be at most {self.max_chunk_size}",
+            )
+        if size is not None and size > self.max_size:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Uploads can be at most {self.max_size} bytes",
+            )
+
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        await asyncio.to_thread(self._dir(session_id).mkdir, parents=True)
+        query = upload_session_table.insert().values(
+            id=session_id,
+            file_name=file_name,
+            size=size,
+            chunk_size=chunk_size,
+            status="open",
+            created_at=now,
+            updated_at=now,
+        )
+        await self.database.execute(query)
+        self.created += 1
+        logger.debug(f"Created upload session {session_id} for {file_name}")
+        return await self.get(session_id)
+
+    async def _fetch(self, session_id: str):
+        query = upload_session_table.select().where(
+            upload_session_table.c.id == session_id
+        )
+        session = await self.database.fetch_one(query)
+        if session is None:
+            raise not_found()
+        return session
+
+    async def _received(self, session_id: str) -> list:
+        query = (
+            upload_chunk_table.select()
+            .where(upload_chunk_table.c.session_id == session_id)
+            .order_by(upload_chunk_table.c.chunk)
+        )
+        return await self.database.fetch_all(query)
+
+    def _chunk_count(self, session) -> Optional[int]:
+        if session.size is None:
+            return None
+        return max(-(-session.size // session.chunk_size), 1)
+
+    def _max_chunk_count(self, session) -> int:
+        # a session of unknown size takes at most max_size bytes of chunks
+        return self._chunk_count(session) or -(-self.max_size // session.chunk_size)
+
+    async def _not_open(self, session_id: str) -> HTTPException:
+        session = await self._fetch(session_id)
+        return HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload session is {session.status}",
+        )
+
+    async def get(self, session_id: str) -> dict:
+        session = await self._fetch(session_id)
+        received = [row.chunk for row in await self._received(session_id)]
+        chunk_count = self._chunk_count(session)
+        missing = None
+        if chunk_count is not None:
+            missing = sorted(set(range(chunk_count)) - set(received))
+        return {
+            "session_id": session.id,
+            "file_name": session.file_name,
+            "size": session.size,
+            "chunk_size": session.chunk_size,
+            "status": session.status,
+            "file_url": session.file_url,
+            "received": received,
+            "missing": missing,
+            "expires_at": session.updated_at + self.ttl,
+        }
+
+    async def put_chunk(
+        self, session_id: str, chunk: int, chunks: AsyncIterator[bytes]
+    ) -> int:
+        session = await self._fetch(session_id)
+        if session.status != "open":
+            raise await self._not_open(session_id)
+
+        if chunk < 0 or chunk >= self._max_chunk_count(session):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Chunk {chunk} is out of range",
+            )
+
+        # every put writes a file of its own and the chunk row is pointed at
+        # it only while the session is open, a completing session reads files
+        # that no later put replaces. A chunk that is put twice at the same
+        # time keeps one of them complete
+        file = f"{chunk:08d}.{uuid.uuid4().hex}"
+        path = self._dir(session_id) / file
+        size = 0
+        try:
+            async with aiofiles.open(path, "wb") as f:
+                async for data in chunks:
+                    size += len(data)
+                    if size > session.chunk_size:
+                        raise HTTPException(
+                            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"Chunks can be at most {session.chunk_size} bytes",
+                        )
+                    await f.write(data)
+        except FileNotFoundError:
+            # the session dir was removed, the session completed or was deleted
+            raise await self._not_open(session_id)
+        except BaseException:
+            await asyncio.to_thread(self._unlink, path)
+            raise
+
+        previous = await self.database.fetch_one(
+            upload_chunk_table.select().where(
+                upload_chunk_table.c.session_id == session_id,
+                upload_chunk_table.c.chunk == chunk,
+            )
+        )
+        is_open = sqlalchemy.exists().where(
+            upload_session_table.c.id == session_id,
+            upload_session_table.c.status == "open",
+        )
+        query = (
+            upload_chunk_table.insert()
+            .prefix_with("OR REPLACE")
+            .from_select(
+                ["session_id", "chunk", "size", "file"],
+                sqlalchemy.select(
+                    sqlalchemy.literal(session_id),
+                    sqlalchemy.literal(chunk),
+                    sqlalchemy.literal(size),
+                    sqlalchemy.literal(file),
+                ).where(is_open),
+            )
+            .returning(upload_chunk_table.c.chunk)
+        )
+        if await self.database.fetch_one(query) is None:
+            await asyncio.to_thread(self._unlink, path)
+            raise await self._not_open(session_id)
+        if previous is not None:
+            await asyncio.to_thread(
+                self._unlink, self._chunk_path(session_id, previous)
+            )
+
+        await self._touch(session_id)
+        self.chunks += 1
+        self.chunk_bytes += size
+        return size
+
+    def _unlink(self, path: Path) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    async def _touch(self, session_id: str, **values) -> None:
+        query = (
+            upload_session_table.update()
+            .where(upload_session_table.c.id == session_id)
+            .values(updated_at=time.time(), **values)
+        )
+        await self.database.execute(query)
+
+    def _check_complete(self, session, received: list) -> int:
+        # chunks 0..n-1 must all be there and all but the last one full, when
+        # the size is not known the highest chunk received is the last one
+        chunks = [row.chunk for row in received]
+        chunk_count = self._chunk_count(session)
+        if chunk_count is None:
+            chunk_count = chunks[-1] + 1 if chunks else 1
+        missing = sorted(set(range(chunk_count)) - set(chunks))
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Upload session is missing chunks {missing}",
+            )
+
+        short = [row.chunk for row in received[:-1] if row.size != session.chunk_size]
+        if short:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Chunks {short} are shorter than chunk_size",
+            )
+
+        size = sum(row.size for row in received)
+        if session.size is not None and size != session.size:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Received {size} bytes, expected {session.size}",
+            )
+        return size
+
+    async def complete(self, session_id: str) -> dict:
+        session = await self._fetch(session_id)
+        if session.status == "complete":
+            # completing again, e.g. after the response was lost, is harmless
+            return await self.get(session_id)
+
+        # a single caller moves the session from open to completing, chunks
+        # put after that are refused. updated_at is touched so the garbage
+        # collection does not remove the chunks while they are uploaded
+        claim = (
+            upload_session_table.update()
+            .where(
+                upload_session_table.c.id == session_id,
+                upload_session_table.c.status == "open",
+            )
+            .values(status="completing", updated_at=time.time())
+            .returning(upload_session_table.c.id)
+        )
+        if await self.database.fetch_one(claim) is None:
+            session = await self._fetch(session_id)
+            if session.status == "complete":
+                return await self.get(session_id)
+            raise await self._not_open(session_id)
+
+        try:
+            received = await self._received(session_id)
+            size = self._check_complete(session, received)
+            paths = [self._chunk_path(session_id, row) for row in received]
+
+            # hashing the chunks on disk first avoids sending content that is
+            # already stored
+            content_hash = await asyncio.to_thread(hash_files, paths)
+            if file_url := await upload_index.lookup(content_hash, size):
+                deduplicated = True
+            else:
+                reader = ChunkReader(paths)
+                try:
+                    file_url, content_hash = await upload_pool.run(
+                        get_storage().upload_stream,
+                        reader,
+                        session.file_name,
+                        size=size,
+                    )
+                finally:
+                    reader.close()
+                await upload_index.record(
+                    content_hash, file_url, size, session.file_name
+                )
+                deduplicated = False
+        except BaseException:
+            # the client can put the missing chunks or complete again
+            await self._touch(session_id, status="open")
+            raise
+
+        await self._touch(session_id, status="complete", file_url=file_url)
+        await asyncio.to_thread(shutil.rmtree, self._dir(session_id), True)
+        self.completed += 1
+        logger.info(f"Completed upload session {session_id} as {file_url}")
+        return {
+            **await self.get(session_id),
+            "sha256": content_hash,
+            "deduplicated": deduplicated,
+        }
+
+    async def delete(self, session_id: str) -> None:
+        session = await self._fetch(session_id)
+        if session.status == "completing":
+            raise await self._not_open(session_id)
+        await self._remove([session_id])
+
+    async def _remove(self, session_ids: list[str]) -> None:
+        async with self.database.transaction():
+            await self.database.execute(
+                upload_chunk_table.delete().where(
+                    upload_chunk_table.c.session_id.in_(session_ids)
+                )
+            )
+            await self.database.execute(
+                upload_session_table.delete().where(
+                    upload_session_table.c.id.in_(session_ids)
+                )
+            )
+        for session_id in session_ids:
+            await asyncio.to_thread(shutil.rmtree, self._dir(session_id), True)
+
+    async def collect_garbage(self) -> int:
+        # completed sessions are kept as long as open ones so a client can
+        # still look up the url of an upload it completed
+        cutoff = time.time() - self.ttl
+        query = (
+            upload_session_table.select()
+            .with_only_columns(upload_session_table.c.id)
+            .where(upload_session_table.c.updated_at < cutoff)
+        )
+        session_ids = [row.id for row in await self.database.fetch_all(query)]
+        if session_ids:
+            await self._remove(session_ids)
+            self.collected += len(session_ids)
+            logger.info(f"Removed {len(session_ids)} abandoned upload sessions")
+        return len(session_ids)
+
+    async def start(self) -> None:
+        logger.info("Starting upload session garbage collection")
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await self.collect_garbage()
+            except Exception:
+                logger.exception("Collecting upload sessions failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.gc_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "created": self.created,
+            "chunks": self.chunks,
+            "chunk_bytes": self.chunk_bytes,
+            "completed": self.completed,
+            "collected": self.collected,
+        }
+
+
+upload_sessions = UploadSessions(
+    database,
+    root=config.UPLOAD_SESSION_PATH,
+    max_chunk_size=config.UPLOAD_SESSION_MAX_CHUNK_SIZE,
+    max_size=config.UPLOAD_SESSION_MAX_SIZE,
+    ttl=config.UPLOAD_SESSION_TTL_SECONDS,
+    gc_interval=config.UPLOAD_SESSION_GC_INTERVAL_SECONDS,
+)
+metrics.register("upload_sessions", upload_sessions.stats)
@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import logging
+import signal
+
+from storeapi.config import config
+from storeapi.database import database, engine
+from storeapi.jobs import job_queue
+from storeapi.loggin_conf import configure_logging
+from storeapi.mailer import email_batcher
+from storeapi.migrations import run_migrations
+from storeapi.tasks import close_http_client
+
+logger = logging.getLogger(__name__)
+
+
+async def run(workers: int, burst: bool):
+    await database.connect()
+    # started like in the app, the email jobs are meant to run here
+    if config.EMAIL_BATCHING:
+        await email_batcher.start()
+    try:
+        if burst:
+            ran = await job_queue.run_pending()
+            logger.info(f"Ran {ran} jobs")
+            return
+
+        job_queue.workers = workers
+        await job_queue.start()
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+
+        await job_queue.stop()
+    finally:
+        await email_batcher.stop()
+        await close_http_client()
+        await database.disconnect()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Run the storeapi job workers")
+    parser.add_argument("--workers", type=int, default=job_queue.workers)
+    parser.add_argument(
+        "--burst", action="store_true", help="run the due jobs and exit"
+    )
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    run_migrations(engine)
+    asyncio.run(run(args.workers, args.burst))
+
+
+if __name__ == "__main__":
+    main()